@@ -1,7 +1,10 @@
-import os, sys, cPickle, pprint, subprocess, time, random
+import os, sys, cPickle, pprint, time, multiprocessing
+import threading, Queue, collections
 from itertools import product
+from multiprocessing.pool import ThreadPool
 import numpy, pylab
 from scipy.ndimage import gaussian_filter, median_filter, interpolation
+from scipy.ndimage import maximum_filter
 from scipy.signal import hann, gaussian
 try:
     from scipy.spatial import Delaunay
@@ -15,6 +18,7 @@ try:
 except ImportError:
     raise UserWarning("simple_tif.py import failed. " +
                       "Go get it from the MSIM website.")
+import artifact_cache
 
 def get_lattice_vectors(
     filename_list=['Sample.raw'],
@@ -29,6 +33,7 @@ def get_lattice_vectors(
     preframes=0,
     extent=15,
     num_spikes=300,
+    subpixel_spikes=False,
     tolerance=3.,
     num_harmonics=3,
     outlier_phase=1.,
@@ -41,7 +46,9 @@ def get_lattice_vectors(
     show_interpolation=False,
     show_calibration_steps=False,
     show_lattice=False,
-    record_parameters=True):
+    record_parameters=True,
+    num_processes=1, #For the 'arbitrary' scan type's offset search
+    store_fft_data=False): #Only needed to debug the shift vector
 
     if scan_type == 'visitech': #legacy support
         scan_type = '1d'
@@ -62,6 +69,7 @@ def get_lattice_vectors(
              xPix=xPix, yPix=yPix, zPix=zPix, preframes=preframes,
              extent=extent,
              num_spikes=num_spikes,
+             subpixel_spikes=subpixel_spikes,
              tolerance=tolerance,
              num_harmonics=num_harmonics,
              outlier_phase=outlier_phase,
@@ -71,7 +79,8 @@ def get_lattice_vectors(
              display=display,
              animate=animate,
              show_interpolation=show_interpolation,
-             show_lattice=show_lattice)
+             show_lattice=show_lattice,
+             num_processes=num_processes)
         print "Lake lattice vectors:"
         for v in lake_lattice_vectors:
             print v
@@ -130,7 +139,8 @@ def get_lattice_vectors(
         print
         corrected_shift_vector, final_offset_vector = get_precise_shift_vector(
             direct_lattice_vectors, shift_vector, offset_vector,
-            image_proj, zPix, scan_type, verbose)            
+            image_proj, zPix, scan_type, verbose,
+            num_processes=num_processes)
     else:
         if len(filename_list) > 1:
             raise UserWarning(
@@ -140,15 +150,16 @@ def get_lattice_vectors(
         image_data = load_image_data(
             filename_list[0], xPix=xPix, yPix=yPix, zPix=zPix,
             preframes=preframes)
-        fft_data_folder, fft_abs, fft_avg = get_fft_abs(
-            filename_list[0], image_data) #DC term at center
+        fft_data_name, fft_abs, fft_avg = get_fft_abs(
+            filename_list[0], image_data, #DC term at center
+            store_fft_data=store_fft_data, preframes=preframes)
         filtered_fft_abs = spike_filter(fft_abs)
 
         """Find candidate spikes in the Fourier domain"""
         #FIXME: If 'extent' is unset, add an interactive 'extent' setting.
         coords = find_spikes(
             fft_abs, filtered_fft_abs, extent=extent, num_spikes=num_spikes,
-            display=display, animate=animate)
+            display=display, animate=animate, subpixel=subpixel_spikes)
         """Use these candidate spikes to determine the
         Fourier-space lattice"""
         if verbose: print "Finding Fourier-space lattice vectors..."
@@ -195,10 +206,11 @@ def get_lattice_vectors(
 
         if scan_type in ('1d', '2d'):
             shift_vector = get_shift_vector(
-                corrected_basis_vectors, fft_data_folder, filtered_fft_abs,
+                corrected_basis_vectors, fft_data_name, filtered_fft_abs,
                 num_harmonics=num_harmonics, outlier_phase=outlier_phase,
                 verbose=verbose, display=display,
-                scan_type=scan_type, scan_dimensions=scan_dimensions)
+                scan_type=scan_type, scan_dimensions=scan_dimensions,
+                image_data=None if store_fft_data else image_data)
             im = image_data[-1, :, :]
         elif scan_type in ('arbitrary',):
             shift_vector = None
@@ -206,7 +218,8 @@ def get_lattice_vectors(
         
         corrected_shift_vector, final_offset_vector = get_precise_shift_vector(
             direct_lattice_vectors, shift_vector, offset_vector,
-            im, zPix, scan_type, verbose)
+            im, zPix, scan_type, verbose,
+            num_processes=num_processes)
 
     if show_lattice:
         which_filename = 0
@@ -277,6 +290,8 @@ def enderlein_image_parallel(
     lattice_vectors, offset_vector, shift_vector,
     new_grid_xrange, new_grid_yrange,
     num_processes=1,
+    chunk_size=10, #Frames per task handed to each worker process
+    tile_rows=None, #Rows of the new grid per task, to split space, not time
     window_footprint=10,
     aperture_size=3,
     scale_factor=0.5,
@@ -291,9 +306,20 @@ def enderlein_image_parallel(
     intermediate_data=False, #Memory hog, for stupid reasons, leave 'False'
     normalize=False, #Of uncertain merit, leave 'False' probably
     display=False,
+    vectorized=True, #Process all spots in a frame at once
+    dtype=numpy.float64, #float32 halves memory use and the saved images
     ):
+    """
+    The workers split up the frames, by default. Each one builds a
+    full-size image from its frames, and we add them up at the end. For
+    very large fields of view, that's a lot of full-size images; set
+    'tile_rows' and each worker builds every frame's contribution to
+    one tile of the new grid instead, which goes straight into place.
+    """
     input_arguments = locals()
     input_arguments.pop('num_processes')
+    input_arguments.pop('chunk_size')
+    input_arguments.pop('tile_rows')
 
     print "\nCalculating Enderlein image"
     print
@@ -303,14 +329,17 @@ def enderlein_image_parallel(
     background_basename = os.path.splitext(background_filename)[0]
     background_name = background_basename + '_background_image.raw'
     average_intensity_name = basename + '_avg_intensity.pkl'
+    artifact_names, sources, parameters, hashed_sources = (
+        enderlein_artifact(input_arguments))
     
-    if os.path.exists(enderlein_image_name):
+    if artifact_cache.is_cached(artifact_names, sources, parameters,
+                                hashed_sources=hashed_sources):
         print "\nEnderlein image already calculated."
         print "Loading", os.path.split(enderlein_image_name)[1]
         images = {}
         try:
             images['enderlein_image'] = numpy.fromfile(
-                enderlein_image_name, dtype=float
+                enderlein_image_name, dtype=dtype
                 ).reshape(new_grid_xrange[2], new_grid_yrange[2])
         except ValueError:
             print "\n\nWARNING: the data file:"
@@ -318,13 +347,13 @@ def enderlein_image_parallel(
             print "may not be the size it was expected to be.\n\n"
             raise
     else:
-        start_time = time.clock()
+        start_time = time.time()
         image_average_intensity = calculate_laser_intensity_drift(
             image_filename=data_filename, bg_filename=background_name,
             output_filename=average_intensity_name,
             xPix=xPix, yPix=yPix, zPix=zPix, preframes=preframes,
             display=display)
-        if num_processes == 1:
+        if num_processes == 1 and tile_rows is None:
             images = enderlein_image_subprocess(**input_arguments)
         else:
             input_arguments['intermediate_data'] = False #Difficult for parallel
@@ -332,68 +361,107 @@ def enderlein_image_parallel(
             input_arguments['show_slices'] = False #Difficult for parallel
             input_arguments['display'] = False #Annoying for parallel
             input_arguments['verbose'] = False #Annoying for parallel
-            
-            step_boundaries = range(0, steps, 10) + [steps]
-            step_boundaries = [
-                (step_boundaries[i], step_boundaries[i+1] - 1)
-                for i in range(len(step_boundaries)-1)]
-            running_processes = {}
-            first_harvest = True
-            random_prefix = '%06i_'%(random.randint(0, 999999))
-            while len(running_processes) > 0 or len(step_boundaries) > 0:
-                """Load up the subprocesses"""
-                while (len(running_processes) < num_processes and
-                       len(step_boundaries) > 0):
-                    sb = step_boundaries.pop(0)
-                    (input_arguments['start_frame'],
-                     input_arguments['end_frame']) = (sb)
-                    output_filename = (random_prefix +
-                                       '%i_%i_intermediate_data.temp'%(sb))
-                    sys.stdout.write(
-                        "\rProcessing frames: " + repr(sb[0]) + '-' +
-                        repr(sb[1]) + ' '*10)
-                    sys.stdout.flush()
-                    command_string = """
-import array_illumination, cPickle
-from numpy import array
-input_arguments=%s
-sub_images = array_illumination.enderlein_image_subprocess(**input_arguments)
-cPickle.dump(sub_images, open('%s', 'wb'), protocol=2)
-"""%(repr(input_arguments), output_filename)
-                    running_processes[output_filename] = subprocess.Popen(
-                        [sys.executable, '-c %s'%command_string],
-                        stdin=subprocess.PIPE,
-                        stdout=subprocess.PIPE,
-                        stderr=subprocess.PIPE)
-                """Poke each subprocess, harvest the finished ones"""
-                pop_me = []
-                for f, proc in running_processes.items():
-                    if proc.poll() is not None: #Time to harvest
-                        pop_me.append(f)
-                        report = proc.communicate()
-                        if report != ('', ''):
-                            print report
-                            raise UserWarning("Problem with a subprocess.")
-                        sub_images = cPickle.load(open(f, 'rb'))
-                        os.remove(f)
-                        
-                        if first_harvest:
-                            images = sub_images
-                            first_harvest = False
-                        else:
-                            for k in images.keys():
-                                images[k] += sub_images[k]
-                for p in pop_me: #Forget about the harvested processes
-                    running_processes.pop(p)
-                """Chill for a second"""
-                time.sleep(0.2)
-        end_time = time.clock()
+            if make_confocal_image:
+                input_arguments['vectorized'] = False
+            """Load the calibration once, here, and hand it to every
+            worker process when the pool starts"""
+            state = load_enderlein_state(
+                data_filename=data_filename,
+                lake_filename=lake_filename,
+                background_filename=background_filename,
+                xPix=xPix, yPix=yPix, zPix=zPix, steps=steps,
+                preframes=preframes,
+                lattice_vectors=lattice_vectors,
+                offset_vector=offset_vector, shift_vector=shift_vector,
+                new_grid_xrange=new_grid_xrange,
+                new_grid_yrange=new_grid_yrange,
+                window_footprint=window_footprint,
+                scale_factor=scale_factor,
+                flat_fielding=flat_fielding,
+                laser_intensity_drift_correction=(
+                    laser_intensity_drift_correction),
+                scan_uniformity_correction=scan_uniformity_correction,
+                vectorized=input_arguments['vectorized'],
+                verbose=verbose)
+            grid_shape = (new_grid_xrange[2], new_grid_yrange[2])
+            if tile_rows is not None and input_arguments['vectorized']:
+                """Each worker writes its tiles straight into the images"""
+                image_names = ['enderlein_image']
+                if make_widefield_image:
+                    image_names.append('widefield_image')
+                shared_images = multiprocessing.RawArray(
+                    numpy.dtype(dtype).char,
+                    len(image_names) * grid_shape[0] * grid_shape[1])
+                tiles = [(r, min(r + tile_rows, grid_shape[0]))
+                         for r in range(0, grid_shape[0], tile_rows)]
+                pool = multiprocessing.Pool(
+                    processes=num_processes,
+                    initializer=_tile_worker_init,
+                    initargs=(input_arguments, state, image_names,
+                              shared_images))
+                try:
+                    for rows in pool.imap_unordered(_tile_worker, tiles):
+                        sys.stdout.write(
+                            "\rProcessed rows: " + repr(rows[0]) + '-' +
+                            repr(rows[1] - 1) + ' '*10)
+                        sys.stdout.flush()
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+                shared_images = numpy.frombuffer(
+                    shared_images, dtype=dtype).reshape(
+                        (len(image_names),) + grid_shape)
+                images = dict(zip(image_names, shared_images))
+            else:
+                """Each worker accumulates into its own slot of shared
+                memory"""
+                image_names = ['enderlein_image', 'enderlein_normalization']
+                if make_widefield_image:
+                    image_names.append('widefield_image')
+                if make_confocal_image:
+                    image_names.append('confocal_image')
+                partial_sums = multiprocessing.RawArray(
+                    numpy.dtype(dtype).char, num_processes * len(image_names) *
+                    grid_shape[0] * grid_shape[1])
+                slot_counter = multiprocessing.Value('i', 0)
+                chunks = [(z, min(z + chunk_size, steps) - 1)
+                          for z in range(0, steps, chunk_size)]
+                pool = multiprocessing.Pool(
+                    processes=num_processes,
+                    initializer=_enderlein_worker_init,
+                    initargs=(input_arguments, state, image_names,
+                              partial_sums, slot_counter))
+                try:
+                    for sb in pool.imap_unordered(_enderlein_worker, chunks):
+                        sys.stdout.write(
+                            "\rProcessed frames: " + repr(sb[0]) + '-' +
+                            repr(sb[1]) + ' '*10)
+                        sys.stdout.flush()
+                    pool.close()
+                except:
+                    pool.terminate()
+                    raise
+                finally:
+                    pool.join()
+                partial_sums = numpy.frombuffer(
+                    partial_sums, dtype=dtype).reshape(
+                        (num_processes, len(image_names)) + grid_shape)
+                images = dict(zip(image_names, partial_sums.sum(axis=0)))
+                enderlein_normalization = images.pop('enderlein_normalization')
+                if normalize:
+                    images['enderlein_image'] /= enderlein_normalization
+        end_time = time.time()
         print "Elapsed time: %0.2f seconds"%(end_time - start_time)
         images['enderlein_image'].tofile(enderlein_image_name)
         if make_widefield_image:
             images['widefield_image'].tofile(basename + '_widefield.raw')
         if make_confocal_image:
             images['confocal_image'].tofile(basename + '_confocal.raw')
+        artifact_cache.store(artifact_names, sources, parameters,
+                             hashed_sources=hashed_sources)
     if display:
         fig = pylab.figure()
         pylab.imshow(images['enderlein_image'],
@@ -402,6 +470,93 @@ cPickle.dump(sub_images, open('%s', 'wb'), protocol=2)
         fig.show()
     return images
 
+_worker_state = {}
+
+def _enderlein_worker_init(
+    input_arguments, state, image_names, partial_sums, slot_counter):
+    """Runs once in each of enderlein_image_parallel()'s worker
+    processes. Remembers the calibration, and claims a slot in the
+    shared partial sums."""
+    with slot_counter.get_lock():
+        slot = slot_counter.value
+        slot_counter.value += 1
+    grid_shape = (input_arguments['new_grid_xrange'][2],
+                  input_arguments['new_grid_yrange'][2])
+    partial_sums = numpy.frombuffer(
+        partial_sums, dtype=input_arguments['dtype']).reshape(
+            (-1, len(image_names)) + grid_shape)
+    _worker_state['input_arguments'] = input_arguments
+    _worker_state['state'] = state
+    _worker_state['partial_sums'] = dict(
+        zip(image_names, partial_sums[slot]))
+
+def _tile_worker_init(input_arguments, state, image_names, shared_images):
+    """Runs once in each of enderlein_image_parallel()'s worker
+    processes, when it splits the new grid into tiles"""
+    grid_shape = (input_arguments['new_grid_xrange'][2],
+                  input_arguments['new_grid_yrange'][2])
+    shared_images = numpy.frombuffer(
+        shared_images, dtype=input_arguments['dtype']).reshape(
+            (len(image_names),) + grid_shape)
+    _worker_state['input_arguments'] = input_arguments
+    _worker_state['state'] = state
+    _worker_state['images'] = dict(zip(image_names, shared_images))
+
+def _tile_worker(grid_rows):
+    """Build every frame's contribution to one tile of the new grid,
+    and put it in place"""
+    tile_images = enderlein_image_subprocess(
+        state=_worker_state['state'], grid_rows=grid_rows,
+        **_worker_state['input_arguments'])
+    for k, image in _worker_state['images'].items():
+        image[grid_rows[0]:grid_rows[1], :] = tile_images[k]
+    return grid_rows
+
+def _enderlein_worker(frames):
+    """Process a chunk of frames, and add the results to this worker's
+    partial sums"""
+    input_arguments = dict(_worker_state['input_arguments'])
+    input_arguments['start_frame'], input_arguments['end_frame'] = frames
+    sub_images = enderlein_image_subprocess(
+        state=_worker_state['state'], return_sums=True, **input_arguments)
+    for k, partial_sum in _worker_state['partial_sums'].items():
+        partial_sum += sub_images[k]
+    return frames
+
+def enderlein_artifact(arguments):
+    """
+    The files enderlein_image_parallel() saves its images to, for a
+    dict of its 'arguments', and the sources, parameters and hashed
+    sources artifact_cache records them with. The reconstruction is
+    only reusable if it came from the same data, calibration and
+    settings.
+    """
+    basename = os.path.splitext(arguments['data_filename'])[0]
+    background_basename = os.path.splitext(
+        arguments['background_filename'])[0]
+    lake_basename = os.path.splitext(arguments['lake_filename'])[0]
+    artifact_names = [basename + '_enderlein_image.raw']
+    if arguments['make_widefield_image']:
+        artifact_names.append(basename + '_widefield.raw')
+    if arguments['make_confocal_image']:
+        artifact_names.append(basename + '_confocal.raw')
+    hot_pixels_name = os.path.join(
+        os.path.dirname(background_basename), 'hot_pixels.txt')
+    sources = [arguments['data_filename'],
+               background_basename + '_background_image.raw',
+               hot_pixels_name]
+    if arguments['flat_fielding']:
+        sources.append(lake_basename + '_spot_intensities.npy')
+    if arguments['laser_intensity_drift_correction']:
+        sources.append(lake_basename + '_avg_intensity.pkl')
+    parameters = dict(arguments)
+    for k in ('data_filename', 'lake_filename', 'background_filename',
+              'verbose', 'show_steps', 'show_slices', 'display', 'vectorized'):
+        parameters.pop(k)
+    parameters['dtype'] = numpy.dtype(
+        parameters['dtype']).str #'float32' or numpy.float32
+    return artifact_names, sources, parameters, [hot_pixels_name]
+
 def enderlein_image_subprocess(
     data_filename, lake_filename, background_filename,
     xPix, yPix, zPix, steps, preframes,
@@ -422,36 +577,551 @@ def enderlein_image_subprocess(
     intermediate_data=False, #Memory hog, for stupid reasons. Leave 'False'
     normalize=False, #Of uncertain merit, leave 'False' probably
     display=False,
+    vectorized=True, #Process all spots in a frame at once
+    dtype=numpy.float64, #float32 halves memory use, and is plenty precise
+    grid_rows=None, #(first, last+1) rows of the new grid, for one tile
+    state=None, #From load_enderlein_state(), to skip reloading calibration
+    return_sums=False, #Unnormalized sums, for combining partial results
     ):
-    """Determine file names"""
+    reconstructor = Enderlein_Reconstructor(
+        data_filename=data_filename, lake_filename=lake_filename,
+        background_filename=background_filename,
+        xPix=xPix, yPix=yPix, zPix=zPix, steps=steps, preframes=preframes,
+        lattice_vectors=lattice_vectors,
+        offset_vector=offset_vector, shift_vector=shift_vector,
+        new_grid_xrange=new_grid_xrange, new_grid_yrange=new_grid_yrange,
+        window_footprint=window_footprint,
+        aperture_size=aperture_size,
+        scale_factor=scale_factor,
+        make_widefield_image=make_widefield_image,
+        make_confocal_image=make_confocal_image,
+        flat_fielding=flat_fielding,
+        laser_intensity_drift_correction=laser_intensity_drift_correction,
+        scan_uniformity_correction=scan_uniformity_correction,
+        verbose=verbose,
+        show_steps=show_steps,
+        show_slices=show_slices,
+        intermediate_data=intermediate_data,
+        normalize=normalize,
+        display=display,
+        vectorized=vectorized,
+        dtype=dtype,
+        grid_rows=grid_rows,
+        state=state)
+    image_data = load_image_data(
+        filename=data_filename, xPix=xPix, yPix=yPix, zPix=zPix,
+        preframes=preframes)
+    if start_frame is None:
+        start_frame = 0
+    if end_frame is None:
+        end_frame = steps - 1
+    """Now, time to chug through some data."""
+    for z in range(start_frame, end_frame+1):
+        reconstructor.add_frame(z, image_data[z, :, :])
+    return reconstructor.result(return_sums=return_sums)
+
+class Enderlein_Reconstructor:
+    """
+    Builds an Enderlein image one raw frame at a time, so processing can
+    keep pace with acquisition instead of waiting for the whole stack
+    to hit the disk. Feed it frames with add_frame(), in any order, and
+    call result() whenever you want the image so far.
+
+    'data_filename' is only used to find (or name) auxiliary files like
+    the intensity drift and intermediate data, so it can be the file
+    the raw data is still being saved to.
+
+    The images are accumulated (and returned) as 'dtype'. Our raw data
+    is 16-bit, so float32 loses nothing that matters, and halves the
+    memory and disk bandwidth of float64.
+
+    For very large fields of view, 'grid_rows' (first, last+1) builds
+    just those rows of the new grid: one tile. Tiles only need the
+    spots that land on them, and the raw image rows under those spots,
+    so memory scales with the tile, and tiles can be stitched together
+    without adding anything up.
+    """
+    def __init__(
+        self,
+        data_filename, lake_filename, background_filename,
+        xPix, yPix, zPix, steps, preframes,
+        lattice_vectors, offset_vector, shift_vector,
+        new_grid_xrange, new_grid_yrange,
+        window_footprint=10,
+        aperture_size=3,
+        scale_factor=0.5,
+        make_widefield_image=True,
+        make_confocal_image=False, #Broken, for now
+        flat_fielding=True,
+        laser_intensity_drift_correction=False,
+        scan_uniformity_correction=True,
+        verbose=True,
+        show_steps=False, #For debugging
+        show_slices=False, #For debugging
+        intermediate_data=False, #Memory hog. Leave 'False'
+        normalize=False, #Of uncertain merit, leave 'False' probably
+        display=False,
+        vectorized=True, #Process all spots in a frame at once
+        dtype=numpy.float64,
+        grid_rows=None, #(first, last+1) rows of the new grid, for one tile
+        state=None, #From load_enderlein_state()
+        ):
+        """What enderlein_image_parallel() would get, for save()"""
+        self.input_arguments = dict(locals())
+        for k in ('self', 'grid_rows', 'state'):
+            self.input_arguments.pop(k)
+        if show_steps or intermediate_data or make_confocal_image:
+            vectorized = False #These need the spot-by-spot loop
+        if state is None:
+            state = load_enderlein_state(
+                data_filename=data_filename, lake_filename=lake_filename,
+                background_filename=background_filename,
+                xPix=xPix, yPix=yPix, zPix=zPix, steps=steps,
+                preframes=preframes,
+                lattice_vectors=lattice_vectors,
+                offset_vector=offset_vector, shift_vector=shift_vector,
+                new_grid_xrange=new_grid_xrange,
+                new_grid_yrange=new_grid_yrange,
+                window_footprint=window_footprint, scale_factor=scale_factor,
+                flat_fielding=flat_fielding,
+                laser_intensity_drift_correction=(
+                    laser_intensity_drift_correction),
+                scan_uniformity_correction=scan_uniformity_correction,
+                vectorized=vectorized,
+                verbose=verbose, display=display)
+        self.state = state
+        self.xPix, self.yPix = xPix, yPix
+        self.lattice_vectors = lattice_vectors
+        self.offset_vector = offset_vector
+        self.shift_vector = shift_vector
+        self.window_footprint = window_footprint
+        self.scale_factor = scale_factor
+        self.make_widefield_image = make_widefield_image
+        self.make_confocal_image = make_confocal_image
+        self.flat_fielding = flat_fielding
+        self.laser_intensity_drift_correction = (
+            laser_intensity_drift_correction)
+        self.scan_uniformity_correction = scan_uniformity_correction
+        self.verbose = verbose
+        self.show_steps = show_steps
+        self.show_slices = show_slices
+        self.intermediate_data = intermediate_data
+        self.normalize = normalize
+        self.vectorized = vectorized
+        self.dtype = numpy.dtype(dtype)
+
+        """Precalculate a few useful quantities"""
+        self.new_grid_x = numpy.linspace(*new_grid_xrange)
+        self.new_grid_y = numpy.linspace(*new_grid_yrange)
+        self.aperture_1d = gaussian(2*window_footprint+1, std=aperture_size)
+        aperture = self.aperture_1d.reshape(2*window_footprint+1, 1)
+        self.aperture = aperture * aperture.T
+        self.grid_step_x = self.new_grid_x[1] - self.new_grid_x[0]
+        self.grid_step_y = self.new_grid_y[1] - self.new_grid_y[0]
+        self.subgrid_footprint, self.subgrid = get_subgrid(
+            self.new_grid_x, self.new_grid_y, window_footprint, scale_factor)
+        self.subgrid_points = ((2*self.subgrid_footprint[0] + 1) *
+                               (2*self.subgrid_footprint[1] + 1))
+
+        """
+        Which part of the new grid do we build? A tile's spots spill a
+        subgrid footprint past its rows, so we accumulate those rows
+        too ('buffer_rows'), but only return the tile's own.
+        """
+        num_rows = self.new_grid_x.shape[0]
+        if grid_rows is None:
+            grid_rows = (0, num_rows)
+        elif not vectorized:
+            raise UserWarning("Tiled reconstruction needs vectorized=True")
+        self.grid_rows = tuple(grid_rows)
+        subgrid_rows = 2*int(self.subgrid_footprint[0]) + 1
+        self.buffer_rows = (max(grid_rows[0] - subgrid_rows, 0),
+                            min(grid_rows[1] + subgrid_rows, num_rows))
+        self.image_rows = (0, xPix)
+        self.hot_pixels = state['hot_pixels']
+        self.reassignment_table = state.get('reassignment_table')
+        if self.grid_rows != (0, num_rows):
+            self._set_up_tile(state, window_footprint)
+        self.background_frame = numpy.asarray(
+            state['background_frame'][self.image_rows[0]:self.image_rows[1]],
+            dtype=self.dtype)
+
+        """Create data containers"""
+        if show_steps or show_slices:
+            self.fig = pylab.figure()
+        grid_shape = (self.buffer_rows[1] - self.buffer_rows[0],
+                      self.new_grid_y.shape[0])
+        self.enderlein_image = numpy.zeros(grid_shape, dtype=self.dtype)
+        self.enderlein_normalization = numpy.zeros(
+            grid_shape, dtype=self.dtype)
+        self.this_frames_enderlein_image = numpy.zeros(
+            grid_shape, dtype=self.dtype)
+        self.this_frames_normalization = numpy.zeros(
+            grid_shape, dtype=self.dtype)
+        if intermediate_data:
+            basename = os.path.splitext(data_filename)[0]
+            self.cumulative_sum = numpy.memmap(
+                basename + '_cumsum.raw', dtype=float, mode='w+',
+                shape=(steps,) + grid_shape)
+            self.processed_frames = numpy.memmap(
+                basename + '_frames.raw', dtype=float, mode='w+',
+                shape=(steps,) + grid_shape)
+            self.x_scan_positions = numpy.memmap(
+                basename + '_frames_x.raw', dtype=float, mode='w+',
+                shape=(steps,) + grid_shape)
+            self.y_scan_positions = numpy.memmap(
+                basename + '_frames_y.raw', dtype=float, mode='w+',
+                shape=(steps,) + grid_shape)
+        if make_widefield_image:
+            """Resampling is linear, so instead of resampling every
+            frame onto the new grid, we add up the raw frames, and
+            resample the sum when someone asks for the result"""
+            self.raw_frame_sum = numpy.zeros(
+                (self.image_rows[1] - self.image_rows[0], yPix))
+            widefield_grid_x = self.new_grid_x[
+                self.grid_rows[0]:self.grid_rows[1]] - self.image_rows[0]
+            self.widefield_shape = (widefield_grid_x.shape[0], grid_shape[1])
+            widefield_coordinates = numpy.meshgrid(
+                widefield_grid_x, self.new_grid_y)
+            self.widefield_coordinates = (
+                widefield_coordinates[0].ravel(),
+                widefield_coordinates[1].ravel())
+        if make_confocal_image:
+            self.confocal_image = numpy.zeros(grid_shape, dtype=self.dtype)
+        self.reset()
+        return None
+
+    def _set_up_tile(self, state, window_footprint):
+        """Keep only the spots that land on our rows of the new grid,
+        and the raw image rows under their windows (and under the
+        widefield image's interpolation), plus a row either side for
+        the hot pixel median. Renumber the rows to match."""
+        table = state['reassignment_table']
+        subgrid_rows = 2*int(self.subgrid_footprint[0]) + 1
+        in_tile = (
+            (table['grid_corners'][:, 0] < self.grid_rows[1]) &
+            (table['grid_corners'][:, 0] + subgrid_rows > self.grid_rows[0]))
+        window_rows = table['window_corners'][in_tile, 0]
+        tile_x = self.new_grid_x[self.grid_rows[0]:self.grid_rows[1]]
+        first_row = numpy.concatenate((
+            window_rows, [numpy.floor(tile_x[0]) - window_footprint])).min()
+        last_row = numpy.concatenate((
+            window_rows + 2*window_footprint + 3,
+            [numpy.ceil(tile_x[-1]) + window_footprint + 1])).max()
+        self.image_rows = (max(int(first_row) - 1, 0),
+                           min(int(last_row) + 1, self.xPix))
+        self.reassignment_table = dict(
+            (k, table[k][in_tile]) for k in (
+                'window_corners', 'window_shifts',
+                'grid_corners', 'grid_shifts', 'weights'))
+        self.reassignment_table['window_corners'] -= (self.image_rows[0], 0)
+        self.reassignment_table['grid_corners'] -= (self.buffer_rows[0], 0)
+        spots_so_far = numpy.concatenate(([0], numpy.cumsum(in_tile)))
+        self.reassignment_table['frame_start'] = spots_so_far[
+            table['frame_start']]
+        if self.hot_pixels is not None:
+            x, y = numpy.unravel_index(
+                self.hot_pixels.targets, self.hot_pixels.image_shape)
+            in_band = (x >= self.image_rows[0]) & (x < self.image_rows[1])
+            self.hot_pixels = Hot_Pixel_Corrector(
+                numpy.transpose((y[in_band], x[in_band] - self.image_rows[0])),
+                image_shape=(self.image_rows[1] - self.image_rows[0],
+                             self.yPix))
+        return None
+
+    def reset(self):
+        """Forget every frame added so far"""
+        self.enderlein_image.fill(0)
+        self.enderlein_normalization.fill(1e-12)
+        if self.make_widefield_image:
+            self.raw_frame_sum.fill(0)
+        if self.make_confocal_image:
+            self.confocal_image.fill(0)
+        self.num_frames = 0
+        return None
+
+    def add_frame(self, z, image):
+        """Add raw frame number 'z' of the scan to the Enderlein image"""
+        state = self.state
+        window_footprint = self.window_footprint
+        subgrid_footprint = self.subgrid_footprint
+        background_frame = self.background_frame
+        this_frames_enderlein_image = self.this_frames_enderlein_image
+        this_frames_normalization = self.this_frames_normalization
+        im = numpy.asarray(
+            image[self.image_rows[0]:self.image_rows[1]]).astype(self.dtype)
+        if self.hot_pixels is not None:
+            im = self.hot_pixels.correct(im)
+        this_frames_enderlein_image.fill(0.)
+        this_frames_normalization.fill(1e-12)
+        if self.verbose:
+            sys.stdout.write("\rProcessing raw data image %i"%(z))
+            sys.stdout.flush()
+        if self.make_widefield_image:
+            self.raw_frame_sum += im
+        if self.laser_intensity_drift_correction:
+            signal_avg_intensity_normalization = state[
+                'signal_avg_intensity'][z]
+            if self.flat_fielding:
+                lake_avg_intensity_normalization = state[
+                    'lake_avg_intensity'][z]
+            else:
+                lake_avg_intensity_normalization = 1
+        else:
+            signal_avg_intensity_normalization = 1
+            lake_avg_intensity_normalization = 1
+        if self.vectorized:
+            reassignment_table = self.reassignment_table
+            frame_start = reassignment_table['frame_start']
+            spots = slice(frame_start[z], frame_start[z+1])
+            left, right = get_spot_operators(
+                reassignment_table['window_shifts'][spots],
+                reassignment_table['grid_shifts'][spots],
+                self.subgrid, self.aperture_1d)
+            left = numpy.asarray(left, dtype=self.dtype)
+            right = numpy.asarray(right, dtype=self.dtype)
+            reassign_spots(
+                image=im - background_frame,
+                window_corners=reassignment_table['window_corners'][spots],
+                grid_corners=reassignment_table['grid_corners'][spots],
+                left=left, right=right,
+                weights=(reassignment_table['weights'][spots] *
+                         signal_avg_intensity_normalization *
+                         lake_avg_intensity_normalization),
+                enderlein_image=this_frames_enderlein_image,
+                enderlein_normalization=this_frames_normalization)
+        else:
+            lattice_points, i_list, j_list = (
+                generate_lattice(
+                    image_shape=(self.xPix, self.yPix),
+                    lattice_vectors=self.lattice_vectors,
+                    center_pix=self.offset_vector + get_shift(
+                        self.shift_vector, z),
+                    edge_buffer=window_footprint+1,
+                    return_i_j=True))
+            if self.scan_uniformity_correction:
+                uniformity_normalization = state['vertex_weights'][z]
+            else:
+                uniformity_normalization = 1.
+            if self.flat_fielding:
+                intensity_normalizations = 1.0 / (
+                    state['intensities_vs_scan_position'].lookup(
+                        i_list, j_list, z))
+            else:
+                intensity_normalizations = numpy.ones(len(lattice_points))
+            for m, lp in enumerate(lattice_points):
+                i, j = int(i_list[m]), int(j_list[m])
+                """Take an image centered on each illumination point"""
+                spot_image = get_centered_subimage(
+                    center_point=lp, window_size=window_footprint,
+                    image=im, background=background_frame)
+                """Aperture the image with a synthetic pinhole"""
+                intensity_normalization = intensity_normalizations[m]
+                if (intensity_normalization == 0 or
+                    spot_image.shape != (2*window_footprint+1,
+                                         2*window_footprint+1)):
+                    continue #Skip to the next spot
+                apertured_image = (self.aperture *
+                                   spot_image *
+                                   intensity_normalization *
+                                   uniformity_normalization *
+                                   signal_avg_intensity_normalization *
+                                   lake_avg_intensity_normalization)
+                nearest_grid_index = numpy.round(
+                        (lp - (self.new_grid_x[0], self.new_grid_y[0])) /
+                        (self.grid_step_x, self.grid_step_y))
+                nearest_grid_point = (
+                    (self.new_grid_x[0], self.new_grid_y[0]) +
+                    (self.grid_step_x, self.grid_step_y) * nearest_grid_index)
+                new_coordinates = numpy.meshgrid(
+                    self.subgrid[0] + (1.0 / self.scale_factor) * (
+                        nearest_grid_point[0] - lp[0]),
+                    self.subgrid[1] + (1.0 / self.scale_factor) * (
+                        nearest_grid_point[1] - lp[1]))
+                resampled_image = interpolation.map_coordinates(
+                    apertured_image,
+                    (new_coordinates[0].reshape(self.subgrid_points),
+                     new_coordinates[1].reshape(self.subgrid_points))
+                    ).reshape(2*subgrid_footprint[1]+1,
+                              2*subgrid_footprint[0]+1).T
+                """Add the recentered image back to the scan grid"""
+                if intensity_normalization > 0:
+                    this_frames_enderlein_image[
+                        nearest_grid_index[0]-subgrid_footprint[0]:
+                        nearest_grid_index[0]+subgrid_footprint[0]+1,
+                        nearest_grid_index[1]-subgrid_footprint[1]:
+                        nearest_grid_index[1]+subgrid_footprint[1]+1,
+                        ] += resampled_image
+                    this_frames_normalization[
+                        nearest_grid_index[0]-subgrid_footprint[0]:
+                        nearest_grid_index[0]+subgrid_footprint[0]+1,
+                        nearest_grid_index[1]-subgrid_footprint[1]:
+                        nearest_grid_index[1]+subgrid_footprint[1]+1,
+                        ] += 1
+                    if self.intermediate_data:
+                        self.x_scan_positions[
+                            z,
+                            nearest_grid_index[0]-subgrid_footprint[0]:
+                            nearest_grid_index[0]+subgrid_footprint[0]+1,
+                            nearest_grid_index[1]-subgrid_footprint[1]:
+                            nearest_grid_index[1]+subgrid_footprint[1]+1,
+                            ] += (nearest_grid_point[0] - lp[0] +
+                                  self.grid_step_x * numpy.arange(
+                                      -subgrid_footprint[0],
+                                      subgrid_footprint[0] + 1, 1
+                                      ).reshape(
+                                          (2*subgrid_footprint[0]+1, 1)))
+                        self.y_scan_positions[
+                            z,
+                            nearest_grid_index[0]-subgrid_footprint[0]:
+                            nearest_grid_index[0]+subgrid_footprint[0]+1,
+                            nearest_grid_index[1]-subgrid_footprint[1]:
+                            nearest_grid_index[1]+subgrid_footprint[1]+1,
+                            ] += (nearest_grid_point[1] - lp[1] +
+                                  self.grid_step_y * numpy.arange(
+                                      -subgrid_footprint[1],
+                                      subgrid_footprint[1] + 1, 1
+                                      ).reshape(
+                                          (1, 2*subgrid_footprint[1]+1)))
+                    if self.make_confocal_image: #FIXME!!!!!!!
+                        self.confocal_image[
+                            nearest_grid_index[0]-window_footprint:
+                            nearest_grid_index[0]+window_footprint+1,
+                            nearest_grid_index[1]-window_footprint:
+                            nearest_grid_index[1]+window_footprint+1
+                            ] += interpolation.shift(
+                                apertured_image,
+                                shift=(lp-nearest_grid_point))
+                if self.show_steps:
+                    pylab.clf()
+                    pylab.suptitle(
+                        "Spot %i, %i in frame %i\n"%(i, j, z) +
+                        "Centered at %0.2f, %0.2f\n"%(lp[0], lp[1]) + (
+                                "Nearest grid point: %i, %i"%(
+                                    nearest_grid_point[0],
+                                    nearest_grid_point[1])))
+                    pylab.subplot(1, 3, 1)
+                    pylab.imshow(spot_image, interpolation='nearest',
+                                 cmap=pylab.cm.gray)
+                    pylab.subplot(1, 3, 2)
+                    pylab.imshow(apertured_image, interpolation='nearest',
+                                 cmap=pylab.cm.gray)
+                    pylab.subplot(1, 3, 3)
+                    pylab.imshow(resampled_image, interpolation='nearest',
+                                 cmap=pylab.cm.gray)
+                    self.fig.show()
+                    self.fig.canvas.draw()
+                    response = raw_input(
+                        '\nHit enter to continue, q to quit:')
+                    if response in ('q', 'e', 'x'):
+                        print "Done showing steps..."
+                        self.show_steps = False
+        self.enderlein_image += this_frames_enderlein_image
+        self.enderlein_normalization += this_frames_normalization
+        if not self.normalize:
+            self.enderlein_normalization.fill(1)
+            this_frames_normalization.fill(1)
+        if self.intermediate_data:
+            self.cumulative_sum[z, :, :] = (
+                self.enderlein_image * 1. / self.enderlein_normalization)
+            self.cumulative_sum.flush()
+            self.processed_frames[
+                z, :, :] = this_frames_enderlein_image * 1. / (
+                    this_frames_normalization)
+            self.processed_frames.flush()
+        if self.show_slices:
+            pylab.clf()
+            pylab.imshow(
+                self.enderlein_image * 1.0 / self.enderlein_normalization,
+                cmap=pylab.cm.gray, interpolation='nearest')
+            self.fig.show()
+            self.fig.canvas.draw()
+            response=raw_input('Hit enter to continue...')
+        self.num_frames += 1
+        return None
+
+    def result(self, return_sums=False):
+        """The images built from every frame added so far"""
+        images = {}
+        rows = slice(self.grid_rows[0] - self.buffer_rows[0],
+                     self.grid_rows[1] - self.buffer_rows[0])
+        if return_sums: #Let the caller combine and normalize partial results
+            images['enderlein_image'] = self.enderlein_image[rows].copy()
+            images['enderlein_normalization'] = (
+                self.enderlein_normalization[rows].copy())
+        else:
+            images['enderlein_image'] = (
+                self.enderlein_image[rows] * 1.0 /
+                self.enderlein_normalization[rows])
+        if self.make_widefield_image:
+            images['widefield_image'] = interpolation.map_coordinates(
+                self.raw_frame_sum, self.widefield_coordinates,
+                output=self.dtype).reshape(self.widefield_shape[::-1]).T.copy()
+        if self.make_confocal_image:
+            images['confocal_image'] = self.confocal_image.copy()
+        return images
+
+    def save(self, data_filename):
+        """Save result() where enderlein_image_parallel() saves the
+        images of 'data_filename', with the same cache manifest, so it
+        loads them instead of reconstructing them again."""
+        if self.grid_rows != (0, self.new_grid_x.shape[0]):
+            raise UserWarning("Can't save one tile as a whole image")
+        artifact_names, sources, parameters, hashed_sources = (
+            enderlein_artifact(dict(self.input_arguments,
+                                    data_filename=data_filename)))
+        images = self.result()
+        basename = os.path.splitext(data_filename)[0]
+        images['enderlein_image'].tofile(basename + '_enderlein_image.raw')
+        if self.make_widefield_image:
+            images['widefield_image'].tofile(basename + '_widefield.raw')
+        if self.make_confocal_image:
+            images['confocal_image'].tofile(basename + '_confocal.raw')
+        artifact_cache.store(artifact_names, sources, parameters,
+                             hashed_sources=hashed_sources)
+        return images
+
+def load_enderlein_state(
+    data_filename, lake_filename, background_filename,
+    xPix, yPix, zPix, steps, preframes,
+    lattice_vectors, offset_vector, shift_vector,
+    new_grid_xrange, new_grid_yrange,
+    window_footprint=10,
+    scale_factor=0.5,
+    flat_fielding=True,
+    laser_intensity_drift_correction=False,
+    scan_uniformity_correction=True,
+    vectorized=True,
+    verbose=True,
+    display=False,
+    ):
+    """Everything enderlein_image_subprocess() needs besides the raw
+    frames: background, hot pixels, intensity drift, and the flat-field
+    and scan-uniformity calibration. Loading this is slow compared to
+    processing a handful of frames, so parallel workers load it once."""
     basename = os.path.splitext(data_filename)[0]
-    enderlein_image_name = basename + '_enderlein_image.raw'
     lake_basename = os.path.splitext(lake_filename)[0]
-    lake_intensities_name = lake_basename + '_spot_intensities.pkl'
     lake_avg_intensity_name = lake_basename + '_avg_intensity.pkl'
     signal_avg_intensity_name = basename + '_avg_intensity.pkl'
     background_basename = os.path.splitext(background_filename)[0]
     background_name = background_basename + '_background_image.raw'
     background_directory_name = os.path.dirname(background_name)
 
-    """Load auxiliary data"""
-    if flat_fielding:
-        intensities_vs_scan_position = cPickle.load(
-            open(lake_intensities_name, 'rb'))
+    state = {}
     if laser_intensity_drift_correction:
-        lake_avg_intensity = cPickle.load(
+        state['lake_avg_intensity'] = cPickle.load(
             open(lake_avg_intensity_name, 'rb'))
         try:
-            signal_avg_intensity = cPickle.load(
+            state['signal_avg_intensity'] = cPickle.load(
                 open(signal_avg_intensity_name, 'rb'))
         except IOError:
-            image_average_intensity = calculate_laser_intensity_drift(
+            state['signal_avg_intensity'] = calculate_laser_intensity_drift(
                 image_filename=data_filename, bg_filename=background_name,
                 output_filename=signal_avg_intensity_name,
                 xPix=xPix, yPix=yPix, zPix=zPix, preframes=preframes,
                 display=display)
     try:
-        background_frame = numpy.fromfile(
+        state['background_frame'] = numpy.fromfile(
             background_name).reshape(xPix, yPix).astype(float)
     except ValueError:
         print "\n\nWARNING: the data file:"
@@ -467,243 +1137,32 @@ def enderlein_image_subprocess(
         if skip_hot_pix != 'y':
             raise
     else:
-        hot_pixels = hot_pixels.reshape(2, len(hot_pixels)/2)
-
-    """Create data containers"""
-    if show_steps or show_slices: fig = pylab.figure()
-    if start_frame is None:
-        start_frame = 0
-    if end_frame is None:
-        end_frame = steps - 1
-    new_grid_x = numpy.linspace(*new_grid_xrange)
-    new_grid_y = numpy.linspace(*new_grid_yrange)
-    enderlein_image = numpy.zeros(
-        (new_grid_x.shape[0], new_grid_y.shape[0]), dtype=numpy.float)
-    enderlein_normalization = numpy.zeros_like(enderlein_image)
-    enderlein_normalization.fill(1e-12)
-    this_frames_enderlein_image = numpy.zeros_like(enderlein_image)
-    this_frames_normalization = numpy.zeros_like(enderlein_image)
-    if intermediate_data:
-        cumulative_sum = numpy.memmap(
-            basename + '_cumsum.raw', dtype=float, mode='w+',
-            shape=(steps,) + enderlein_image.shape)
-        processed_frames = numpy.memmap(
-            basename + '_frames.raw', dtype=float, mode='w+',
-            shape=(steps,) + enderlein_image.shape)
-        x_scan_positions = numpy.memmap(
-            basename + '_frames_x.raw', dtype=float, mode='w+',
-            shape=(steps,) + enderlein_image.shape)
-        y_scan_positions = numpy.memmap(
-            basename + '_frames_y.raw', dtype=float, mode='w+',
-            shape=(steps,) + enderlein_image.shape)
-    if make_widefield_image:
-        widefield_image = numpy.zeros_like(enderlein_image)
-        widefield_coordinates = numpy.meshgrid(new_grid_x, new_grid_y)
-        widefield_coordinates = (
-            widefield_coordinates[0].reshape(
-                new_grid_x.shape[0] * new_grid_y.shape[0]),
-            widefield_coordinates[1].reshape(
-                new_grid_x.shape[0] * new_grid_y.shape[0]))
-    if make_confocal_image:
-        confocal_image = numpy.zeros_like(enderlein_image)
-
-    """Precalculate a few useful quantities"""
-    aperture = gaussian(2*window_footprint+1, std=aperture_size
-                        ).reshape(2*window_footprint+1, 1)
-    aperture = aperture * aperture.T
-    grid_step_x = new_grid_x[1] - new_grid_x[0]
-    grid_step_y = new_grid_y[1] - new_grid_y[0]
-    subgrid_footprint = numpy.floor(
-        (-1 + window_footprint * scale_factor / grid_step_x,
-         -1 + window_footprint * scale_factor / grid_step_y))
-    subgrid = ( #Add (1/scale_factor)*(r_0 - r_M) to this to get s_desired
-        window_footprint + (1.0 / scale_factor) * grid_step_x * numpy.arange(
-            -subgrid_footprint[0], subgrid_footprint[0] + 1),
-        window_footprint + (1.0 / scale_factor) * grid_step_y * numpy.arange(
-            -subgrid_footprint[1], subgrid_footprint[1] + 1))
-    subgrid_points = ((2*subgrid_footprint[0] + 1) *
-                      (2*subgrid_footprint[1] + 1))
-    if scan_uniformity_correction:
-        vertex_weights = calculate_scan_uniformity_correction(
-            xPix=xPix, yPix=yPix, zPix=zPix,
+        hot_pixels = Hot_Pixel_Corrector(
+            hot_pixels.reshape(-1, 2), image_shape=(xPix, yPix))
+    state['hot_pixels'] = hot_pixels
+    if vectorized:
+        state['reassignment_table'] = get_reassignment_table(
+            lake_filename=lake_filename,
+            xPix=xPix, yPix=yPix, zPix=zPix, steps=steps,
             lattice_vectors=lattice_vectors,
-            shift_vector=shift_vector, offset_vector=offset_vector,
-            verbose=verbose, display=display)
-
-    """Now, time to chug through some data."""
-    for z in range(start_frame, end_frame+1):
-        im = load_image_slice(
-            filename=data_filename, xPix=xPix, yPix=yPix,
-            preframes=preframes, which_slice=z).astype(float)
-        if hot_pixels is not None:
-            im = remove_hot_pixels(im, hot_pixels)
-        this_frames_enderlein_image.fill(0.)
-        this_frames_normalization.fill(1e-12)
-        if verbose:
-            sys.stdout.write("\rProcessing raw data image %i"%(z))
-            sys.stdout.flush()
-        if make_widefield_image:
-            widefield_image += interpolation.map_coordinates(
-                im, widefield_coordinates
-                ).reshape(new_grid_y.shape[0], new_grid_x.shape[0]).T
-        lattice_points, i_list, j_list = (
-            generate_lattice(
-                image_shape=(xPix, yPix),
-                lattice_vectors=lattice_vectors,
-                center_pix=offset_vector + get_shift(
-                    shift_vector, z),
-                edge_buffer=window_footprint+1,
-                return_i_j=True))
-        if laser_intensity_drift_correction:
-            signal_avg_intensity_normalization = signal_avg_intensity[z]
-            if flat_fielding:
-                lake_avg_intensity_normalization = lake_avg_intensity[z]
-            else:
-                lake_avg_intensity_normalization = 1
-        else:
-            signal_avg_intensity_normalization = 1
-            lake_avg_intensity_normalization = 1
+            offset_vector=offset_vector, shift_vector=shift_vector,
+            new_grid_xrange=new_grid_xrange, new_grid_yrange=new_grid_yrange,
+            window_footprint=window_footprint, scale_factor=scale_factor,
+            flat_fielding=flat_fielding,
+            scan_uniformity_correction=scan_uniformity_correction,
+            verbose=verbose)
+    else:
+        if flat_fielding:
+            state['intensities_vs_scan_position'] = (
+                get_spot_intensity_table(lake_filename))
         if scan_uniformity_correction:
-            uniformity_normalization = vertex_weights[z]
-        else:
-            uniformity_normalization = 1.
-        for m, lp in enumerate(lattice_points):
-            i, j = int(i_list[m]), int(j_list[m])
-            """Take an image centered on each illumination point"""
-            spot_image = get_centered_subimage(
-                center_point=lp, window_size=window_footprint,
-                image=im, background=background_frame)
-            """Aperture the image with a synthetic pinhole"""
-            if flat_fielding:
-                intensity_normalization = 1.0 / (
-                    intensities_vs_scan_position.get(
-                        (i, j), {}).get(z, numpy.inf))
-            else:
-                intensity_normalization = 1.0
-            if (intensity_normalization == 0 or
-                spot_image.shape != (2*window_footprint+1,
-                                     2*window_footprint+1)):
-                continue #Skip to the next spot
-            apertured_image = (aperture *
-                               spot_image *
-                               intensity_normalization *
-                               uniformity_normalization *
-                               signal_avg_intensity_normalization *
-                               lake_avg_intensity_normalization)
-            nearest_grid_index = numpy.round(
-                    (lp - (new_grid_x[0], new_grid_y[0])) /
-                    (grid_step_x, grid_step_y))
-            nearest_grid_point = (
-                (new_grid_x[0], new_grid_y[0]) +
-                (grid_step_x, grid_step_y) * nearest_grid_index)
-            new_coordinates = numpy.meshgrid(
-                subgrid[0] + (1.0 / scale_factor) * (
-                    nearest_grid_point[0] - lp[0]),
-                subgrid[1] + (1.0 / scale_factor) * (
-                    nearest_grid_point[1] - lp[1]))
-            resampled_image = interpolation.map_coordinates(
-                apertured_image,
-                (new_coordinates[0].reshape(subgrid_points),
-                 new_coordinates[1].reshape(subgrid_points))
-                ).reshape(2*subgrid_footprint[1]+1,
-                          2*subgrid_footprint[0]+1).T
-            """Add the recentered image back to the scan grid"""
-            if intensity_normalization > 0:
-                this_frames_enderlein_image[
-                    nearest_grid_index[0]-subgrid_footprint[0]:
-                    nearest_grid_index[0]+subgrid_footprint[0]+1,
-                    nearest_grid_index[1]-subgrid_footprint[1]:
-                    nearest_grid_index[1]+subgrid_footprint[1]+1,
-                    ] += resampled_image
-                this_frames_normalization[
-                    nearest_grid_index[0]-subgrid_footprint[0]:
-                    nearest_grid_index[0]+subgrid_footprint[0]+1,
-                    nearest_grid_index[1]-subgrid_footprint[1]:
-                    nearest_grid_index[1]+subgrid_footprint[1]+1,
-                    ] += 1
-                if intermediate_data:
-                    x_scan_positions[
-                        z,
-                        nearest_grid_index[0]-subgrid_footprint[0]:
-                        nearest_grid_index[0]+subgrid_footprint[0]+1,
-                        nearest_grid_index[1]-subgrid_footprint[1]:
-                        nearest_grid_index[1]+subgrid_footprint[1]+1,
-                        ] += (nearest_grid_point[0] - lp[0] +
-                              grid_step_x * numpy.arange(
-                                  -subgrid_footprint[0],
-                                  subgrid_footprint[0] + 1, 1
-                                  ).reshape((2*subgrid_footprint[0]+1, 1)))
-                    y_scan_positions[
-                        z,
-                        nearest_grid_index[0]-subgrid_footprint[0]:
-                        nearest_grid_index[0]+subgrid_footprint[0]+1,
-                        nearest_grid_index[1]-subgrid_footprint[1]:
-                        nearest_grid_index[1]+subgrid_footprint[1]+1,
-                        ] += (nearest_grid_point[1] - lp[1] +
-                              grid_step_y * numpy.arange(
-                                  -subgrid_footprint[1],
-                                  subgrid_footprint[1] + 1, 1
-                                  ).reshape((1, 2*subgrid_footprint[1]+1)))
-                if make_confocal_image: #FIXME!!!!!!!
-                    confocal_image[
-                        nearest_grid_index[0]-window_footprint:
-                        nearest_grid_index[0]+window_footprint+1,
-                        nearest_grid_index[1]-window_footprint:
-                        nearest_grid_index[1]+window_footprint+1
-                        ] += interpolation.shift(
-                            apertured_image, shift=(lp-nearest_grid_point))
-            if show_steps:
-                pylab.clf()
-                pylab.suptitle(
-                    "Spot %i, %i in frame %i\nCentered at %0.2f, %0.2f\n"%(
-                        i, j, z, lp[0], lp[1]) + (
-                            "Nearest grid point: %i, %i"%(
-                                nearest_grid_point[0],
-                                nearest_grid_point[1])))
-                pylab.subplot(1, 3, 1)
-                pylab.imshow(
-                    spot_image, interpolation='nearest', cmap=pylab.cm.gray)
-                pylab.subplot(1, 3, 2)
-                pylab.imshow(apertured_image, interpolation='nearest',
-                             cmap=pylab.cm.gray)
-                pylab.subplot(1, 3, 3)
-                pylab.imshow(resampled_image, interpolation='nearest',
-                             cmap=pylab.cm.gray)
-                fig.show()
-                fig.canvas.draw()
-                response = raw_input('\nHit enter to continue, q to quit:')
-                if response == 'q' or response == 'e' or response == 'x':
-                    print "Done showing steps..."
-                    show_steps = False
-        enderlein_image += this_frames_enderlein_image
-        enderlein_normalization += this_frames_normalization
-        if not normalize:
-            enderlein_normalization.fill(1)
-            this_frames_normalization.fill(1)
-        if intermediate_data:
-            cumulative_sum[z, :, :] = (
-                enderlein_image * 1. / enderlein_normalization)
-            cumulative_sum.flush()
-            processed_frames[
-                z, :, :] = this_frames_enderlein_image * 1. / (
-                    this_frames_normalization)
-            processed_frames.flush()
-        if show_slices:
-            pylab.clf()
-            pylab.imshow(enderlein_image * 1.0 / enderlein_normalization,
-                         cmap=pylab.cm.gray, interpolation='nearest')
-            fig.show()
-            fig.canvas.draw()
-            response=raw_input('Hit enter to continue...')
-
-    images = {}
-    images['enderlein_image'] = (
-        enderlein_image * 1.0 / enderlein_normalization)
-    if make_widefield_image:
-        images['widefield_image'] = widefield_image
-    if make_confocal_image:
-        images['confocal_image'] = confocal_image
-    return images
+            state['vertex_weights'] = calculate_scan_uniformity_correction(
+                xPix=xPix, yPix=yPix, zPix=zPix,
+                lattice_vectors=lattice_vectors,
+                shift_vector=shift_vector, offset_vector=offset_vector,
+                verbose=verbose, display=display,
+                cache_basename=lake_basename)
+    return state
 
 ##def load_image_data(filename, xPix=512, yPix=512, zPix=201):
 ##    """Load the 16-bit raw data from the MSIM"""
@@ -713,113 +1172,281 @@ def enderlein_image_subprocess(
 
 def load_image_data(filename, xPix=512, yPix=512, zPix=201, preframes=0):
     """Load the 16-bit raw data from the MSIM"""
-    if os.path.splitext(filename)[1] in ('.tif', '.tiff'):
-        """
-        Ignore the dimension parameters, and use the TIF metadata.
-        """
-        info = simple_tif.get_tif_info(filename)
-        xPix = info['length']
-        yPix = info['width']
-        zPix = info['num_slices']
-        offset = info['offset']
-        if info['dtype'] != numpy.uint16:
-            raise UserWarning("MSIM data must be 16-bit unsigned integers.")
-    else:
-        offset = 0
-    bytes_per_frame = 2*xPix*yPix
-    offset += preframes * bytes_per_frame
-    return numpy.memmap(#FIRST dimension is image number
-        filename, dtype=numpy.uint16, mode='r', offset=offset,
-        shape=(zPix, xPix, yPix))
+    reader = get_image_stack_reader(
+        filename, xPix=xPix, yPix=yPix, preframes=preframes)
+    if reader.tif:
+        return reader.data #Ignore zPix, and use the TIF metadata.
+    if zPix > reader.zPix:
+        print "\n\nWARNING: the data file:"
+        print filename
+        print "may not be the size it was expected to be.\n\n"
+        raise UserWarning("Expected %i frames, found %i"%(zPix, reader.zPix))
+    return reader.data[:zPix, :, :] #FIRST dimension is image number
 
 def load_image_slice(filename, xPix, yPix, preframes=0, which_slice=0):
-    if os.path.splitext(filename)[1] in ('.tif', '.tiff'):
-        """
-        Ignore the dimension parameters, and use the TIF metadata.
-        """
-        info = simple_tif.get_tif_info(filename)
-        xPix = info['width']
-        yPix = info['length']
-        offset = info['offset']
-        if info['dtype'] != numpy.uint16:
-            raise UserWarning("MSIM data must be 16-bit unsigned integers.")
-    else:
-        offset = 0
     """Load a frame of the 16-bit raw data from the MSIM"""
-    bytes_per_pixel = 2
-    data_file = open(filename, 'rb')
-    data_file.seek(
-        offset + (which_slice + preframes) * xPix*yPix*bytes_per_pixel)
-    try:
-        return numpy.fromfile(
-            data_file, dtype=numpy.uint16, count=xPix*yPix
-            ).reshape(xPix, yPix)
-    except ValueError:
-        print "\n\nWARNING: the data file:"
-        print data_file
-        print "may not be the size it was expected to be.\n\n"
-        raise
+    return get_image_stack_reader(
+        filename, xPix=xPix, yPix=yPix, preframes=preframes
+        ).get_frame(which_slice)
+
+"""
+Open readers keep their files open (and, on Windows, undeletable), so
+we only keep the most recently used few.
+"""
+max_image_stack_readers = 4
+_image_stack_readers = collections.OrderedDict() #Least recently used first
+
+def get_image_stack_reader(filename, xPix, yPix, preframes=0):
+    """Reuse the same Image_Stack_Reader for every frame of a file,
+    unless the file changed since we opened it."""
+    stat = os.stat(filename)
+    key = (os.path.abspath(filename), xPix, yPix, preframes)
+    reader = _image_stack_readers.pop(key, None)
+    if reader is not None and reader.file_id != (stat.st_size, stat.st_mtime):
+        reader.close()
+        reader = None
+    if reader is None:
+        reader = Image_Stack_Reader(
+            filename, xPix=xPix, yPix=yPix, preframes=preframes)
+    _image_stack_readers[key] = reader
+    while len(_image_stack_readers) > max_image_stack_readers:
+        _image_stack_readers.popitem(last=False)[1].close()
+    return reader
+
+def close_image_stack_readers(filename=None):
+    """Close the readers get_image_stack_reader() kept open for
+    'filename', or for every file if it's None. Call this when you're
+    done with a file, especially before deleting or overwriting it."""
+    for key in _image_stack_readers.keys():
+        if filename is None or key[0] == os.path.abspath(filename):
+            _image_stack_readers.pop(key).close()
+    return None
+
+class Image_Stack_Reader:
+    """
+    Opens a raw or simple_tif stack of 16-bit MSIM data once, and hands
+    out frames as memmap views, without copying or reparsing headers.
 
-def load_fft_slice(fft_data_folder, xPix, yPix, which_slice=0):
-    bytes_per_pixel = 16
-    filename = os.path.join(fft_data_folder, '%06i.dat'%(which_slice))
-    data_file = open(filename, 'rb')
-    return numpy.memmap(data_file, dtype=numpy.complex128, mode='r'
-                        ).reshape(xPix, yPix)
+    If 'prefetch' is positive, every get_frame() call asks a background
+    thread to read the next 'prefetch' frames from disk, so they're in
+    memory by the time we want them.
+    """
+    def __init__(self, filename, xPix=512, yPix=512, preframes=0,
+                 prefetch=0):
+        self.filename = filename
+        stat = os.stat(filename)
+        self.file_id = (stat.st_size, stat.st_mtime)
+        self.tif = os.path.splitext(filename)[1] in ('.tif', '.tiff')
+        if self.tif:
+            """
+            Ignore the dimension parameters, and use the TIF metadata.
+            """
+            info = simple_tif.get_tif_info(filename)
+            xPix = info['length']
+            yPix = info['width']
+            zPix = info['num_slices'] - preframes
+            offset = info['offset']
+            if info['dtype'] != numpy.uint16:
+                raise UserWarning(
+                    "MSIM data must be 16-bit unsigned integers.")
+        else:
+            offset = 0
+            zPix = stat.st_size // (2*xPix*yPix) - preframes
+        if zPix < 1:
+            print "\n\nWARNING: the data file:"
+            print filename
+            print "may not be the size it was expected to be.\n\n"
+            raise UserWarning("No frames found in " + filename)
+        self.xPix, self.yPix, self.zPix = xPix, yPix, zPix
+        self.data = numpy.memmap(#FIRST dimension is image number
+            filename, dtype=numpy.uint16, mode='r',
+            offset=offset + preframes * 2*xPix*yPix,
+            shape=(zPix, xPix, yPix))
+        self.prefetch = prefetch
+        if prefetch > 0:
+            self._prefetched_up_to = -1
+            self._prefetch_queue = Queue.Queue()
+            self._prefetch_thread = threading.Thread(
+                target=self._prefetch_frames, name='Prefetch')
+            self._prefetch_thread.daemon = True
+            self._prefetch_thread.start()
+        return None
 
-def get_fft_abs(filename, image_data, show_steps=False):
+    def __len__(self):
+        return self.zPix
+
+    def get_frame(self, which_slice):
+        """A read-only view of one frame, straight out of the file"""
+        if self.prefetch > 0:
+            for z in range(max(which_slice, self._prefetched_up_to) + 1,
+                           min(which_slice + self.prefetch + 1, self.zPix)):
+                self._prefetch_queue.put(z)
+                self._prefetched_up_to = z
+        return self.data[which_slice, :, :]
+
+    def _prefetch_frames(self):
+        while True:
+            z = self._prefetch_queue.get()
+            if z is None:
+                break
+            """Touching one pixel per (4 kB) page pulls it from disk"""
+            self.data[z, :, :].reshape(-1)[::2048].max()
+        return None
+
+    def close(self):
+        """Stop prefetching, and let go of the memmap. Frames we handed
+        out are views of it, so the file only really closes once
+        they're gone too; closing the mmap under them would crash."""
+        if self.prefetch > 0:
+            self._prefetch_queue.put(None)
+            self._prefetch_thread.join()
+            self.prefetch = 0
+        self.data = None
+        return None
+
+def load_fft_slice(fft_data_name, xPix, yPix, which_slice=0):
+    """The full, fftshifted 2D FFT of one windowed slice, rebuilt from
+    the half-spectrum get_fft_abs() stores on disk"""
+    fft_data = numpy.load(fft_data_name, mmap_mode='r')
+    return numpy.fft.fftshift(expand_rfft(
+        fft_data[which_slice, :, :].astype(numpy.complex128), yPix))
+
+def load_fft_pixels(fft_data_name, xPix, yPix, pixels):
+    """The time series of a handful of Fourier pixels, without reading
+    the rest of the FFT data from disk. Pixel coordinates are relative
+    to the DC term, like the ones find_spikes() returns."""
+    fft_data = numpy.load(fft_data_name, mmap_mode='r')
+    values = []
+    for p in pixels:
+        i, j = p[0] % xPix, p[1] % yPix
+        if j < fft_data.shape[2]:
+            values.append(fft_data[:, i, j].astype(numpy.complex128))
+        else: #Only half the spectrum is stored; use conjugate symmetry
+            values.append(numpy.conj(fft_data[:, -i % xPix, -j % yPix]
+                                     ).astype(numpy.complex128))
+    return values
+
+def get_harmonic_values(image_data, pixels, block_size=16):
+    """The same Fourier coefficients load_fft_pixels() reads from disk,
+    computed straight from the image data instead. Each coefficient is
+    a dot product of the Hann-windowed slice with a complex
+    exponential, and both are separable, so this costs two small matrix
+    products per block of slices, and scales with the number of pixels
+    instead of the size of the FFT."""
+    num_slices, xPix, yPix = image_data.shape
+    pixels = numpy.array(pixels).reshape(-1, 2)
+    x_exponentials = hann(xPix).reshape(1, xPix) * numpy.exp(
+        -2j * numpy.pi * pixels[:, 0:1] * numpy.arange(xPix) / xPix)
+    y_exponentials = hann(yPix).reshape(1, yPix) * numpy.exp(
+        -2j * numpy.pi * pixels[:, 1:2] * numpy.arange(yPix) / yPix)
+    values = numpy.zeros((num_slices, pixels.shape[0]),
+                         dtype=numpy.complex128)
+    for z in range(0, num_slices, block_size):
+        block = numpy.asarray(
+            image_data[z:z + block_size, :, :], dtype=float)
+        """Real matrix products are much faster than complex ones"""
+        y_transform = (
+            numpy.dot(block, y_exponentials.real.T) +
+            1j * numpy.dot(block, y_exponentials.imag.T)) #Slice, x, pixel
+        values[z:z + block.shape[0], :] = (
+            y_transform * x_exponentials.T.reshape(1, xPix, -1)).sum(axis=1)
+    return list(values.T)
+
+def expand_rfft(half_spectrum, n):
+    """Rebuild the full (unshifted) 2D FFT of a real array from the
+    output of numpy.fft.rfft2, using conjugate symmetry. 'n' is the
+    length of the last axis of the original array. Works on stacks of
+    2D spectra, and on magnitudes too."""
+    h = half_spectrum.shape[-1]
+    m = half_spectrum.shape[-2]
+    full = numpy.empty(half_spectrum.shape[:-1] + (n,),
+                       dtype=half_spectrum.dtype)
+    full[..., :h] = half_spectrum
+    mirrored_rows = (-numpy.arange(m)) % m
+    mirrored_columns = (-numpy.arange(h, n)) % n
+    full[..., h:] = numpy.conj(
+        half_spectrum[..., mirrored_rows, :][..., mirrored_columns])
+    return full
+
+def get_fft_abs(filename, image_data, show_steps=False, block_size=16,
+                store_fft_data=True, preframes=0):
     basename = os.path.splitext(filename)[0]
     fft_abs_name = basename + '_fft_abs.npy'
     fft_avg_name = basename + '_fft_avg.npy'
-    fft_data_folder = basename + '_fft_data'
-    """FFT data is stored as a sequence of raw binary files, one per
-    2D z-slice. The files are named 000000.dat, 000001.dat, etc."""
+    fft_data_name = basename + '_fft_data.npy'
+    """FFT data is stored as one complex64 .npy stack of half-spectra,
+    straight out of numpy.fft.rfft2 (unshifted). The image data is
+    real, so the other half is redundant. Read it back with
+    load_fft_slice() or load_fft_pixels(). If you only need the
+    harmonic pixels, skip storing it ('store_fft_data=False') and use
+    get_harmonic_values() instead; then 'fft_data_name' is None."""
+    if not store_fft_data:
+        fft_data_name = None
+    artifact_names = [fft_abs_name, fft_avg_name]
+    if fft_data_name is not None:
+        artifact_names.append(fft_data_name)
+    """'preframes' only matters for recognizing a cached FFT; the
+    frames are already skipped in 'image_data'"""
+    fft_parameters = ('fft_abs', image_data.shape, preframes)
     
-    if (os.path.exists(fft_abs_name) and
-        os.path.exists(fft_avg_name) and
-        os.path.exists(fft_data_folder)):
+    if artifact_cache.is_cached(artifact_names, [filename], fft_parameters):
         print "Loading", os.path.split(fft_abs_name)[1]
         fft_abs = numpy.load(fft_abs_name)
         print "Loading", os.path.split(fft_avg_name)[1]
         fft_avg = numpy.load(fft_avg_name)
     else:
         print "Generating fft_abs, fft_avg and fft_data..."
-        os.mkdir(fft_data_folder)
-        fft_abs = numpy.zeros(image_data.shape[1:])
-        fft_avg = numpy.zeros(image_data.shape[1:], dtype=numpy.complex128)
-        window = (hann(image_data.shape[1]).reshape(image_data.shape[1], 1) *
-                  hann(image_data.shape[2]).reshape(1, image_data.shape[2]))
+        num_slices, xPix, yPix = image_data.shape
+        if fft_data_name is not None:
+            fft_data = numpy.lib.format.open_memmap(
+                fft_data_name, mode='w+', dtype=numpy.complex64,
+                shape=(num_slices, xPix, yPix//2 + 1))
+        half_fft_abs = numpy.zeros((xPix, yPix//2 + 1))
+        half_fft_sum = numpy.zeros((xPix, yPix//2 + 1), dtype=numpy.complex128)
+        window = (hann(xPix).reshape(xPix, 1) *
+                  hann(yPix).reshape(1, yPix))
         if show_steps: fig = pylab.figure()
-        for z in range(image_data.shape[0]):
-            fft_data = numpy.fft.fftshift(#Stored shifted!
-                numpy.fft.fftn(window * image_data[z, :, :], axes=(0, 1)))
-            fft_data.tofile(os.path.join(fft_data_folder, '%06i.dat'%(z)))
-            fft_abs += numpy.abs(fft_data)
+        """Transform a block of slices at a time"""
+        for z in range(0, num_slices, block_size):
+            block = numpy.fft.rfft2(
+                window * image_data[z:z + block_size, :, :], axes=(1, 2))
+            if fft_data_name is not None:
+                fft_data[z:z + block.shape[0], :, :] = block
+            half_fft_abs += numpy.abs(block).sum(axis=0)
+            half_fft_sum += block.sum(axis=0)
             if show_steps:
-                pylab.clf()
-                pylab.subplot(1, 3, 1)
-                pylab.title('Windowed slice %i'%(z))
-                pylab.imshow(window * numpy.array(image_data[z, :, :]),
-                             cmap=pylab.cm.gray, interpolation='nearest')
-                pylab.subplot(1, 3, 2)
-                pylab.title('FFT of slice %i'%(z))
-                pylab.imshow(numpy.log(1 + numpy.abs(fft_data)),
-                             cmap=pylab.cm.gray, interpolation='nearest')
-                pylab.subplot(1, 3, 3)
-                pylab.title("Cumulative sum of FFT absolute values")
-                pylab.imshow(numpy.log(1 + fft_abs),
-                             cmap=pylab.cm.gray, interpolation='nearest')
-                fig.show()
-                fig.canvas.draw()
-                raw_input("Hit enter to continue...")
-            fft_avg += fft_data
-            sys.stdout.write('\rFourier transforming slice %i'%(z+1))
+                for b in range(block.shape[0]):
+                    pylab.clf()
+                    pylab.subplot(1, 3, 1)
+                    pylab.title('Windowed slice %i'%(z + b))
+                    pylab.imshow(window * numpy.array(image_data[z + b, :, :]),
+                                 cmap=pylab.cm.gray, interpolation='nearest')
+                    pylab.subplot(1, 3, 2)
+                    pylab.title('FFT of slice %i'%(z + b))
+                    pylab.imshow(numpy.log(1 + numpy.abs(numpy.fft.fftshift(
+                        expand_rfft(block[b, :, :], yPix)))),
+                                 cmap=pylab.cm.gray, interpolation='nearest')
+                    pylab.subplot(1, 3, 3)
+                    pylab.title("Cumulative sum of FFT absolute values")
+                    pylab.imshow(numpy.log(1 + numpy.fft.fftshift(
+                        expand_rfft(half_fft_abs, yPix))),
+                                 cmap=pylab.cm.gray, interpolation='nearest')
+                    fig.show()
+                    fig.canvas.draw()
+                    raw_input("Hit enter to continue...")
+            sys.stdout.write(
+                '\rFourier transforming slice %i'%(z + block.shape[0]))
             sys.stdout.flush()
-        fft_avg = numpy.abs(fft_avg)
+        if fft_data_name is not None:
+            fft_data.flush()
+            del fft_data
+        fft_abs = numpy.fft.fftshift(expand_rfft(half_fft_abs, yPix))
+        fft_avg = numpy.abs(numpy.fft.fftshift(expand_rfft(half_fft_sum, yPix)))
         numpy.save(fft_abs_name, fft_abs)
         numpy.save(fft_avg_name, fft_avg)
+        artifact_cache.store(artifact_names, [filename], fft_parameters)
         print
-    return (fft_data_folder, fft_abs, fft_avg)
+    return (fft_data_name, fft_abs, fft_avg)
 
 def spike_filter(fft_abs, display=False):
     f = gaussian_filter(numpy.log(1 + fft_abs), sigma=0.5)
@@ -868,11 +1495,19 @@ def spike_filter(fft_abs, display=False):
     return f
 
 def find_spikes(fft_abs, filtered_fft_abs, extent=15, num_spikes=300,
-                display=True, animate=False):
-    """Finds spikes in the sum of the 2D ffts of an image stack"""
+                display=True, animate=False, method='nms', subpixel=False):
+    """Finds spikes in the sum of the 2D ffts of an image stack.
+
+    method='greedy' repeatedly takes the brightest pixel and zeroes the
+    box around it. method='nms' finds the same spikes with a few passes
+    of a maximum filter. 'subpixel' refines each spike with a parabolic
+    fit, so later steps start from better candidates."""
     center_pix = numpy.array(fft_abs.shape)//2
     log_fft_abs = numpy.log(1 + fft_abs)
     filtered_fft_abs = numpy.array(filtered_fft_abs)
+    if animate:
+        method = 'greedy' #Animation shows the boxes getting zeroed
+    assert method in ('nms', 'greedy')
 
     if display:
         image_extent=[-0.5 - center_pix[1],
@@ -890,6 +1525,22 @@ def find_spikes(fft_abs, filtered_fft_abs, extent=15, num_spikes=300,
         pylab.title('Filtered average Fourier magnitude')
         fig.show()
 
+    if method == 'nms':
+        coords = find_spikes_nms(filtered_fft_abs, extent, num_spikes)
+    else:
+        coords = find_spikes_greedy(
+            filtered_fft_abs, extent, num_spikes, animate, center_pix)
+    if subpixel:
+        coords = refine_spikes(numpy.array(filtered_fft_abs), coords)
+
+    coords = [c - center_pix for c in coords]
+    coords = sorted(coords, key=lambda x: x[0]**2 + x[1]**2)
+
+    return coords #Lattice k-vectors, sorted by vector magnitude
+
+def find_spikes_greedy(filtered_fft_abs, extent, num_spikes, animate,
+                       center_pix):
+    filtered_fft_abs = numpy.array(filtered_fft_abs)
     coords = []
     if animate:
         fig = pylab.figure()
@@ -917,11 +1568,67 @@ def find_spikes(fft_abs, filtered_fft_abs, extent=15, num_spikes=300,
             fig.canvas.draw()
             if i == 0:
                 raw_input('.')
-
-    coords = [c - center_pix for c in coords]
-    coords = sorted(coords, key=lambda x: x[0]**2 + x[1]**2)
-
-    return coords #Lattice k-vectors, sorted by vector magnitude
+    return coords
+
+def find_spikes_nms(filtered_fft_abs, extent, num_spikes):
+    """Non-maximum suppression version of find_spikes_greedy(), which
+    gives the same spikes in a few passes instead of one full-image
+    argmax per spike.
+
+    The greedy search zeroes rows and columns c-extent to c+extent-1
+    around each spike 'c'. A remaining pixel that's the brightest
+    remaining pixel from c-extent to c+extent can't be zeroed before
+    it's picked, and can only zero dimmer pixels, so we pick all of
+    those at once, suppress the boxes around them, and repeat. Only
+    positive pixels count: the filtered FFT has zero mean, and once the
+    positive spikes run out the greedy search starts picking its own
+    zeroed boxes."""
+    remaining = numpy.where(filtered_fft_abs > 0, filtered_fft_abs, -numpy.inf)
+    values, indices = [], []
+    while True:
+        local_max = remaining >= maximum_filter(
+            remaining, size=2*extent+1, mode='constant', cval=-numpy.inf)
+        candidates = numpy.flatnonzero(local_max & (remaining > -numpy.inf))
+        if len(candidates) == 0:
+            break
+        """Brightest first; ties go to the first pixel, like argmax"""
+        candidates = candidates[numpy.argsort(
+            -remaining.ravel()[candidates], kind='mergesort')]
+        for flat_index in candidates:
+            c = numpy.unravel_index(flat_index, remaining.shape)
+            if remaining[c] == -numpy.inf:
+                continue #A tie, suppressed earlier this pass
+            values.append(remaining[c])
+            indices.append(flat_index)
+            remaining[max(c[0]-extent, 0):c[0]+extent,
+                      max(c[1]-extent, 0):c[1]+extent] = -numpy.inf
+        if (len(values) >= num_spikes and
+            remaining.max() < sorted(values)[-num_spikes]):
+            break #Anything we'd find now is dimmer than what we have
+    order = numpy.lexsort((indices, -numpy.array(values)))[:num_spikes]
+    return [numpy.array(numpy.unravel_index(indices[i], remaining.shape))
+            for i in order]
+
+def refine_spikes(filtered_fft_abs, coords):
+    """Parabolic fits through each spike and its neighbors, along each
+    axis, like simple_max_finder()"""
+    refined = []
+    for pixel in coords:
+        c = numpy.array(pixel, dtype=float)
+        for axis in range(2):
+            if not 0 < pixel[axis] < filtered_fft_abs.shape[axis] - 1:
+                continue
+            neighbors = []
+            for offset in (-1, 0, 1):
+                p = numpy.array(pixel, dtype=int)
+                p[axis] += offset
+                neighbors.append(filtered_fft_abs[p[0], p[1]])
+            curvature = neighbors[0] - 2*neighbors[1] + neighbors[2]
+            if curvature < 0:
+                c[axis] += numpy.clip(
+                    0.5 * (neighbors[0] - neighbors[2]) / curvature, -1, 1)
+        refined.append(c)
+    return refined
 
 def get_basis_vectors(
     fft_abs, coords, extent=15, tolerance=3., num_harmonics=3, verbose=False):
@@ -1049,11 +1756,11 @@ def get_precise_basis(coords, basis_vectors, fft_abs, tolerance, verbose=False):
             for c in coords:
                 dif = numpy.sqrt(((lat - c)**2).sum())
                 if dif < tolerance:
-                    p = c + center_pix
+                    p = numpy.round(c).astype(int) + center_pix
                     correction = simple_max_finder(
                         fft_abs[p[0] - 1:p[0] + 2,
                                 p[1] - 1:p[1] + 2], show_plots=False)
-                    true_max = c + correction
+                    true_max = p - center_pix + correction
                     if abs(correction).max() > 1:
                         if verbose:
                             print "Correction is too large. Skipping."
@@ -1095,20 +1802,19 @@ def combinations_with_replacement(iterable, r):
 
 def get_offset_vector(
     image, direct_lattice_vectors, prefilter='median',
-    verbose=True, display=True, show_interpolation=True):
+    verbose=True, display=True, show_interpolation=True,
+    lattice_kernel=None):
+    """'lattice_kernel' is from get_lattice_kernel(), if you've already
+    got one for this image shape"""
     if prefilter == 'median':
         image = median_filter(image, size=3)
     if verbose: print "\nCalculating offset vector..."
-    ws = 2 + int(max(
-        [abs(v).max() for v in direct_lattice_vectors]))
+    if lattice_kernel is None:
+        lattice_kernel = get_lattice_kernel(
+            image.shape, direct_lattice_vectors)
+    ws = lattice_kernel['window_size']
     if verbose: print "Window size:", ws
-    window = numpy.zeros([2*ws + 1]*2, dtype=numpy.float)
-    lattice_points = generate_lattice(
-        image.shape, direct_lattice_vectors, edge_buffer=2+ws)
-    im = image.astype(float)
-    for lp in lattice_points:
-        window += get_centered_subimage(
-            center_point=lp, window_size=ws, image=im)
+    window = get_lattice_average(image, lattice_kernel)
 
     if display:
         fig = pylab.figure()
@@ -1137,6 +1843,109 @@ def get_offset_vector(
     if verbose: print "Offset vector:", offset_vector
     return offset_vector
 
+def get_offset_vectors(
+    image_data, direct_lattice_vectors, prefilter='median',
+    num_processes=1, chunk_size=10, verbose=False):
+    """get_offset_vector() for every frame of a stack. The lattice only
+    depends on the frame shape, so we set it up once, and share the
+    frames between 'num_processes' worker processes."""
+    lattice_kernel = get_lattice_kernel(
+        image_data.shape[1:], direct_lattice_vectors)
+    frames = (image_data[z, :, :] for z in range(image_data.shape[0]))
+    if num_processes == 1:
+        pool = None
+        offset_vectors = (get_offset_vector(
+            image=im, direct_lattice_vectors=direct_lattice_vectors,
+            prefilter=prefilter, verbose=False, display=False,
+            show_interpolation=False, lattice_kernel=lattice_kernel)
+                          for im in frames)
+    else:
+        pool = multiprocessing.Pool(
+            processes=num_processes,
+            initializer=_offset_worker_init,
+            initargs=(direct_lattice_vectors, prefilter, lattice_kernel))
+        offset_vectors = pool.imap(_offset_worker, frames, chunk_size)
+    try:
+        results = []
+        for z, offset_vector in enumerate(offset_vectors):
+            results.append(offset_vector)
+            if verbose:
+                sys.stdout.write('\rComputing offset for frame %i'%(z))
+                sys.stdout.flush()
+        if pool is not None:
+            pool.close()
+    except:
+        if pool is not None:
+            pool.terminate()
+        raise
+    finally:
+        if pool is not None:
+            pool.join()
+    if verbose:
+        print
+    return results
+
+def _offset_worker_init(direct_lattice_vectors, prefilter, lattice_kernel):
+    _worker_state['offset_arguments'] = {
+        'direct_lattice_vectors': direct_lattice_vectors,
+        'prefilter': prefilter,
+        'lattice_kernel': lattice_kernel}
+
+def _offset_worker(image):
+    return get_offset_vector(
+        image=image, verbose=False, display=False, show_interpolation=False,
+        **_worker_state['offset_arguments'])
+
+def get_lattice_kernel(image_shape, direct_lattice_vectors):
+    """
+    Everything get_lattice_average() needs that only depends on the
+    image shape and the lattice.
+
+    get_lattice_average() sums the cubic spline interpolation of the
+    image over a window centered on each lattice point. That's the same
+    as correlating the image's spline coefficients with a 'kernel' of
+    B-spline weights around each lattice point, so we store the FFT of
+    that kernel. The edge buffer keeps the kernel more than a window
+    size from the image edges, so the FFT's wraparound never matters.
+    """
+    ws = 2 + int(max(
+        [abs(v).max() for v in direct_lattice_vectors]))
+    lattice_points = numpy.array(generate_lattice(
+        image_shape, direct_lattice_vectors, edge_buffer=2+ws)).reshape(-1, 2)
+    """The 4x4 pixels near each point with nonzero B-spline weight"""
+    nearby = numpy.arange(-1, 3)
+    x = numpy.floor(lattice_points[:, 0:1]).astype(int) + nearby
+    y = numpy.floor(lattice_points[:, 1:2]).astype(int) + nearby
+    x_weights = cubic_bspline(lattice_points[:, 0:1] - x)
+    y_weights = cubic_bspline(lattice_points[:, 1:2] - y)
+    kernel = numpy.zeros(image_shape, dtype=float)
+    numpy.add.at(kernel,
+                 (x.reshape(-1, 4, 1), y.reshape(-1, 1, 4)),
+                 x_weights.reshape(-1, 4, 1) * y_weights.reshape(-1, 1, 4))
+    return {'window_size': ws,
+            'image_shape': tuple(image_shape),
+            'kernel_fft': numpy.conj(numpy.fft.rfft2(kernel))}
+
+def get_lattice_average(image, lattice_kernel):
+    """The sum of the (2*window_size + 1)-pixel square window centered
+    on every lattice point, like summing get_centered_subimage() over
+    the lattice, in one FFT correlation."""
+    assert image.shape == lattice_kernel['image_shape']
+    ws = lattice_kernel['window_size']
+    coefficients = interpolation.spline_filter(
+        numpy.asarray(image, dtype=float), order=3)
+    correlation = numpy.fft.irfft2(
+        numpy.fft.rfft2(coefficients) * lattice_kernel['kernel_fft'],
+        s=image.shape)
+    shifts = numpy.arange(-ws, ws + 1)
+    return correlation[numpy.ix_(shifts % image.shape[0],
+                                 shifts % image.shape[1])]
+
+def cubic_bspline(x):
+    x = abs(x)
+    return numpy.where(x < 1, 2./3. - x**2 + 0.5 * x**3,
+                       numpy.where(x < 2, (2 - x)**3 / 6., 0))
+
 def simple_max_finder(a, show_plots=True):
     """Given a 3x3 array with the maximum pixel in the center,
     estimates the x/y position of the true maximum"""
@@ -1167,13 +1976,15 @@ def simple_max_finder(a, show_plots=True):
     return true_max
 
 def get_shift_vector(
-    fourier_lattice_vectors, fft_data_folder, filtered_fft_abs,
+    fourier_lattice_vectors, fft_data_name, filtered_fft_abs,
     num_harmonics=3, outlier_phase=1.,
-    verbose=True, display=True, scan_type='1d', scan_dimensions=None):
+    verbose=True, display=True, scan_type='1d', scan_dimensions=None,
+    image_data=None):
+    """If 'image_data' is provided, the harmonic pixels are calculated
+    directly from it, and 'fft_data_name' is ignored."""
     if verbose: print "\nCalculating shift vector..."
     center_pix = numpy.array(filtered_fft_abs.shape) // 2
     harmonic_pixels = []
-    values = {}
     for v in fourier_lattice_vectors:
         harmonic_pixels.append([])
         for i in range(1, num_harmonics+1):
@@ -1188,23 +1999,19 @@ def get_shift_vector(
                 print "Shift:", shift
                 print "Brightest neighboring pixel:", actual_pix
             harmonic_pixels[-1].append(tuple(actual_pix))
-            values[harmonic_pixels[-1][-1]] = []
-    num_slices = len(os.listdir(fft_data_folder))
-    if verbose: print '\n'
-    for z in range(num_slices):
-        if verbose:
-            sys.stdout.write("\rLoading harmonic pixels from FFT slice %06i"%(z))
-            sys.stdout.flush()
-        fft_data = load_fft_slice(
-            fft_data_folder,
+    all_pixels = [p for hp in harmonic_pixels for p in hp]
+    if image_data is not None:
+        if verbose: print "\nCalculating harmonic pixels from image data"
+        values = dict(zip(all_pixels, get_harmonic_values(
+            image_data, pixels=all_pixels)))
+    else:
+        if verbose: print "\nLoading harmonic pixels from FFT data"
+        values = dict(zip(all_pixels, load_fft_pixels(
+            fft_data_name,
             xPix=filtered_fft_abs.shape[0],
             yPix=filtered_fft_abs.shape[1],
-            which_slice=z)
-        for hp in harmonic_pixels:
-            for p in hp:
-                values[p].append(
-                    fft_data[p[0] + center_pix[0], p[1] + center_pix[1]])
-    if verbose: print
+            pixels=all_pixels)))
+    num_slices = len(values[all_pixels[0]])
     slopes = []
     K = []
     if display: fig = pylab.figure()
@@ -1240,7 +2047,8 @@ def get_shift_vector(
                 slope[1] *= scan_dimensions[1]
             values[p] -= values[p].mean()
             if abs(values[p]).mean() < outlier_phase:
-                K.append(p * (-2. * numpy.pi / numpy.array(fft_data.shape)))
+                K.append(p * (-2. * numpy.pi /
+                              numpy.array(filtered_fft_abs.shape)))
                 slopes.append(slope)
             else:
                 if verbose: print "Ignoring outlier:", p
@@ -1277,25 +2085,17 @@ def get_shift_vector(
 
 def get_precise_shift_vector(
     direct_lattice_vectors, shift_vector, offset_vector,
-    last_image, zPix, scan_type, verbose):
+    last_image, zPix, scan_type, verbose, num_processes=1):
     if scan_type is 'arbitrary':
         """In the case of 'arbitrary' scan type, the variable
         'last_image' is poorly named, for legacy reasons. It actually
         is a 3D stack, and we compute an offset vector for every image
         in this stack."""
         corrected_shift_vector = [numpy.array([0, 0])]
-        for z in range(1, zPix):
-            if verbose:
-                sys.stdout.write('\rComputing shift for frame %i'%(z))
-                sys.stdout.flush()
-            corrected_shift_vector.append(
-                get_offset_vector(
-                    image=last_image[z, :, :],
-                    direct_lattice_vectors=direct_lattice_vectors,
-                    verbose=False, display=False, show_interpolation=False) -
-                offset_vector)
-        if verbose:
-            print
+        for frame_offset in get_offset_vectors(
+            last_image[1:zPix, :, :], direct_lattice_vectors,
+            num_processes=num_processes, verbose=verbose):
+            corrected_shift_vector.append(frame_offset - offset_vector)
         final_offset_vector = offset_vector + corrected_shift_vector[-1]
     else:
         """Use the offset vector to correct the shift vector"""
@@ -1427,11 +2227,25 @@ def combine_lattices(
 def calculate_scan_uniformity_correction(
     xPix, yPix, zPix,
     lattice_vectors, shift_vector, offset_vector,
-    verbose=False, display=False):
+    verbose=False, display=False, cache_basename=None):
     """
     The scan grid may not be uniform. This function computes a weight
     for each exposure to correct for nonuniform scan patterns.
+
+    If 'cache_basename' is set, the weights are saved to (and loaded
+    from) a file starting with it, keyed by the scan geometry, which is
+    all they depend on.
     """
+    if cache_basename is not None:
+        parameters = ('scan_uniformity', zPix,
+                      lattice_vectors, shift_vector, offset_vector)
+        cache_name = cache_basename + '_scan_uniformity_%s.npy'%(
+            calibration_key(*parameters))
+        if (artifact_cache.is_cached([cache_name], [], parameters) and
+            not display):
+            if verbose:
+                print "Loading scan uniformity correction:", cache_name
+            return numpy.load(cache_name)
     if verbose:
         print "Calculating scan uniformity correction..."
     scan_locations = numpy.zeros((zPix, 2))
@@ -1451,13 +2265,13 @@ def calculate_scan_uniformity_correction(
     if verbose:
         print "Done."
     vertex_weights = numpy.zeros(triangles.points.shape[0], dtype=numpy.float)
-    for v in triangles.vertices:
-        """'v' is a set of 3 indices in triangles.points"""
-        corners = triangles.points[v]
-        """'corners' is a set of 3 2D coordinates"""
-        triangle_area = abs(numpy.cross(corners[1] - corners[0],
-                                    corners[2] - corners[0]))
-        vertex_weights[v] += 1./3. * triangle_area
+    """Each row of triangles.vertices is a set of 3 indices in
+    triangles.points, so 'corners' has shape (num_triangles, 3, 2)"""
+    corners = triangles.points[triangles.vertices]
+    triangle_areas = abs(numpy.cross(corners[:, 1, :] - corners[:, 0, :],
+                                     corners[:, 2, :] - corners[:, 0, :]))
+    numpy.add.at(vertex_weights, triangles.vertices,
+                 1./3. * triangle_areas.reshape(-1, 1))
     if display:
         response = raw_input("Plot triangles? y/[n]:")
         if response == 'y':
@@ -1475,14 +2289,60 @@ def calculate_scan_uniformity_correction(
                            list(t[:, 0]) + [t[0, 0]], 'r-')
             pylab.axis('equal')
             fig.show()
+    if cache_basename is not None:
+        numpy.save(cache_name, vertex_weights[:zPix])
+        artifact_cache.store([cache_name], [], parameters)
     return vertex_weights[:zPix]
 
+def get_frame_statistics(
+    filename, xPix, yPix, zPix, preframes=0,
+    block_size=16, num_threads=None, saturation_level=65535, verbose=False):
+    """Per-frame sum, mean, and number of saturated pixels, plus the max
+    projection, of a raw or TIF stack. We read the file once, in blocks
+    of 'block_size' frames spread across a thread pool, and cache the
+    results next to the data, so we only reread it if it changes."""
+    basename = os.path.splitext(filename)[0]
+    statistics_name = basename + '_frame_statistics.npz'
+    parameters = ('frame_statistics', xPix, yPix, zPix, preframes,
+                  saturation_level)
+    if artifact_cache.is_cached([statistics_name], [filename], parameters):
+        statistics = numpy.load(statistics_name)
+        return dict((k, statistics[k]) for k in statistics.files)
+    if verbose:
+        print "Calculating frame statistics:", os.path.split(filename)[1]
+    image_data = load_image_data(filename, xPix, yPix, zPix, preframes)
+    def process_block(start):
+        block = image_data[start:start + block_size, :, :]
+        block = block.reshape(block.shape[0], -1)
+        return (block.sum(axis=1, dtype=numpy.int64),
+                numpy.array([numpy.count_nonzero(frame >= saturation_level)
+                             for frame in block]),
+                block.max(axis=0))
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+    pool = ThreadPool(num_threads)
+    try:
+        results = pool.map(
+            process_block, range(0, image_data.shape[0], block_size))
+    finally:
+        pool.close()
+        pool.join()
+    statistics = {
+        'sum': numpy.concatenate([r[0] for r in results]),
+        'saturated': numpy.concatenate([r[1] for r in results]),
+        'max_projection': numpy.maximum.reduce([r[2] for r in results]
+                                               ).reshape(image_data.shape[1:])}
+    statistics['mean'] = statistics['sum'] * (1.0 / image_data[0, :, :].size)
+    numpy.savez(statistics_name, **statistics)
+    artifact_cache.store([statistics_name], [filename], parameters)
+    return statistics
+
 def calculate_laser_intensity_drift(
     image_filename, bg_filename, output_filename,
     xPix, yPix, zPix, preframes,
     display):
     
-    image_data = load_image_data(
+    frame_statistics = get_frame_statistics(
         image_filename, xPix, yPix, zPix, preframes)
     try:
         bg = numpy.fromfile(bg_filename).reshape(xPix, yPix).astype(float)
@@ -1492,8 +2352,7 @@ def calculate_laser_intensity_drift(
         print "may not be the size it was expected to be.\n\n"
         raise
     average_intensity = gaussian_filter(
-        median_filter((image_data.sum(axis=2).sum(axis=1) -
-                       bg.sum()),
+        median_filter((frame_statistics['sum'] - bg.sum()),
                       size=5),
         sigma=5)
     cPickle.dump(average_intensity,
@@ -1509,20 +2368,21 @@ def spot_intensity_vs_scan_position(
     lake_filename, xPix, yPix, zPix, preframes,
     direct_lattice_vectors, shift_vector, offset_vector,
     background_filename, background_zPix,
-    window_size=5, verbose=False, show_steps=False, display=False):
+    window_size=5, verbose=False, show_steps=False, display=False,
+    num_threads=None):
     """Calibrate how the intensity of each spot varies with galvo
     position, using a fluorescent lake dataset and a stack of
     light-free background images."""
 
     lake_basename = os.path.splitext(lake_filename)[0]
-    lake_intensities_name = lake_basename + '_spot_intensities.pkl'
+    lake_intensities_name = lake_basename + '_spot_intensities.npy'
     lake_average_intensity_name = lake_basename + '_avg_intensity.pkl'
     background_basename = os.path.splitext(background_filename)[0]
     background_name = background_basename + '_background_image.raw'
     background_directory_name = os.path.dirname(background_basename)
+    hot_pixels_name = os.path.join(background_directory_name, 'hot_pixels.txt')
     try:
-        hot_pixels = numpy.fromfile(
-            os.path.join(background_directory_name, 'hot_pixels.txt'), sep=', ')
+        hot_pixels = numpy.fromfile(hot_pixels_name, sep=', ')
     except IOError:
         skip_hot_pix = raw_input("Hot pixel list not found. Continue? y/[n]:")
         if skip_hot_pix != 'y':
@@ -1530,14 +2390,28 @@ def spot_intensity_vs_scan_position(
         else:
             hot_pixels = None
     else:
-        hot_pixels = hot_pixels.reshape(2, len(hot_pixels)/2)
-    
-    if (os.path.exists(lake_intensities_name) and
-        os.path.exists(background_name)):
-        print "\nIllumination intensity calibration already calculated."
-        print "Loading", os.path.split(lake_intensities_name)[1]
-        intensities_vs_scan_position = cPickle.load(
-            open(lake_intensities_name, 'rb'))
+        hot_pixels = Hot_Pixel_Corrector(
+            hot_pixels.reshape(-1, 2), image_shape=(xPix, yPix))
+    """
+    The background image depends only on the background stack and the
+    hot pixels, so several lakes can share it. The flat-field
+    calibration depends on the lake, the background image, and the
+    lattice.
+    """
+    background_sources = [background_filename, hot_pixels_name]
+    background_parameters = (
+        'background', xPix, yPix, background_zPix, preframes)
+    lake_artifact_names = [
+        lake_intensities_name, lake_basename + '_spot_intensities_offset.txt',
+        lake_average_intensity_name]
+    lake_sources = [lake_filename, background_name]
+    lake_parameters = (
+        'spot_intensities', xPix, yPix, zPix, preframes,
+        direct_lattice_vectors, shift_vector, offset_vector, window_size)
+
+    if artifact_cache.is_cached([background_name], background_sources,
+                                background_parameters,
+                                hashed_sources=[hot_pixels_name]):
         print "Loading", os.path.split(background_name)[1]
         try:
             bg = numpy.fromfile(background_name, dtype=float
@@ -1548,7 +2422,6 @@ def spot_intensity_vs_scan_position(
             print "may not be the size it was expected to be.\n\n"
             raise
     else:
-        print "\nCalculating illumination spot intensities..."
         print "Constructing background image..."
         background_image_data = load_image_data(
             background_filename, xPix, yPix, background_zPix, preframes)
@@ -1558,10 +2431,22 @@ def spot_intensity_vs_scan_position(
         bg *= 1.0 / background_image_data.shape[0]
         del background_image_data
         if hot_pixels is not None:
-            bg = remove_hot_pixels(bg, hot_pixels)
+            bg = hot_pixels.correct(bg)
         print "Background image complete."
         print "Saving", os.path.split(background_name)[1]
         bg.tofile(background_name)
+        artifact_cache.store([background_name], background_sources,
+                             background_parameters,
+                             hashed_sources=[hot_pixels_name])
+
+    if artifact_cache.is_cached(lake_artifact_names, lake_sources,
+                                lake_parameters):
+        print "\nIllumination intensity calibration already calculated."
+        print "Loading", os.path.split(lake_intensities_name)[1]
+        intensities_vs_scan_position = get_spot_intensity_table(
+            lake_filename)
+    else:
+        print "\nCalculating illumination spot intensities..."
         lake_image_data = load_image_data(
             lake_filename, xPix, yPix, zPix, preframes)
         lake_average_intensity = calculate_laser_intensity_drift(
@@ -1569,77 +2454,290 @@ def spot_intensity_vs_scan_position(
             output_filename=lake_average_intensity_name,
             xPix=xPix, yPix=yPix, zPix=zPix, preframes=preframes,
             display=display)
-        intensities_vs_scan_position = {}
-        """A dict of dicts. Element [i, j][z] gives the intensity of the
-        i'th, j'th spot in the lattice, in frame z"""
-        if show_steps: fig = pylab.figure()
         print "Computing flat-field calibration..."
-        for z in range(lake_image_data.shape[0]):
-            im = numpy.array(lake_image_data[z, :, :], dtype=float)
-            if hot_pixels is not None:
-                im = remove_hot_pixels(im, hot_pixels)
-            sys.stdout.write("\rCalibration image %i"%(z))
-            sys.stdout.flush()
-            lattice_points, i_list, j_list = generate_lattice(
-                image_shape=(xPix, yPix),
-                lattice_vectors=direct_lattice_vectors,
-                center_pix=offset_vector + get_shift(shift_vector, z),
-                edge_buffer=window_size+1,
-                return_i_j=True)
-            
-            for m, lp in enumerate(lattice_points):
-                i, j = int(i_list[m]), int(j_list[m])
-                intensity_history = intensities_vs_scan_position.setdefault(
-                    (i, j), {}) #Get this spot's history
-                spot_image = get_centered_subimage(
-                    center_point=lp, window_size=window_size,
-                    image=im, background=bg)
-                intensity_history[z] = float(spot_image.sum()) #Funny thing...
-                if show_steps:
-                    pylab.clf()
-                    pylab.imshow(
-                        spot_image, interpolation='nearest', cmap=pylab.cm.gray)
-                    pylab.title(
-                        "Spot %i, %i in frame %i\nCentered at %0.2f, %0.2f"%(
-                            i, j, z, lp[0], lp[1]))
-                    fig.show()
-                    fig.canvas.draw()
-                    response = raw_input()
-                    if response == 'q' or response == 'e' or response == 'x':
-                        print "Done showing steps..."
-                        show_steps = False
+        if show_steps:
+            """Show each spot on its way through get_centered_subimage()"""
+            fig = pylab.figure()
+            spot_i, spot_j, spot_z, spot_intensities = [], [], [], []
+            for z in range(lake_image_data.shape[0]):
+                im = numpy.array(lake_image_data[z, :, :], dtype=float)
+                if hot_pixels is not None:
+                    im = hot_pixels.correct(im)
+                sys.stdout.write("\rCalibration image %i"%(z))
+                sys.stdout.flush()
+                lattice_points, i_list, j_list = generate_lattice(
+                    image_shape=(xPix, yPix),
+                    lattice_vectors=direct_lattice_vectors,
+                    center_pix=offset_vector + get_shift(shift_vector, z),
+                    edge_buffer=window_size+1,
+                    return_i_j=True)
+                for m, lp in enumerate(lattice_points):
+                    i, j = int(i_list[m]), int(j_list[m])
+                    spot_image = get_centered_subimage(
+                        center_point=lp, window_size=window_size,
+                        image=im, background=bg)
+                    spot_i.append(i)
+                    spot_j.append(j)
+                    spot_z.append(z)
+                    spot_intensities.append(float(spot_image.sum()))
+                    if show_steps:
+                        pylab.clf()
+                        pylab.imshow(spot_image, interpolation='nearest',
+                                     cmap=pylab.cm.gray)
+                        pylab.title(
+                            "Spot %i, %i in frame %i\n"%(i, j, z) +
+                            "Centered at %0.2f, %0.2f"%(lp[0], lp[1]))
+                        fig.show()
+                        fig.canvas.draw()
+                        response = raw_input()
+                        if response in ('q', 'e', 'x'):
+                            print "Done showing steps..."
+                            show_steps = False
+        else:
+            (spot_i, spot_j, spot_z, spot_intensities, frame_times
+             ) = measure_spot_intensities(
+                 lake_image_data, direct_lattice_vectors, shift_vector,
+                 offset_vector, bg, hot_pixels, window_size=window_size,
+                 num_threads=num_threads)
+            print "%i calibration images, %0.1f ms per image (%0.2f s total)"%(
+                len(frame_times), 1000*numpy.mean(frame_times),
+                sum(frame_times))
         """Normalize the intensity values"""
-        num_entries = 0
-        total_sum = 0
-        for hist in intensities_vs_scan_position.values():
-            for intensity in hist.values():
-                num_entries += 1
-                total_sum += intensity
-        inverse_avg = num_entries * 1.0 / total_sum
-        for hist in intensities_vs_scan_position.values():
-            for k in hist.keys():
-                hist[k] *= inverse_avg
+        spot_intensities = numpy.array(spot_intensities)
+        spot_intensities *= len(spot_intensities) / spot_intensities.sum()
+        intensities_vs_scan_position = make_spot_intensity_table(
+            spot_i, spot_j, spot_z, spot_intensities,
+            zPix=lake_image_data.shape[0])
         print "\nSaving", os.path.split(lake_intensities_name)[1]
-        cPickle.dump(intensities_vs_scan_position,
-                     open(lake_intensities_name, 'wb'), protocol=2)
+        intensities_vs_scan_position.save(lake_intensities_name)
+        artifact_cache.store(lake_artifact_names, lake_sources,
+                             lake_parameters)
     if display:
         fig=pylab.figure()
-        num_lines = 0
-        for (i, j), spot_hist in intensities_vs_scan_position.items()[:10]:
-            num_lines += 1
-            sh = spot_hist.items()
-            pylab.plot([frame_num for frame_num, junk in sh],
-                       [intensity for junk, intensity in sh],
-                       ('-', '-.')[num_lines > 5],
-                       label=repr((i, j)))
+        intensities = intensities_vs_scan_position.intensities
+        measured = numpy.isfinite(intensities)
+        spots = numpy.argwhere(measured.any(axis=2))[:10]
+        for num_lines, (i, j) in enumerate(spots):
+            frame_nums = numpy.flatnonzero(measured[i, j, :])
+            pylab.plot(frame_nums, intensities[i, j, frame_nums],
+                       ('-', '-.')[num_lines >= 5],
+                       label=repr(tuple(
+                           (i, j) + intensities_vs_scan_position.index_offset)))
         pylab.legend()
         fig.show()
     return intensities_vs_scan_position, bg #bg is short for 'background'
 
+def get_spot_intensities(image, background, lattice_points, window_size):
+    """The background-subtracted sum of the (2*window_size + 1)-pixel
+    square window centered on each lattice point, for every point at
+    once.
+
+    Equivalent to summing get_centered_subimage(), but instead of
+    shifting each window by a fraction of a pixel, we integrate a
+    fractionally-placed window, using bilinear interpolation of the
+    image's summed-area table."""
+    image = numpy.asarray(image, dtype=float) - background
+    summed_area = numpy.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    summed_area[1:, 1:] = image.cumsum(axis=0).cumsum(axis=1)
+    lattice_points = numpy.asarray(lattice_points, dtype=float).reshape(-1, 2)
+    """Pixel 'n' covers n-0.5 to n+0.5, which is n to n+1 in the table"""
+    low = lattice_points - window_size
+    high = lattice_points + window_size + 1
+    def integral(x, y):
+        x = numpy.clip(x, 0, image.shape[0])
+        y = numpy.clip(y, 0, image.shape[1])
+        x0 = numpy.minimum(numpy.floor(x).astype(int), image.shape[0] - 1)
+        y0 = numpy.minimum(numpy.floor(y).astype(int), image.shape[1] - 1)
+        fx, fy = x - x0, y - y0
+        return ((1 - fx) * (1 - fy) * summed_area[x0, y0] +
+                fx * (1 - fy) * summed_area[x0 + 1, y0] +
+                (1 - fx) * fy * summed_area[x0, y0 + 1] +
+                fx * fy * summed_area[x0 + 1, y0 + 1])
+    return (integral(high[:, 0], high[:, 1]) - integral(low[:, 0], high[:, 1])
+            - integral(high[:, 0], low[:, 1]) + integral(low[:, 0], low[:, 1]))
+
+def measure_spot_intensities(
+    image_data, lattice_vectors, shift_vector, offset_vector,
+    background, hot_pixels, window_size=5, num_threads=None):
+    """Spot intensities for every frame of a lake stack, processed
+    in parallel threads (numpy releases the GIL for the heavy lifting).
+    'hot_pixels' is a Hot_Pixel_Corrector, or None.
+
+    Returns the i, j, and frame number of every spot, its intensity,
+    and how long each frame took to process."""
+    def process_frame(z):
+        start = time.time()
+        im = numpy.array(image_data[z, :, :], dtype=float)
+        if hot_pixels is not None:
+            im = hot_pixels.correct(im)
+        lattice_points, i_list, j_list = generate_lattice(
+            image_shape=im.shape,
+            lattice_vectors=lattice_vectors,
+            center_pix=offset_vector + get_shift(shift_vector, z),
+            edge_buffer=window_size+1,
+            return_i_j=True)
+        intensities = get_spot_intensities(
+            im, background, lattice_points, window_size)
+        return (numpy.asarray(i_list, dtype=int),
+                numpy.asarray(j_list, dtype=int),
+                intensities, time.time() - start)
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+    pool = ThreadPool(num_threads)
+    try:
+        results = pool.map(process_frame, range(image_data.shape[0]))
+    finally:
+        pool.close()
+        pool.join()
+    spot_i = numpy.concatenate([r[0] for r in results])
+    spot_j = numpy.concatenate([r[1] for r in results])
+    spot_z = numpy.concatenate([numpy.repeat(z, len(r[0]))
+                                for z, r in enumerate(results)])
+    spot_intensities = numpy.concatenate([r[2] for r in results])
+    frame_times = [r[3] for r in results]
+    return spot_i, spot_j, spot_z, spot_intensities, frame_times
+
+class Spot_Intensity_Table:
+    """
+    The flat-field calibration from spot_intensity_vs_scan_position():
+    the relative intensity of the i'th, j'th spot in the lattice, in
+    frame z.
+
+    Stored as a dense (n_i, n_j, z) float32 array, where spot i, j lives
+    at [i - index_offset[0], j - index_offset[1]]. Spots and frames we
+    never measured hold 'inf', so their flat-field normalization
+    (1/intensity) is zero, and the reconstruction skips them.
+    """
+    def __init__(self, intensities, index_offset):
+        self.intensities = intensities
+        self.index_offset = numpy.array(index_offset, dtype=int)
+        return None
+
+    def lookup(self, i_list, j_list, z):
+        """Intensities of spots (i_list[n], j_list[n]) in frame(s) z"""
+        i, j, z = numpy.broadcast_arrays(
+            numpy.asarray(i_list).astype(int) - self.index_offset[0],
+            numpy.asarray(j_list).astype(int) - self.index_offset[1],
+            numpy.asarray(z).astype(int))
+        inside = ((i >= 0) & (i < self.intensities.shape[0]) &
+                  (j >= 0) & (j < self.intensities.shape[1]) &
+                  (z >= 0) & (z < self.intensities.shape[2]))
+        intensities = numpy.empty(i.shape, dtype=float)
+        intensities.fill(numpy.inf)
+        intensities[inside] = self.intensities[i[inside], j[inside], z[inside]]
+        return intensities
+
+    def save(self, filename):
+        """The array goes in 'filename', which load_spot_intensity_table()
+        can memory-map, and the index offset in a small text file"""
+        numpy.save(filename, self.intensities)
+        numpy.savetxt(os.path.splitext(filename)[0] + '_offset.txt',
+                      self.index_offset.reshape(1, 2), fmt='%i', delimiter=', ')
+        return None
+
+def make_spot_intensity_table(i_list, j_list, z_list, intensities, zPix=None):
+    """A Spot_Intensity_Table from a list of individual measurements"""
+    i_list, j_list, z_list = [numpy.asarray(x, dtype=int)
+                              for x in (i_list, j_list, z_list)]
+    if zPix is None:
+        zPix = z_list.max() + 1
+    index_offset = (i_list.min(), j_list.min())
+    table = numpy.empty((i_list.max() - index_offset[0] + 1,
+                         j_list.max() - index_offset[1] + 1,
+                         zPix), dtype=numpy.float32)
+    table.fill(numpy.inf)
+    table[i_list - index_offset[0], j_list - index_offset[1], z_list
+          ] = intensities
+    return Spot_Intensity_Table(table, index_offset)
+
+def load_spot_intensity_table(filename, mmap_mode='r'):
+    offset_name = os.path.splitext(filename)[0] + '_offset.txt'
+    return Spot_Intensity_Table(
+        numpy.load(filename, mmap_mode=mmap_mode),
+        numpy.loadtxt(offset_name, dtype=int, delimiter=', '))
+
+def convert_spot_intensity_pickle(pickle_filename, zPix=None):
+    """Older versions stored the flat-field calibration as a pickled dict
+    of dicts, where element [i, j][z] is the intensity of spot i, j in
+    frame z. Save it as a Spot_Intensity_Table next to the pickle."""
+    intensities_vs_scan_position = cPickle.load(open(pickle_filename, 'rb'))
+    i_list, j_list, z_list, intensities = [], [], [], []
+    for (i, j), spot_hist in intensities_vs_scan_position.items():
+        for z, intensity in spot_hist.items():
+            i_list.append(i)
+            j_list.append(j)
+            z_list.append(z)
+            intensities.append(intensity)
+    table = make_spot_intensity_table(
+        i_list, j_list, z_list, intensities, zPix=zPix)
+    table.save(os.path.splitext(pickle_filename)[0] + '.npy')
+    return table
+
+def get_spot_intensity_table(lake_filename, mmap_mode='r'):
+    """Load the lake's flat-field calibration, converting it first if
+    it's still an old-style pickle"""
+    lake_basename = os.path.splitext(lake_filename)[0]
+    lake_intensities_name = lake_basename + '_spot_intensities.npy'
+    if not os.path.exists(lake_intensities_name):
+        lake_intensities_pickle_name = lake_basename + '_spot_intensities.pkl'
+        print "Converting", os.path.split(lake_intensities_pickle_name)[1]
+        convert_spot_intensity_pickle(lake_intensities_pickle_name)
+    return load_spot_intensity_table(lake_intensities_name, mmap_mode)
+
 def remove_hot_pixels(image, hot_pixels):
-    for y, x in hot_pixels:
-        image[x, y] = numpy.median(image[max(x-1, 0):x+2, max(y-1, 0):y+2])
-    return image
+    """Replace each (y, x) pair in 'hot_pixels' with the median of its
+    3x3 neighborhood. To correct many frames, build one
+    Hot_Pixel_Corrector and reuse it."""
+    return Hot_Pixel_Corrector(hot_pixels, image.shape[-2:]).correct(image)
+
+class Hot_Pixel_Corrector:
+    """
+    Replaces hot pixels with the median of their 3x3 neighborhood (the
+    part of it inside the image, at the edges).
+
+    'hot_pixels' is a list of (y, x) pairs, like hot_pixels.txt holds,
+    so pixel (y, x) is image[x, y]. We work out where every hot pixel's
+    neighbors are once, so correcting a frame is a single gather and
+    median, and correct() works on a whole (z, x, y) block of frames
+    just as well as on one frame.
+
+    Every hot pixel gets the median of the uncorrected frame, so
+    neighboring hot pixels don't depend on the order of the list.
+    """
+    def __init__(self, hot_pixels, image_shape):
+        self.image_shape = tuple(image_shape)
+        hot_pixels = numpy.asarray(hot_pixels, dtype=int).reshape(-1, 2)
+        x, y = hot_pixels[:, 1], hot_pixels[:, 0]
+        self.targets = numpy.ravel_multi_index((x, y), self.image_shape)
+        dx, dy = [d.ravel() for d in numpy.mgrid[-1:2, -1:2]]
+        neighbor_x = x.reshape(-1, 1) + dx
+        neighbor_y = y.reshape(-1, 1) + dy
+        inside = ((neighbor_x >= 0) & (neighbor_x < self.image_shape[0]) &
+                  (neighbor_y >= 0) & (neighbor_y < self.image_shape[1]))
+        self.neighbors = numpy.ravel_multi_index( #(N, 9)
+            (neighbor_x, neighbor_y), self.image_shape, mode='clip')
+        """Only hot pixels at the edge need the (slow) nanmedian"""
+        self.edge = ~inside.all(axis=1)
+        self.outside = ~inside[self.edge]
+        return None
+
+    def __len__(self):
+        return len(self.targets)
+
+    def correct(self, image):
+        """Correct a frame, or a block of frames, in place"""
+        assert image.shape[-2:] == self.image_shape
+        if not image.flags.c_contiguous:
+            image = numpy.ascontiguousarray(image)
+        frames = image.reshape(-1, self.image_shape[0]*self.image_shape[1])
+        neighborhoods = frames[:, self.neighbors] #(z, N, 9)
+        medians = numpy.median(neighborhoods, axis=2)
+        if self.edge.any():
+            edge_neighborhoods = neighborhoods[:, self.edge, :].astype(float)
+            edge_neighborhoods[:, self.outside] = numpy.nan
+            medians[:, self.edge] = numpy.nanmedian(edge_neighborhoods, axis=2)
+        frames[:, self.targets] = medians
+        return image
 
 def shift_to_central_unit_cell(coordinates, image_shape, lattice_vectors):
     offset = numpy.array(coordinates) - (numpy.array(image_shape) // 2)
@@ -1697,78 +2795,406 @@ def get_centered_subimage(
         subimage, shift=(x, y)-center_point, output=subimage)
     return subimage[1:-1, 1:-1]
 
+def get_subgrid(new_grid_x, new_grid_y, window_footprint, scale_factor):
+    """The patch of the new grid that each spot's resampled image
+    covers, in the coordinates of the spot's window"""
+    grid_step_x = new_grid_x[1] - new_grid_x[0]
+    grid_step_y = new_grid_y[1] - new_grid_y[0]
+    subgrid_footprint = numpy.floor(
+        (-1 + window_footprint * scale_factor / grid_step_x,
+         -1 + window_footprint * scale_factor / grid_step_y))
+    subgrid = ( #Add (1/scale_factor)*(r_0 - r_M) to this to get s_desired
+        window_footprint + (1.0 / scale_factor) * grid_step_x * numpy.arange(
+            -subgrid_footprint[0], subgrid_footprint[0] + 1),
+        window_footprint + (1.0 / scale_factor) * grid_step_y * numpy.arange(
+            -subgrid_footprint[1], subgrid_footprint[1] + 1))
+    return subgrid_footprint, subgrid
+
+def get_spot_geometry(
+    lattice_points, window_footprint, image_shape, scale_factor,
+    new_grid_x, new_grid_y, subgrid_footprint):
+    """Where each illumination spot's window sits in the raw image, and
+    where its resampled image lands on the new grid. This is the
+    pixel-value-independent half of the spot-by-spot loop in
+    enderlein_image_subprocess()."""
+    lattice_points = numpy.asarray(lattice_points, dtype=float).reshape(-1, 2)
+    grid_start = numpy.array((new_grid_x[0], new_grid_y[0]))
+    grid_step = numpy.array((new_grid_x[1] - new_grid_x[0],
+                             new_grid_y[1] - new_grid_y[0]))
+    subgrid_footprint = numpy.asarray(subgrid_footprint).astype(int)
+    rounded_points = numpy.round(lattice_points).astype(int)
+    nearest_grid_index = numpy.round(
+        (lattice_points - grid_start) / grid_step).astype(int)
+    nearest_grid_point = grid_start + grid_step * nearest_grid_index
+    window_corners = rounded_points - window_footprint - 1
+    grid_corners = nearest_grid_index - subgrid_footprint
+    """Spots too close to the edge get skipped, like the loop does"""
+    in_bounds = (
+        numpy.all(window_corners >= 0, axis=1) &
+        numpy.all(rounded_points + window_footprint + 2 <=
+                  numpy.array(image_shape), axis=1) &
+        numpy.all(grid_corners >= 0, axis=1) &
+        numpy.all(nearest_grid_index + subgrid_footprint + 1 <=
+                  numpy.array((len(new_grid_x), len(new_grid_y))), axis=1))
+    return {
+        'window_corners': window_corners,
+        'window_shifts': lattice_points - rounded_points,
+        'grid_corners': grid_corners,
+        'grid_shifts': (1.0 / scale_factor) * (
+            nearest_grid_point - lattice_points),
+        'in_bounds': in_bounds,
+        }
+
+def get_spot_operators(window_shifts, grid_shifts, subgrid, aperture_1d):
+    """Matrix form of get_centered_subimage(), the synthetic pinhole,
+    and the interpolation.map_coordinates() onto the subgrid, for many
+    spots at once. Every step is separable, so each spot's resampled
+    image is left[n].dot(window).dot(right[n].T), where 'window' is the
+    background-subtracted (2*window_footprint+3)-pixel square around
+    the spot's nearest pixel."""
+    window_size = aperture_1d.size
+    operators = []
+    for axis in range(2):
+        """Subpixel shift of the padded window, then crop the padding"""
+        shift_coordinates = (
+            numpy.arange(1, window_size + 1).reshape(1, -1) +
+            window_shifts[:, axis].reshape(-1, 1))
+        shift = spline_resampling_matrix(shift_coordinates, window_size + 2)
+        """Resample the apertured image onto the subgrid"""
+        resample_coordinates = (numpy.asarray(subgrid[axis]).reshape(1, -1) +
+                                grid_shifts[:, axis].reshape(-1, 1))
+        resample = spline_resampling_matrix(resample_coordinates, window_size)
+        operators.append(numpy.matmul(
+            resample * aperture_1d.reshape(1, 1, -1), shift))
+    return operators
+
+def spline_resampling_matrix(coordinates, n):
+    """Matrix form of interpolation.map_coordinates() for a length-n
+    signal: spline prefiltering, then evaluating the cubic spline at
+    'coordinates' with mirrored coefficients at the edges, and zero
+    outside the signal like mode='constant'. Returns an array of shape
+    coordinates.shape + (n,)."""
+    coordinates = numpy.asarray(coordinates, dtype=float)
+    in_bounds = ((coordinates >= 0) & (coordinates <= n - 1)).ravel()
+    floor = numpy.where(in_bounds, numpy.floor(coordinates).ravel(), 0)
+    t = numpy.where(in_bounds, coordinates.ravel() - floor, 0)
+    """Each coordinate touches four neighboring spline coefficients,
+    from floor-1 to floor+2. Past the edges, these are mirrored."""
+    prefilter = interpolation.spline_filter1d(numpy.eye(n), order=3, axis=0)
+    mirrored_index = numpy.abs(numpy.arange(-1, n + 2))
+    mirrored_index = numpy.where(mirrored_index > n - 1,
+                                 2*(n - 1) - mirrored_index, mirrored_index)
+    tap_weights = ((1 - t)**3 / 6.,
+                   (4 - 6*t**2 + 3*t**3) / 6.,
+                   (1 + 3*t + 3*t**2 - 3*t**3) / 6.,
+                   t**3 / 6.)
+    interpolation_matrix = numpy.zeros((t.size, n + 3))
+    first_tap = numpy.arange(t.size) * (n + 3) + floor.astype(int)
+    for tap, weight in enumerate(tap_weights):
+        interpolation_matrix.put(first_tap + tap, weight * in_bounds)
+    return numpy.dot(interpolation_matrix, prefilter[mirrored_index]
+                     ).reshape(coordinates.shape + (n,))
+
+def reassign_spots(
+    image, window_corners, grid_corners, left, right, weights,
+    enderlein_image, enderlein_normalization):
+    """Vectorized version of the spot-by-spot loop in
+    enderlein_image_subprocess(). Gathers every spot's window from the
+    (background-subtracted) image into one array, resamples them all
+    with the operators from get_spot_operators(), and scatter-adds the
+    weighted results onto the new grid."""
+    window_size = left.shape[2]
+    offsets = numpy.arange(window_size)
+    spot_images = image[
+        window_corners[:, 0].reshape(-1, 1, 1) + offsets.reshape(1, -1, 1),
+        window_corners[:, 1].reshape(-1, 1, 1) + offsets.reshape(1, 1, -1)]
+    resampled_images = numpy.matmul(
+        numpy.matmul(left, spot_images), right.transpose(0, 2, 1))
+    resampled_images *= numpy.asarray(weights).reshape(-1, 1, 1)
+    grid_index = (
+        (grid_corners[:, 0].reshape(-1, 1, 1) +
+         numpy.arange(left.shape[1]).reshape(1, -1, 1)
+         ) * enderlein_image.shape[1] +
+        (grid_corners[:, 1].reshape(-1, 1, 1) +
+         numpy.arange(right.shape[1]).reshape(1, 1, -1))).ravel()
+    enderlein_image += numpy.bincount(
+        grid_index, weights=resampled_images.ravel(),
+        minlength=enderlein_image.size).reshape(enderlein_image.shape)
+    enderlein_normalization += numpy.bincount(
+        grid_index, minlength=enderlein_image.size
+        ).reshape(enderlein_image.shape)
+    return None
+
+def get_reassignment_table(
+    lake_filename, xPix, yPix, zPix, steps,
+    lattice_vectors, offset_vector, shift_vector,
+    new_grid_xrange, new_grid_yrange,
+    window_footprint=10,
+    scale_factor=0.5,
+    flat_fielding=True,
+    scan_uniformity_correction=True,
+    verbose=True):
+    """Everything the vectorized reassignment needs that depends only on
+    the calibration, not on the pixel values: which spots get used in
+    each frame, where their windows and resampled images sit, their
+    subpixel shifts, and their flat-field and scan-uniformity weights.
+    Spot 'n' of frame 'z' is row frame_start[z] + n of each array.
+
+    Computed once and saved next to the lake's spot intensities, so
+    every data set processed with the same calibration reuses it."""
+    lake_basename = os.path.splitext(lake_filename)[0]
+    if flat_fielding:
+        intensities_vs_scan_position = get_spot_intensity_table(lake_filename)
+        sources = [lake_basename + '_spot_intensities.npy']
+    else:
+        sources = []
+    parameters = (
+        'reassignment_table', xPix, yPix, zPix, steps,
+        lattice_vectors, offset_vector, shift_vector,
+        new_grid_xrange, new_grid_yrange, window_footprint, scale_factor,
+        flat_fielding, scan_uniformity_correction)
+    table_name = lake_basename + '_reassignment_%s.npz'%(
+        calibration_key(*parameters))
+    if artifact_cache.is_cached([table_name], sources, parameters):
+        if verbose:
+            print "Loading reassignment table:", table_name
+        table = numpy.load(table_name)
+        return dict((k, table[k]) for k in table.files)
+    if verbose:
+        print "Compiling reassignment table:", table_name
+
+    if scan_uniformity_correction:
+        vertex_weights = calculate_scan_uniformity_correction(
+            xPix=xPix, yPix=yPix, zPix=zPix,
+            lattice_vectors=lattice_vectors,
+            shift_vector=shift_vector, offset_vector=offset_vector,
+            verbose=verbose, cache_basename=lake_basename)
+    new_grid_x = numpy.linspace(*new_grid_xrange)
+    new_grid_y = numpy.linspace(*new_grid_yrange)
+    subgrid_footprint, subgrid = get_subgrid(
+        new_grid_x, new_grid_y, window_footprint, scale_factor)
+    table = {'window_corners': [], 'window_shifts': [],
+             'grid_corners': [], 'grid_shifts': [], 'weights': []}
+    frame_start = numpy.zeros(steps + 1, dtype=int)
+    for z in range(steps):
+        lattice_points, i_list, j_list = (
+            generate_lattice(
+                image_shape=(xPix, yPix),
+                lattice_vectors=lattice_vectors,
+                center_pix=offset_vector + get_shift(shift_vector, z),
+                edge_buffer=window_footprint+1,
+                return_i_j=True))
+        lattice_points = numpy.array(lattice_points).reshape(-1, 2)
+        if flat_fielding:
+            with numpy.errstate(divide='ignore'):
+                intensity_normalization = 1.0 / (
+                    intensities_vs_scan_position.lookup(i_list, j_list, z))
+        else:
+            intensity_normalization = numpy.ones(lattice_points.shape[0])
+        if scan_uniformity_correction:
+            intensity_normalization *= vertex_weights[z]
+        spots = get_spot_geometry(
+            lattice_points, window_footprint, (xPix, yPix), scale_factor,
+            new_grid_x, new_grid_y, subgrid_footprint)
+        keep = spots['in_bounds'] & (intensity_normalization > 0)
+        for k in ('window_corners', 'window_shifts',
+                  'grid_corners', 'grid_shifts'):
+            table[k].append(spots[k][keep])
+        table['weights'].append(intensity_normalization[keep])
+        frame_start[z+1] = frame_start[z] + keep.sum()
+    for k in table.keys():
+        table[k] = numpy.concatenate(table[k], axis=0)
+    table['frame_start'] = frame_start
+    numpy.savez(table_name, **table)
+    artifact_cache.store([table_name], sources, parameters)
+    return table
+
+def calibration_key(*args):
+    """A short string that changes whenever any of the arguments do.
+    See artifact_cache.parameter_key()."""
+    return artifact_cache.parameter_key(*args)
+
 def join_enderlein_images(
     data_filenames_list,
     new_grid_xrange, new_grid_yrange,
-    join_widefield_images=True
+    join_widefield_images=True,
+    dtype=numpy.float64, #float32 halves the file size, uint16 quarters it
     ):
+    """Join the reconstructions of a list of data files into one stack,
+    a plane at a time, so the stack never has to fit in memory. To join
+    files while later ones are still being reconstructed, use an
+    Enderlein_Stack_Joiner directly."""
     if len(data_filenames_list) < 1:
         print "No files to join. Skipping..."
         return None
     print "Joining enderlein and widefield images into stack..."
-    enderlein_stack = numpy.zeros(
-        (len(data_filenames_list), new_grid_xrange[2], new_grid_yrange[2]),
-        dtype=numpy.float)
-    if join_widefield_images:
-        widefield_stack = numpy.zeros(
-            (len(data_filenames_list), new_grid_xrange[2], new_grid_yrange[2]),
-            dtype=numpy.float)
-    for i, d in enumerate(data_filenames_list):
+    uint16_scales = None
+    if numpy.dtype(dtype) == numpy.uint16:
+        """Everything's on disk already, so we can find the brightest
+        plane and use the whole 16-bit range"""
+        uint16_scales = {}
+        stack_names = ['enderlein'] + ['widefield']*join_widefield_images
+        for stack_name in stack_names:
+            maximum = max(load_enderlein_plane(
+                d, stack_name, new_grid_xrange, new_grid_yrange).max()
+                          for d in data_filenames_list)
+            uint16_scales[stack_name] = 65535.0 / max(maximum, 1e-12)
+    joiner = Enderlein_Stack_Joiner(
+        data_filenames_list, new_grid_xrange, new_grid_yrange,
+        join_widefield_images=join_widefield_images, dtype=dtype,
+        uint16_scales=uint16_scales, background=False)
+    for i in range(len(data_filenames_list)):
         sys.stdout.write(
             '\rLoading file %i of %i'%(i, len(data_filenames_list)))
         sys.stdout.flush()
-        basename = os.path.splitext(d)[0]
-        enderlein_image_name = basename + '_enderlein_image.raw'
-        widefield_image_name = basename + '_widefield.raw'
-        try:
-            enderlein_stack[i, :, :] = numpy.fromfile(
-                enderlein_image_name, dtype=numpy.float).reshape(
-                new_grid_xrange[2], new_grid_yrange[2])
-        except ValueError:
-            print "\n\nWARNING: the data file:"
-            print enderlein_image_name
-            print "may not be the size it was expected to be.\n\n"
-            raise
-        if join_widefield_images:
-            try:
-                widefield_stack[i, :, :] = numpy.fromfile(
-                    widefield_image_name, dtype=numpy.float).reshape(
-                    new_grid_xrange[2], new_grid_yrange[2])
-            except ValueError:
-                print "\n\nWARNING: the data file:"
-                print widefield_image_name
-                print "may not be the size it was expected to be.\n\n"
-                raise
-
-    stack_basename = os.path.commonprefix(data_filenames_list).rstrip(
-        '0123456789')
-    print "\nStack basename:", stack_basename
-    enderlein_stack.tofile(stack_basename + '_enderlein_stack.raw')
-    simple_tif.array_to_tif(
-        enderlein_stack.astype(numpy.float32),
-        outfile=stack_basename + '_enderlein_stack.tif')
-    if join_widefield_images:
-        widefield_stack.tofile(stack_basename + '_widefield_stack.raw')
-        simple_tif.array_to_tif(
-            widefield_stack.astype(numpy.float32),
-            outfile=stack_basename + '_widefield_stack.tif')
-        w_notes = open(stack_basename + '_widefield_stack.txt', 'wb')
-        w_notes.write("Left/right: %i pixels\r\n"%(widefield_stack.shape[2]))
-        w_notes.write("Up/down: %i pixels\r\n"%(widefield_stack.shape[1]))
-        w_notes.write("Number of images: %i\r\n"%(widefield_stack.shape[0]))
-        w_notes.write("Data type: 64-bit real\r\n")
-        w_notes.write("Byte order: Intel (little-endian))\r\n")
-        w_notes.close()
-    e_notes = open(stack_basename + '_enderlein_stack.txt', 'wb')
-    e_notes.write("Left/right: %i pixels\r\n"%(enderlein_stack.shape[2]))
-    e_notes.write("Up/down: %i pixels\r\n"%(enderlein_stack.shape[1]))
-    e_notes.write("Number of images: %i\r\n"%(enderlein_stack.shape[0]))
-    e_notes.write("Data type: 64-bit real\r\n")
-    e_notes.write("Byte order: Intel (little-endian))\r\n")
-    e_notes.close()
+        joiner.add_file(i)
+    joiner.close()
     print "Done joining."
     return None
 
+def load_enderlein_plane(
+    data_filename, stack_name, new_grid_xrange, new_grid_yrange):
+    """The saved enderlein or widefield image of one data file. These
+    are float64 or float32, depending on how they were reconstructed;
+    the file size tells us which."""
+    basename = os.path.splitext(data_filename)[0]
+    image_name = basename + {'enderlein': '_enderlein_image.raw',
+                             'widefield': '_widefield.raw'}[stack_name]
+    num_pixels = new_grid_xrange[2] * new_grid_yrange[2]
+    if os.path.getsize(image_name) == 4 * num_pixels:
+        dtype = numpy.float32
+    else:
+        dtype = numpy.float64
+    try:
+        return numpy.fromfile(image_name, dtype=dtype).reshape(
+            new_grid_xrange[2], new_grid_yrange[2])
+    except ValueError:
+        print "\n\nWARNING: the data file:"
+        print image_name
+        print "may not be the size it was expected to be.\n\n"
+        raise
+
+class Enderlein_Stack_Joiner:
+    """
+    Writes the enderlein (and optionally widefield) images of a list of
+    data files into raw and simple_tif stacks on disk. Each file's
+    plane goes straight into a memory-mapped stack, so the stacks never
+    have to fit in memory.
+
+    Call add_file(i) as soon as data file 'i' has been reconstructed;
+    with 'background' True, a thread copies it into the stack while
+    you reconstruct the next file. Call close() when you're done.
+
+    'dtype' is float64 (raw stack float64, TIF float32, like we've
+    always saved), float32, or uint16. uint16 stacks are scaled by
+    'uint16_scales' (a dict with a scale for 'enderlein' and
+    'widefield'); if we don't have a scale, we pick one from the first
+    plane, leaving a factor of two of headroom, and clip. The scales
+    are recorded in the stack notes.
+    """
+    def __init__(
+        self, data_filenames_list, new_grid_xrange, new_grid_yrange,
+        join_widefield_images=True, dtype=numpy.float64,
+        uint16_scales=None, background=True):
+        self.data_filenames_list = list(data_filenames_list)
+        self.new_grid_xrange = new_grid_xrange
+        self.new_grid_yrange = new_grid_yrange
+        self.dtype = numpy.dtype(dtype)
+        if self.dtype not in (numpy.float64, numpy.float32, numpy.uint16):
+            raise UserWarning("Stacks can be float64, float32, or uint16")
+        if self.dtype == numpy.float64:
+            tif_dtype = numpy.float32 #Like array_to_tif() always did
+        else:
+            tif_dtype = self.dtype
+        self.uint16_scales = dict(uint16_scales or {})
+        self.stack_basename = os.path.commonprefix(
+            self.data_filenames_list).rstrip('0123456789')
+        print "\nStack basename:", self.stack_basename
+        shape = (len(self.data_filenames_list),
+                 new_grid_xrange[2], new_grid_yrange[2])
+        self.stacks = {}
+        stack_names = ['enderlein'] + ['widefield']*join_widefield_images
+        for stack_name in stack_names:
+            stack_filename = self.stack_basename + '_%s_stack'%(stack_name)
+            self.stacks[stack_name] = (
+                numpy.memmap(stack_filename + '.raw', dtype=self.dtype,
+                             mode='w+', shape=shape),
+                simple_tif.tif_memmap(stack_filename + '.tif',
+                                      shape=shape, dtype=tif_dtype))
+        self.background = background
+        if background:
+            self._queue = Queue.Queue()
+            self._error = None
+            self._thread = threading.Thread(
+                target=self._join_files, name='Stack joiner')
+            self._thread.daemon = True
+            self._thread.start()
+        return None
+
+    def add_file(self, which_file):
+        """Copy the reconstruction of data file number 'which_file'
+        into the stacks"""
+        if self.background:
+            self._queue.put(which_file)
+        else:
+            self._add_file(which_file)
+        return None
+
+    def _add_file(self, which_file):
+        for stack_name, (raw_stack, tif_stack) in self.stacks.items():
+            plane = load_enderlein_plane(
+                self.data_filenames_list[which_file], stack_name,
+                self.new_grid_xrange, self.new_grid_yrange)
+            if self.dtype == numpy.uint16:
+                if stack_name not in self.uint16_scales:
+                    self.uint16_scales[stack_name] = 65535.0 / max(
+                        2 * plane.max(), 1e-12)
+                plane = numpy.round(numpy.clip(
+                    plane * self.uint16_scales[stack_name], 0, 65535))
+            raw_stack[which_file, :, :] = plane
+            tif_stack[which_file, :, :] = plane
+        return None
+
+    def _join_files(self):
+        while True:
+            which_file = self._queue.get()
+            if which_file is None:
+                break
+            if self._error is not None:
+                continue #Don't bother, close() will raise the error
+            try:
+                self._add_file(which_file)
+            except Exception as e:
+                self._error = e
+        return None
+
+    def close(self):
+        """Wait for any files still being added, and write the notes
+        that go with each stack"""
+        if self.background:
+            self._queue.put(None)
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        data_type = {numpy.dtype(numpy.float64): "64-bit real",
+                     numpy.dtype(numpy.float32): "32-bit real",
+                     numpy.dtype(numpy.uint16): "16-bit unsigned"}[self.dtype]
+        for stack_name, (raw_stack, tif_stack) in self.stacks.items():
+            raw_stack.flush()
+            tif_stack.flush()
+            notes = open(
+                self.stack_basename + '_%s_stack.txt'%(stack_name), 'wb')
+            notes.write("Left/right: %i pixels\r\n"%(raw_stack.shape[2]))
+            notes.write("Up/down: %i pixels\r\n"%(raw_stack.shape[1]))
+            notes.write("Number of images: %i\r\n"%(raw_stack.shape[0]))
+            notes.write("Data type: %s\r\n"%(data_type))
+            notes.write("Byte order: Intel (little-endian))\r\n")
+            if self.dtype == numpy.uint16:
+                notes.write("Scale: %r counts per unit intensity\r\n"%(
+                    self.uint16_scales.get(stack_name, 0)))
+            notes.close()
+        return None
+
 def get_data_locations():
     """Assumes that hot_pixels.txt and background.raw are in the same
     directory as array_illumination.py"""
@@ -0,0 +1,186 @@
+import os, time, json, hashlib
+import numpy
+"""
+Derived data (FFTs, calibrations, reconstructions) is slow to compute,
+and we save it next to the raw data it came from. Checking if a
+derived file exists isn't enough to know if we can reuse it: the raw
+data might have changed, or we might have changed a parameter.
+
+So, every time we save an 'artifact' (one or more derived files that
+get computed together), we also save a small manifest next to it,
+'<first artifact file>.manifest', recording the size and modification
+time of every source file, and a hash of every parameter. We only
+reuse an artifact if its manifest matches.
+
+Derived data can add up. If 'max_directory_bytes' is set, saving an
+artifact deletes the least recently used artifacts in the same
+directory until that directory's artifacts fit. Reconstructions are
+artifacts too, so leave this as None unless you really mean it. An
+artifact was last used when its manifest was last modified.
+"""
+max_directory_bytes = None
+
+def parameter_key(*args):
+    """A short string that changes whenever any of the arguments do.
+    Handles arrays, lists, tuples, dicts and anything with a sensible
+    repr()."""
+    h = hashlib.md5()
+    def update(a):
+        if isinstance(a, numpy.ndarray):
+            h.update(repr((a.shape, a.dtype.str)))
+            h.update(numpy.ascontiguousarray(a).tostring())
+        elif isinstance(a, (list, tuple)):
+            h.update('(')
+            for x in a:
+                update(x)
+            h.update(')')
+        elif isinstance(a, dict):
+            h.update('{')
+            for k in sorted(a.keys()):
+                update(k)
+                update(a[k])
+            h.update('}')
+        else:
+            h.update(repr(a) + ',')
+    update(args)
+    return h.hexdigest()[:12]
+
+def source_id(filename, content_hash=False):
+    """How we recognize a source file. Size and modification time are
+    cheap; 'content_hash' also hashes the contents, which is only worth
+    it for small files that might get rewritten with the same size
+    within the timestamp resolution. None if the file doesn't exist."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    file_id = [stat.st_size, stat.st_mtime]
+    if content_hash:
+        h = hashlib.md5()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), ''):
+                h.update(chunk)
+        file_id.append(h.hexdigest())
+    return file_id
+
+def manifest_name(artifact_names):
+    return artifact_names[0] + '.manifest'
+
+def load_manifest(artifact_names):
+    try:
+        with open(manifest_name(artifact_names), 'rb') as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+def save_manifest(artifact_names, manifest):
+    """Write to a temporary file first, so nobody reads half a manifest.
+    Worker processes might save the same manifest at once, so each
+    gets its own temporary file."""
+    temp_name = manifest_name(artifact_names) + '.%i.temp'%(os.getpid())
+    with open(temp_name, 'wb') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    if os.name != 'nt':
+        os.rename(temp_name, manifest_name(artifact_names)) #Atomic
+        return None
+    """os.rename won't replace an existing file on Windows, so remove
+    it first. Another process might be doing the same, so retry."""
+    for attempt in range(10):
+        try:
+            if os.path.exists(manifest_name(artifact_names)):
+                os.remove(manifest_name(artifact_names))
+            os.rename(temp_name, manifest_name(artifact_names))
+            return None
+        except OSError:
+            if attempt == 9:
+                raise
+            time.sleep(0.01 * (attempt + 1))
+
+def is_cached(artifact_names, sources, parameters, hashed_sources=()):
+    """
+    True if every file in 'artifact_names' exists, and was saved by
+    store() (maybe along with others) with the same 'sources'
+    (unchanged since) and 'parameters'. Marks the artifact as recently
+    used.
+    """
+    manifest = load_manifest(artifact_names)
+    if manifest is None:
+        return False
+    for a in artifact_names:
+        if os.path.basename(a) not in manifest['artifacts']:
+            return False #Saved without it; a superset is fine, though
+    if manifest['parameters'] != parameter_key(parameters):
+        return False
+    if manifest['sources'] != [
+        [os.path.basename(s), source_id(s, s in hashed_sources)]
+        for s in sources]:
+        return False
+    for a in artifact_names:
+        if source_id(a) != manifest['artifact_ids'][os.path.basename(a)]:
+            return False #Missing, or changed since we made it
+    try:
+        os.utime(manifest_name(artifact_names), None) #Recently used
+    except OSError:
+        pass #Somebody else is replacing it; they'll touch it
+    return True
+
+def store(artifact_names, sources, parameters, hashed_sources=()):
+    """
+    Call this right after saving the files in 'artifact_names', which
+    were computed from the files in 'sources' using 'parameters'
+    (anything parameter_key() can hash). Sources in 'hashed_sources'
+    are recognized by their contents, too.
+    """
+    manifest = {
+        'artifacts': [os.path.basename(a) for a in artifact_names],
+        'artifact_ids': dict((os.path.basename(a), source_id(a))
+                             for a in artifact_names),
+        'sources': [[os.path.basename(s), source_id(s, s in hashed_sources)]
+                    for s in sources],
+        'parameters': parameter_key(parameters),
+        'created': time.time(),
+        }
+    for a, a_id in manifest['artifact_ids'].items():
+        if a_id is None:
+            raise UserWarning("Can't cache a missing artifact: " + a)
+    save_manifest(artifact_names, manifest)
+    if max_directory_bytes is not None:
+        evict(os.path.dirname(os.path.abspath(artifact_names[0])),
+              max_directory_bytes, keep=artifact_names)
+    return None
+
+def evict(directory, max_bytes, keep=(), verbose=True):
+    """Delete the least recently used artifacts in 'directory' (and
+    their manifests) until the rest add up to 'max_bytes' or less.
+    Never deletes the artifact whose files are in 'keep'."""
+    keep = set(os.path.normcase(os.path.abspath(k)) for k in keep)
+    artifacts = []
+    for name in os.listdir(directory):
+        if not name.endswith('.manifest'):
+            continue
+        try:
+            with open(os.path.join(directory, name), 'rb') as f:
+                manifest = json.load(f)
+            last_used = os.path.getmtime(os.path.join(directory, name))
+        except (IOError, OSError, ValueError):
+            continue
+        files = [os.path.join(directory, a) for a in manifest['artifacts']]
+        size = sum(os.path.getsize(a) for a in files if os.path.exists(a))
+        kept = any(os.path.normcase(os.path.abspath(a)) in keep for a in files)
+        artifacts.append((last_used, kept, size,
+                          os.path.join(directory, name), files))
+    total_bytes = sum(a[2] for a in artifacts)
+    for last_used, kept, size, manifest_filename, files in sorted(artifacts):
+        if total_bytes <= max_bytes:
+            break
+        if kept:
+            continue
+        if verbose:
+            print "Evicting least recently used:", ', '.join(
+                os.path.basename(a) for a in files)
+        os.remove(manifest_filename)
+        for a in files:
+            if os.path.exists(a):
+                os.remove(a)
+        total_bytes -= size
+    return total_bytes
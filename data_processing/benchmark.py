@@ -0,0 +1,331 @@
+import os, sys, time, glob, json, platform
+import numpy
+from scipy.ndimage import gaussian_filter
+import array_illumination, simple_tif, decon
+try:
+    import resource
+except ImportError: #Windows
+    resource = None
+"""
+How fast is our data processing? Run this file to write a synthetic
+MSIM-sized stack to disk, and see how many frames per second we can
+load from it. Then we generate a synthetic lake, background and sample,
+run the whole calibration and reconstruction on them, and save how
+long each stage took (and how much memory it needed) as JSON. Pass the
+name of an old results file, and we'll compare against it:
+
+  python benchmark.py old_benchmark_results.json
+"""
+
+def make_synthetic_stack(
+    filename, xPix=480, yPix=480, zPix=224, mean_counts=100, seed=0):
+    """Write a seeded stack of Poisson noise, as 16-bit raw or TIF
+    (depending on the file extension)"""
+    random = numpy.random.RandomState(seed)
+    data = random.poisson(
+        mean_counts, size=(zPix, xPix, yPix)).astype(numpy.uint16)
+    if os.path.splitext(filename)[1] in ('.tif', '.tiff'):
+        simple_tif.array_to_tif(data, outfile=filename)
+    else:
+        data.tofile(filename)
+    return None
+
+def load_image_slice_reopening(filename, xPix, yPix, preframes=0,
+                               which_slice=0):
+    """How load_image_slice() used to work: open the file, reparse the
+    TIF header, seek, and read, for every frame."""
+    if os.path.splitext(filename)[1] in ('.tif', '.tiff'):
+        info = simple_tif.get_tif_info(filename)
+        xPix = info['length']
+        yPix = info['width']
+        offset = info['offset']
+    else:
+        offset = 0
+    data_file = open(filename, 'rb')
+    data_file.seek(offset + (which_slice + preframes) * xPix*yPix*2)
+    return numpy.fromfile(
+        data_file, dtype=numpy.uint16, count=xPix*yPix).reshape(xPix, yPix)
+
+def benchmark_frame_loading(filename, xPix=480, yPix=480, prefetch=10):
+    """Frames per second for loading (and converting to float, like the
+    reconstruction does) every frame of a stack."""
+    results = {}
+    num_frames = array_illumination.Image_Stack_Reader(
+        filename, xPix=xPix, yPix=yPix).zPix
+    start = time.time()
+    for z in range(num_frames):
+        load_image_slice_reopening(
+            filename, xPix, yPix, which_slice=z).astype(float)
+    results['reopening'] = num_frames / (time.time() - start)
+    for p in (0, prefetch):
+        start = time.time()
+        reader = array_illumination.Image_Stack_Reader(
+            filename, xPix=xPix, yPix=yPix, prefetch=p)
+        for z in range(num_frames):
+            reader.get_frame(z).astype(float)
+        reader.close()
+        results['reader, prefetch=%i'%(p)] = num_frames / (time.time() - start)
+    return results
+
+def benchmark_reconstruction_dtype(tolerance=1e-4, **reconstruction_arguments):
+    """Reconstruct the same data (keyword arguments for
+    array_illumination.enderlein_image_parallel()) in float64 and in
+    float32, and check that float32 is good enough: no pixel may differ
+    by more than 'tolerance' times the brightest float64 pixel. Returns
+    the worst relative difference for each image. Either one might
+    come from the cache, so this doesn't time them; the 'reconstruction'
+    stage of benchmark_reconstruction() does."""
+    results, images = {}, {}
+    for dtype in (numpy.float64, numpy.float32):
+        reconstruction_arguments['dtype'] = dtype
+        images[dtype] = array_illumination.enderlein_image_parallel(
+            **reconstruction_arguments)
+    for k in images[numpy.float64].keys():
+        reference = images[numpy.float64][k]
+        difference = numpy.abs(
+            images[numpy.float32][k].astype(numpy.float64) - reference).max()
+        results[k + ' difference'] = difference / max(
+            numpy.abs(reference).max(), 1e-12)
+        if results[k + ' difference'] > tolerance:
+            raise UserWarning(
+                "The float32 %s differs from float64 by %0.2e (relative)"%(
+                    k, results[k + ' difference']))
+    return results
+
+def benchmark_block_deconvolution(
+    directory='benchmark_data', shape=(16, 64, 64), psf_sigma=(2., 1.5, 1.5),
+    block_shape=(16, 38, 38), block_halo=(8, 24, 24), num_iterations=10,
+    tolerance=1e-4, seed=0):
+    """Deconvolve a seeded, synthetic volume with a measured-style
+    (data) PSF twice: whole, and in blocks (see the 'block_shape'
+    argument of decon.richardson_lucy_deconvolution()). Check that no
+    pixel differs by more than 'tolerance' times the brightest pixel
+    of the whole-volume estimate, including within a PSF of the edges
+    of the volume, where the two see the volume's boundary differently
+    if anything's wrong. Returns the worst relative differences at the
+    edges and inside."""
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    random = numpy.random.RandomState(seed)
+    psf_radius = [int(numpy.ceil(2 * s)) for s in psf_sigma]
+    psf = numpy.exp(-sum(
+        x**2 / (2. * s**2) for x, s in zip(
+            numpy.mgrid[tuple(slice(-r, r + 1) for r in psf_radius)],
+            psf_sigma)))
+    sample = 100 * random.random_sample(shape)**8
+    image = random.poisson(
+        gaussian_filter(sample, psf_sigma, mode='constant') + 1)
+    estimates = {}
+    for name, blocks in (('whole', None), ('blocks', block_shape)):
+        estimates[name], history = decon.richardson_lucy_deconvolution(
+            image_data=image.astype(numpy.float64), psf_data=psf,
+            num_iterations=num_iterations,
+            output_name=os.path.join(directory, 'deconvolution_%s.raw'%(
+                name)),
+            block_shape=blocks, block_halo=block_halo, verbose=False)
+    difference = numpy.abs(numpy.asarray(estimates['blocks']) -
+                           estimates['whole']) / estimates['whole'].max()
+    inside = tuple(slice(r, -r) for r in psf_radius)
+    edges = numpy.ones(shape, dtype=bool)
+    edges[inside] = False
+    results = {'edge difference': difference[edges].max(),
+               'interior difference': difference[inside].max()}
+    for k, v in results.items():
+        if v > tolerance:
+            raise UserWarning(
+                ("Block deconvolution's %s from the whole volume's is" +
+                 " %0.2e (relative)")%(k, v))
+    return results
+
+def render_spots(image_shape, spot_positions, sigma):
+    """Sum of Gaussian spots, one for each (x, y) in 'spot_positions'.
+    Gaussians are separable, so this is one matrix product."""
+    spot_positions = numpy.asarray(spot_positions, dtype=float).reshape(-1, 2)
+    profiles = [numpy.exp(-(numpy.arange(n).reshape(1, -1) -
+                            spot_positions[:, axis].reshape(-1, 1))**2 /
+                          (2. * sigma**2))
+                for axis, n in enumerate(image_shape)]
+    return numpy.dot(profiles[0].T, profiles[1])
+
+def make_synthetic_dataset(
+    directory, xPix=256, yPix=256, steps=224,
+    lattice_vectors=None, shift_vector=None, offset_vector=None,
+    spot_sigma=1., emission_sigma=1., peak_counts=2000,
+    background_counts=100, num_hot_pixels=20, seed=0):
+    """
+    Write seeded, synthetic 'lake.raw', 'background.raw' and
+    'sample.raw' 16-bit stacks to 'directory', scanned like the galvo
+    MSIM ('1d' scan type), plus a matching 'hot_pixels.txt'. Returns
+    the true lattice vectors, shift vector and offset vector.
+    """
+    random = numpy.random.RandomState(seed)
+    if lattice_vectors is None:
+        lattice_vectors = [numpy.array((11.3, 1.2)), numpy.array((4.6, 10.1))]
+        lattice_vectors.append(-(lattice_vectors[0] + lattice_vectors[1]))
+    if shift_vector is None:
+        """Cross the unit cell in a slanted raster, 'rows' lines"""
+        rows = int(numpy.sqrt(steps))
+        shift_vector = (lattice_vectors[0] +
+                        rows * lattice_vectors[1]) / float(steps)
+    if offset_vector is None:
+        offset_vector = numpy.array((xPix / 2. + 0.3, yPix / 2. - 0.2))
+    hot_pixels = numpy.transpose((random.randint(0, yPix, num_hot_pixels),
+                                  random.randint(0, xPix, num_hot_pixels)))
+    with open(os.path.join(directory, 'hot_pixels.txt'), 'wb') as f:
+        f.write(', '.join('%i, %i'%(y, x) for y, x in hot_pixels))
+    sample = random.random_sample((xPix, yPix))**4
+    files = dict((name, open(os.path.join(directory, name + '.raw'), 'wb'))
+                 for name in ('lake', 'background', 'sample'))
+    for z in range(steps):
+        lattice_points = array_illumination.generate_lattice(
+            (xPix, yPix), lattice_vectors,
+            center_pix=offset_vector + z * shift_vector, edge_buffer=0)
+        illumination = render_spots((xPix, yPix), lattice_points, spot_sigma)
+        expected_counts = {
+            'lake': peak_counts * gaussian_filter(illumination, emission_sigma),
+            'background': numpy.zeros((xPix, yPix)),
+            'sample': peak_counts * gaussian_filter(
+                illumination * sample, emission_sigma)}
+        for name, counts in expected_counts.items():
+            counts += background_counts
+            counts[hot_pixels[:, 1], hot_pixels[:, 0]] += 10 * peak_counts
+            numpy.clip(random.poisson(counts), 0, 65535
+                       ).astype(numpy.uint16).tofile(files[name])
+    for f in files.values():
+        f.close()
+    return lattice_vectors, shift_vector, offset_vector
+
+def peak_memory():
+    """Peak resident memory (in MB) of this process, and of the
+    largest of its finished child processes, so far. None if we can't
+    tell (Windows)."""
+    if resource is None:
+        return None, None
+    if sys.platform == 'darwin':
+        scale = 2.0**-20 #Bytes
+    else:
+        scale = 2.0**-10 #Kilobytes
+    return tuple(scale * resource.getrusage(who).ru_maxrss
+                 for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN))
+
+def benchmark_reconstruction(
+    directory='benchmark_data', xPix=256, yPix=256, steps=224,
+    num_processes=1, dtype=numpy.float64, tile_rows=None, extent=10,
+    num_spikes=60, num_harmonics=2, seed=0, output_filename=None,
+    dtype_tolerance=None):
+    """
+    Generate a synthetic dataset in 'directory', and run the lattice
+    detection, the flat-field calibration and the reconstruction on
+    it, timing each. Anything left over from earlier runs in
+    'directory' gets deleted first, so nothing comes from a cache.
+    If 'dtype_tolerance' isn't None, also check that a float32
+    reconstruction matches float64 that well (see
+    benchmark_reconstruction_dtype()). Returns the results, and saves
+    them as JSON.
+    """
+    if not os.path.exists(directory):
+        os.mkdir(directory)
+    array_illumination.close_image_stack_readers() #Windows won't delete
+    for name in ('lake', 'background', 'sample', 'hot_pixels'):
+        for f in glob.glob(os.path.join(directory, name + '*')):
+            os.remove(f)
+    lake, background, sample = [os.path.join(directory, name + '.raw')
+                                for name in ('lake', 'background', 'sample')]
+    results = {
+        'settings': {'xPix': xPix, 'yPix': yPix, 'steps': steps,
+                     'num_processes': num_processes,
+                     'dtype': numpy.dtype(dtype).name,
+                     'tile_rows': tile_rows, 'seed': seed},
+        'versions': {'python': platform.python_version(),
+                     'numpy': numpy.__version__,
+                     'platform': platform.platform()},
+        'stages': {},
+        }
+    def timed(stage, function, *args, **kwargs):
+        start = time.time()
+        output = function(*args, **kwargs)
+        seconds = time.time() - start
+        peak_rss, peak_child_rss = peak_memory()
+        results['stages'][stage] = {
+            'seconds': seconds, 'frames_per_second': steps / seconds,
+            'peak_rss_mb': peak_rss, 'peak_child_rss_mb': peak_child_rss}
+        print "%s: %0.2f s, %0.1f frames/s"%(stage, seconds, steps / seconds)
+        return output
+
+    print "Generating synthetic data in", directory
+    timed('generate', make_synthetic_dataset, directory, xPix=xPix,
+          yPix=yPix, steps=steps, seed=seed)
+    lattice_vectors, shift_vector, offset_vector = timed(
+        'lattice', array_illumination.get_lattice_vectors,
+        filename_list=[lake], xPix=xPix, yPix=yPix, zPix=steps,
+        extent=extent, num_spikes=num_spikes, num_harmonics=num_harmonics,
+        scan_type='1d', record_parameters=False)
+    timed('spot intensities',
+          array_illumination.spot_intensity_vs_scan_position,
+          lake, xPix, yPix, steps, 0,
+          lattice_vectors, shift_vector, offset_vector,
+          background, steps, window_size=10)
+    reconstruction_arguments = {
+        'data_filename': sample, 'lake_filename': lake,
+        'background_filename': background,
+        'xPix': xPix, 'yPix': yPix, 'zPix': steps, 'steps': steps,
+        'preframes': 0, 'lattice_vectors': lattice_vectors,
+        'offset_vector': offset_vector, 'shift_vector': shift_vector,
+        'new_grid_xrange': (0, xPix-1, 2*xPix),
+        'new_grid_yrange': (0, yPix-1, 2*yPix),
+        'num_processes': num_processes, 'tile_rows': tile_rows,
+        'verbose': False}
+    timed('reconstruction', array_illumination.enderlein_image_parallel,
+          dtype=dtype, **reconstruction_arguments)
+    if dtype_tolerance is not None:
+        results['float32 differences'] = benchmark_reconstruction_dtype(
+            tolerance=dtype_tolerance, **reconstruction_arguments)
+        print "float32 vs. float64:", ', '.join(
+            "%s %0.2e"%(k, v) for k, v in sorted(
+                results['float32 differences'].items()))
+    if output_filename is None:
+        output_filename = os.path.join(directory, 'benchmark_results.json')
+    with open(output_filename, 'wb') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+    print "Results saved in", output_filename
+    return results
+
+def load_benchmark(filename):
+    with open(filename, 'rb') as f:
+        return json.load(f)
+
+def compare_benchmarks(reference, results, max_slowdown=1.2):
+    """Which stages took more than 'max_slowdown' times as long as
+    they did in the 'reference' results (from load_benchmark())?"""
+    if reference['settings'] != results['settings']:
+        print "WARNING: comparing benchmarks with different settings"
+    slower = []
+    for stage in sorted(results['stages'].keys()):
+        if stage not in reference['stages']:
+            continue
+        ratio = (results['stages'][stage]['seconds'] /
+                 reference['stages'][stage]['seconds'])
+        print " %s: %0.2fx the reference time"%(stage, ratio)
+        if ratio > max_slowdown:
+            slower.append(stage)
+    return slower
+
+if __name__ == '__main__':
+    xPix, yPix, zPix = 480, 480, 224
+    for filename in ('benchmark_stack.raw', 'benchmark_stack.tif'):
+        print "Writing", filename
+        make_synthetic_stack(filename, xPix=xPix, yPix=yPix, zPix=zPix)
+        results = benchmark_frame_loading(filename, xPix=xPix, yPix=yPix)
+        for k in sorted(results.keys()):
+            print " %s: %0.1f frames/s"%(k, results[k])
+        os.remove(filename)
+    if len(sys.argv) > 1: #Load it first, in case we're about to overwrite it
+        reference = load_benchmark(sys.argv[1])
+    results = benchmark_reconstruction(dtype_tolerance=1e-4)
+    block_differences = benchmark_block_deconvolution()
+    print "Blocks vs. whole volume:", ', '.join(
+        "%s %0.2e"%(k, v) for k, v in sorted(block_differences.items()))
+    if len(sys.argv) > 1:
+        slower = compare_benchmarks(reference, results)
+        if slower:
+            print "Slower than the reference:", ', '.join(slower)
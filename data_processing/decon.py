@@ -1,9 +1,12 @@
-import os, sys, time, ConfigParser
+import os, sys, time, ConfigParser, threading, Queue
+import multiprocessing, itertools, glob, ctypes
 import numpy
 import Tkinter as Tk, tkFileDialog, tkSimpleDialog
 from scipy.ndimage import gaussian_filter, center_of_mass
-from scipy.fftpack import fftn, ifftn, fftshift
-from simple_tif import tif_to_array, array_to_tif
+from scipy.fftpack import ifftshift
+from simple_tif import tif_to_array, array_to_tif, tif_memmap, get_tif_info
+from fftconvolve_customized import best_fft_shape
+import artifact_cache
 
 if sys.platform.startswith('win'):
     clock = time.clock
@@ -25,6 +28,14 @@ def richardson_lucy_deconvolution(
     tk_master=None,
     which_channel = 'all',
     truncate_negative_values=False,
+    acceleration=None,
+    convergence_threshold=None,
+    convergence_measure='relative_change',
+    save_every=1,
+    background_saving=True,
+    block_shape=None,
+    block_halo=None,
+    num_processes=1,
     ):
     """Deconvolve a 2D or 3D image using the Richardson-Lucy algorithm
     from an image and a point-spread funciton (PSF)
@@ -34,40 +45,94 @@ def richardson_lucy_deconvolution(
     
     'psf_type': 'gaussian', a numpy array, a filename, or None to have
     the user select a PSF data file using the graphical interface.
+    With PSF data, the object is assumed to be zero outside the image;
+    with a Gaussian PSF, a mirror image of what's inside it.
 
     num_iterations: The number of times to iteratively refine the
-    object estimate.
+    object estimate. If 'convergence_threshold' is set, the most times.
 
     modify_psf: Boolean. If True, then both the PSF and the image data
     are modified on every iteration. If false, then tne PSF is assumed
     to be exact, and only the image data is modified.
+
+    acceleration: None, or 'biggs_andrews' to extrapolate each
+    iteration along the direction of the last two (Biggs and Andrews,
+    Applied Optics 36, 1997). Usually converges in far fewer
+    iterations.
+
+    convergence_threshold: None to always do 'num_iterations'
+    iterations. Otherwise, stop a channel early once
+    'convergence_measure' changes by less than this:
+     'relative_change': total absolute change in the estimate, divided
+      by the total of the estimate.
+     'i_divergence': relative decrease of the I-divergence between the
+      image and the blurred estimate, the quantity Richardson-Lucy
+      minimizes.
+
+    save_every: Save the estimate every this many iterations, or None
+    to only save the final result. The history file is preallocated
+    and filled in one slice per iteration either way.
+
+    background_saving: If True, save on a separate thread, so the
+    next iteration doesn't wait on the disk.
+
+    block_shape: None to deconvolve each channel in one piece.
+    Otherwise, for volumes too big for memory: a tuple with one block
+    size per dimension. The image file is memory-mapped, each block is
+    deconvolved along with a halo as wide as the PSF, and the block
+    (without its halo) goes straight into a memory-mapped estimate
+    file. No history is kept, and we return (estimate, None). Every
+    block does exactly 'num_iterations' iterations; blocks stopping
+    at different iterations would leave seams, so
+    'convergence_threshold' must be None.
+
+    block_halo: None for a halo as wide as the PSF reaches, or a tuple
+    with one halo width per dimension. Each iteration spreads errors
+    from the edge of the halo a little further in, so with many
+    iterations a wider halo is more accurate.
+
+    num_processes: How many worker processes deconvolve blocks at
+    once, if 'block_shape' is set.
     """
+    assert acceleration in (None, 'biggs_andrews')
+    assert convergence_measure in ('relative_change', 'i_divergence')
+    if block_shape is not None and convergence_threshold is not None:
+        raise UserWarning(
+            "'convergence_threshold' can't be used with 'block_shape';" +
+            " each block would stop after a different number of" +
+            " iterations, leaving seams between them.")
+    iteration_arguments = {
+        'acceleration': acceleration,
+        'convergence_threshold': convergence_threshold,
+        'convergence_measure': convergence_measure}
 
     """
     Select and load image data.
     """
 
-    if tk_master is None:
+    if tk_master is None and (
+        psf_data is None or num_iterations is None or
+        (psf_sigma is None and psf_data == 'gaussian')):
+        """Only make a window if we'll need to ask the user something"""
         tk_master = Tk.Tk()
         tk_master.withdraw()
 
     config = get_config()
     image_data, output_name, num_channels = image_data_as_array(
         image_data, image_data_shape, image_data_dtype,
-        output_name, verbose, config)
+        output_name, verbose, config, memmap=block_shape is not None)
     if image_data == 'cancelled':
         print "Deconvolution cancelled.\n"
         return None
     else:
         if image_data.min() < 0:
-            if truncate_negative_values:
-                image_data[image_data < 0] = 0
-            else:
+            if not truncate_negative_values:
                 raise UserWarning(
                     "Image data has negative elements!\n" +
                     "This violates the assumptions of Richardson-Lucy" +
                     " deconvolution.")
-        image_data = 1e-12 + image_data.astype(numpy.float64)
+            elif block_shape is None: #Blocks truncate as they're loaded
+                image_data[image_data < 0] = 0
     output_basename, output_extension = os.path.splitext(output_name)
     estimate_name = output_basename + '_estimate' + output_extension
     history_name = output_basename + '_history' + output_extension
@@ -102,8 +167,6 @@ def richardson_lucy_deconvolution(
             return None
         else:
             psf_data = 1e-12 + psf_data.astype(numpy.float64)
-        psf_data = condition_psf_data(
-            psf_data, new_shape=image_data.shape)
 
     if num_iterations is None:
         try:
@@ -122,19 +185,20 @@ def richardson_lucy_deconvolution(
         save_config(config)
         "Number of iterations to perform:", num_iterations
 
-    if psf_data != 'gaussian':
-        print "Precomputing..."
-        start = clock()
-        psf_data_fft = fftn(psf_data)
-        psf_data_fft_r = psf_data_fft[::-1, ::-1, ::-1]
-        end = clock()
-        print "Done precomputing. Time:", end - start
-
     assert which_channel == 'all' or which_channel < num_channels
+    full_image_data = image_data
     if num_channels > 1 and which_channel != 'all':
         """Pick out just one color channel to deconvolve"""
+        input_channels = [(which_channel, num_channels)]
         image_data = image_data[which_channel::num_channels, :, :]
         num_channels = 1
+    else:
+        input_channels = [(c, num_channels) for c in range(num_channels)]
+    if block_shape is None:
+        """Only copy the channels we deconvolve, and add in place, so
+        there's no second full-size temporary"""
+        image_data = image_data.astype(numpy.float64)
+        image_data += 1e-12
 
     if which_channel == 'all' and num_channels > 1:
         data_slices = image_data.shape[0] // num_channels
@@ -145,46 +209,656 @@ def richardson_lucy_deconvolution(
         history_slices = None
         channels = None
 
+    if block_shape is not None:
+        estimate = deconvolve_blocks(
+            full_image_data, input_channels, estimate_name, block_shape,
+            psf_data, psf_sigma, num_iterations,
+            halo=block_halo, num_processes=num_processes,
+            truncate_negative_values=truncate_negative_values,
+            slices=data_slices, channels=channels,
+            iteration_arguments=iteration_arguments)
+        return (estimate, None)
+
+    print "Precomputing..."
+    start = clock()
+    blur_arguments = get_blur_arguments(
+        psf_data, psf_sigma, image_data[0::num_channels, :, :].shape,
+        cache_directory=os.path.dirname(os.path.abspath(output_name)))
+    end = clock()
+    print "Done precomputing. Time:", end - start
+
     full_estimate = image_data.copy()
-    history = numpy.zeros((num_channels * (num_iterations + 1),) +
-                          (image_data.shape[1:]))
+    history_shape = ((num_channels * (num_iterations + 1),) +
+                     (image_data.shape[1:]))
+    if output_extension in ('.tif', '.tiff'):
+        history = tif_memmap(
+            history_name, shape=history_shape, dtype=numpy.float32,
+            slices=history_slices, channels=channels)
+    else: #Use raw binary
+        history = numpy.memmap(history_name, dtype=numpy.float64,
+                               mode='w+', shape=history_shape)
+    checkpoints = CheckpointWriter(
+        estimate_name, history, slices=data_slices, channels=channels,
+        background=background_saving)
+
+    def iteration_finished(i, converged):
+        """Record the history, and save a checkpoint if it's time"""
+        history[(i+1)*num_channels + c, :, :] = estimate.max(axis=0) / (
+            estimate.max(axis=0).mean())
+        if converged:
+            history[(i+2)*num_channels + c::num_channels, :, :] = (
+                history[(i+1)*num_channels + c, :, :])
+        checkpoints.up_to_date = False
+        if save_every is not None and (i + 1) % save_every == 0:
+            print "Saving..."
+            checkpoints.save(full_estimate)
+        sys.stdout.flush()
+        return None
+
     for c in range(num_channels):
         estimate = full_estimate[c::num_channels, :, :]
         image_channel = image_data[c::num_channels, :, :]
         history[c, :, :] = (estimate.max(axis=0) /
                             estimate.max(axis=0).mean())
+        richardson_lucy_iterations(
+            estimate, image_channel, num_iterations, blur_arguments,
+            iteration_callback=iteration_finished, **iteration_arguments)
+    if not checkpoints.up_to_date:
+        print "Saving..."
+        checkpoints.save(full_estimate)
+    checkpoints.close()
+    print "Done saving."
+    return (full_estimate, history)
 
-        for i in range(num_iterations):
+def get_blur_arguments(psf_data, psf_sigma, shape, cache_directory=None):
+    """What richardson_lucy_update() needs to blur a 'shape' array"""
+    if psf_data == 'gaussian':
+        return {'psf_sigma': psf_sigma}
+    otf, fft_shape = get_transfer_function(
+        psf_data, shape, cache_directory=cache_directory)
+    """Light from near the edges of the estimate partly lands outside
+    the image, so each pixel's correction needs normalizing by how much
+    of its light the image sees"""
+    normalization = fft_convolve(
+        numpy.ones(shape), otf, fft_shape, adjoint=True)
+    return {'otf': otf, 'fft_shape': fft_shape,
+            'normalization': normalization}
+
+def richardson_lucy_update(
+    estimate, image_channel,
+    psf_sigma=None, otf=None, fft_shape=None, normalization=None):
+    """Returns the next estimate, and the blurred current estimate.
+    Blurs with a Gaussian if 'psf_sigma' is set, otherwise with the
+    transfer function from get_transfer_function()."""
+    if psf_sigma is not None:
+        blurred_estimate = gaussian_filter(estimate, sigma=psf_sigma)
+        correction = gaussian_filter((image_channel /
+                                      blurred_estimate), sigma=psf_sigma)
+    else:
+        blurred_estimate = fft_convolve(estimate, otf, fft_shape)
+        correction = fft_convolve(
+            image_channel / blurred_estimate, otf, fft_shape,
+            adjoint=True)
+        if normalization is not None:
+            correction /= normalization
+    correction *= estimate
+    return correction, blurred_estimate
+
+def richardson_lucy_iterations(
+    estimate, image_channel, num_iterations, blur_arguments,
+    acceleration=None, convergence_threshold=None,
+    convergence_measure='relative_change', iteration_callback=None,
+    verbose=True):
+    """Refine 'estimate' in place, for at most 'num_iterations'
+    iterations (see richardson_lucy_deconvolution() for the options).
+    Calls iteration_callback(i, converged) after each iteration.
+    Returns the number of iterations done."""
+    prediction = estimate.copy()
+    previous_change = None
+    previous_divergence = None
+    converged = False
+
+    for i in range(num_iterations):
+        if verbose:
             print "Computing iteration %i..."%i
-            start = clock()
-            if psf_data == 'gaussian':
-                blurred_estimate = gaussian_filter(estimate, sigma=psf_sigma)
-                estimate *= gaussian_filter((image_channel /
-                                             blurred_estimate), sigma=psf_sigma)
+        start = clock()
+        new_estimate, blurred_estimate = richardson_lucy_update(
+            prediction, image_channel, **blur_arguments)
+        if convergence_threshold is not None:
+            if convergence_measure == 'relative_change':
+                measure = (numpy.abs(new_estimate - estimate).sum() /
+                           estimate.sum())
+                converged = measure < convergence_threshold
             else:
-                blurred_estimate = ifftn(psf_data_fft * fftn(estimate)).real
-                estimate *= ifftn(psf_data_fft_r * fftn(image_channel /
-                                                        blurred_estimate)
-                                  ).real
-            end = clock()
+                """The divergence of the estimate we just blurred"""
+                measure = (image_channel *
+                           numpy.log(image_channel / blurred_estimate) -
+                           image_channel + blurred_estimate
+                           ).sum() / image_channel.sum()
+                if previous_divergence is not None:
+                    converged = (abs(previous_divergence - measure) <
+                                 convergence_threshold *
+                                 abs(previous_divergence))
+                previous_divergence = measure
+            if verbose:
+                print " Convergence (%s): %0.3g"%(convergence_measure, measure)
+        if acceleration == 'biggs_andrews':
+            """
+            Extrapolate along the last step, by as much as the last
+            two steps agree.
+            """
+            change = new_estimate - prediction
+            if previous_change is None:
+                alpha = 0
+            else:
+                alpha = ((change * previous_change).sum() /
+                         max((previous_change**2).sum(), 1e-30))
+                alpha = min(max(alpha, 0), 1)
+            previous_change = change
+            prediction = new_estimate + alpha * (new_estimate - estimate)
+            numpy.clip(prediction, 1e-12, numpy.inf, out=prediction)
+            if verbose:
+                print " Acceleration: %0.3f"%alpha
+        else:
+            prediction = new_estimate
+        estimate[:] = new_estimate
+        end = clock()
+        if verbose:
             print " Time:", end - start
             print " Done computing."
-            print "Saving..."
-            history[(i+1)*num_channels + c, :, :] = estimate.max(axis=0) / (
-                estimate.max(axis=0).mean())
-            if output_extension in ('.tif', '.tiff'):
-                array_to_tif(
-                    full_estimate.astype(numpy.float32), outfile=estimate_name,
-                    slices=data_slices, channels=channels)
-                array_to_tif(
-                    history.astype(numpy.float32), outfile=history_name,
-                    slices=history_slices, channels=channels)
-            else: #Use raw binary
-                full_estimate.tofile(estimate_name)
-                history.tofile(history_name)
-            print "Done saving."
+            if converged:
+                print "Converged after %i iterations."%(i + 1)
+        if iteration_callback is not None:
+            iteration_callback(i, converged)
+        if converged:
+            break
+    return i + 1
+
+def deconvolve_blocks(
+    image_data, input_channels, estimate_name, block_shape,
+    psf_data, psf_sigma, num_iterations, halo=None, num_processes=1,
+    truncate_negative_values=False, slices=None, channels=None,
+    iteration_arguments=None):
+    """Deconvolve 'image_data' (usually a memmap) a block at a time,
+    writing into a memory-mapped estimate file, which we return.
+
+    'input_channels' is a list of (first slice, slice step) for each
+    channel to deconvolve; the estimate has these channels
+    interleaved. Each block is deconvolved together with a halo as
+    wide as the PSF reaches (unless 'halo' says otherwise), so the
+    part we keep doesn't see the edge of the block."""
+    first, step = input_channels[0]
+    channel_shape = image_data[first::step, :, :].shape
+    estimate_shape = ((channel_shape[0] * len(input_channels),) +
+                      channel_shape[1:])
+    if os.path.splitext(estimate_name)[1] in ('.tif', '.tiff'):
+        estimate = tif_memmap(
+            estimate_name, shape=estimate_shape, dtype=numpy.float32,
+            slices=slices, channels=channels)
+    else: #Use raw binary
+        estimate = numpy.memmap(estimate_name, dtype=numpy.float64,
+                                mode='w+', shape=estimate_shape)
+    if halo is None:
+        if psf_data == 'gaussian': #gaussian_filter() truncates at 4 sigma
+            halo = [int(numpy.ceil(4 * s)) for s in psf_sigma]
+        else:
+            halo = [s // 2 for s in psf_data.shape]
+    for name, value in (('block_shape', block_shape), ('halo', halo)):
+        if len(value) != len(channel_shape):
+            raise UserWarning(
+                "'%s' needs one entry for each dimension"%(name) +
+                " of the input image.")
+    blocks = []
+    for c in range(len(input_channels)):
+        for corner in itertools.product(*[
+            range(0, n, b) for n, b in zip(channel_shape, block_shape)]):
+            core = tuple((s, min(s + b, n)) for s, b, n in zip(
+                corner, block_shape, channel_shape))
+            padded = tuple((max(s - h, 0), min(e + h, n)) for (s, e), h, n in
+                           zip(core, halo, channel_shape))
+            blocks.append((c, padded, core))
+    print "Deconvolving", len(blocks), "blocks with halo", tuple(halo)
+    worker_arguments = (
+        _array_source(image_data), input_channels, _array_source(estimate),
+        psf_data, psf_sigma, num_iterations, truncate_negative_values,
+        iteration_arguments or {})
+    start = clock()
+    if num_processes == 1:
+        _block_worker_init(*worker_arguments)
+        for i, block in enumerate(blocks):
+            _block_worker(block)
+            sys.stdout.write("\rDeconvolved blocks: %i/%i"%(
+                i + 1, len(blocks)))
             sys.stdout.flush()
-    return (full_estimate, history)
+    else:
+        pool = multiprocessing.Pool(
+            processes=num_processes,
+            initializer=_block_worker_init, initargs=worker_arguments)
+        try:
+            for i, block in enumerate(
+                pool.imap_unordered(_block_worker, blocks)):
+                sys.stdout.write("\rDeconvolved blocks: %i/%i"%(
+                    i + 1, len(blocks)))
+                sys.stdout.flush()
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    end = clock()
+    print "\nElapsed time: %0.2f seconds"%(end - start)
+    estimate.flush()
+    return estimate
+
+def _array_source(a):
+    """How a worker process can get at array 'a': memmaps (as they were
+    loaded, not views of them) get reopened from their file, instead of
+    pickling all their data."""
+    if isinstance(a, numpy.memmap) and a.filename is not None:
+        return (a.filename, a.dtype.str, a.offset, a.shape)
+    return a
+
+def _open_array_source(source, mode):
+    if isinstance(source, numpy.ndarray):
+        return source
+    filename, dtype, offset, shape = source
+    return numpy.memmap(filename, dtype=dtype, mode=mode,
+                        offset=offset, shape=shape)
+
+_worker_state = {}
+
+def _block_worker_init(
+    image_source, input_channels, estimate_source, psf_data, psf_sigma,
+    num_iterations, truncate_negative_values, iteration_arguments):
+    """Runs once in each of deconvolve_blocks()' worker processes"""
+    _worker_state['image_data'] = _open_array_source(image_source, 'r')
+    _worker_state['input_channels'] = input_channels
+    _worker_state['estimate'] = _open_array_source(estimate_source, 'r+')
+    _worker_state['psf_data'] = psf_data
+    _worker_state['psf_sigma'] = psf_sigma
+    _worker_state['num_iterations'] = num_iterations
+    _worker_state['truncate_negative_values'] = truncate_negative_values
+    _worker_state['iteration_arguments'] = iteration_arguments
+    _worker_state['blur_arguments'] = {} #One per block shape
+    return None
+
+def _block_worker(block):
+    """Deconvolve one block and its halo, and put the block in place"""
+    c, padded, core = block
+    first, step = _worker_state['input_channels'][c]
+    image_channel = _worker_state['image_data'][first::step, :, :]
+    image_block = image_channel[
+        tuple(slice(*p) for p in padded)].astype(numpy.float64)
+    if _worker_state['truncate_negative_values']:
+        image_block[image_block < 0] = 0
+    image_block += 1e-12
+    if image_block.shape not in _worker_state['blur_arguments']:
+        _worker_state['blur_arguments'][image_block.shape] = (
+            get_blur_arguments(_worker_state['psf_data'],
+                               _worker_state['psf_sigma'], image_block.shape))
+    estimate_block = image_block.copy()
+    richardson_lucy_iterations(
+        estimate_block, image_block, _worker_state['num_iterations'],
+        _worker_state['blur_arguments'][image_block.shape], verbose=False,
+        **_worker_state['iteration_arguments'])
+    num_channels = len(_worker_state['input_channels'])
+    estimate_channel = _worker_state['estimate'][c::num_channels, :, :]
+    estimate_channel[tuple(slice(*x) for x in core)] = estimate_block[
+        tuple(slice(s - p, e - p) for (s, e), (p, q) in zip(core, padded))]
+    return block
+
+def physical_memory():
+    """Total RAM in bytes, or None if we can't tell"""
+    if sys.platform.startswith('win'):
+        class MEMORYSTATUSEX(ctypes.Structure):
+            _fields_ = [('dwLength', ctypes.c_ulong),
+                        ('dwMemoryLoad', ctypes.c_ulong),
+                        ('ullTotalPhys', ctypes.c_ulonglong),
+                        ('ullAvailPhys', ctypes.c_ulonglong),
+                        ('ullTotalPageFile', ctypes.c_ulonglong),
+                        ('ullAvailPageFile', ctypes.c_ulonglong),
+                        ('ullTotalVirtual', ctypes.c_ulonglong),
+                        ('ullAvailVirtual', ctypes.c_ulonglong),
+                        ('ullAvailExtendedVirtual', ctypes.c_ulonglong)]
+        status = MEMORYSTATUSEX()
+        status.dwLength = ctypes.sizeof(status)
+        if ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status)):
+            return status.ullTotalPhys
+        return None
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def get_image_size(image_filename, image_data_shape=None,
+                   image_data_dtype=None):
+    """The number of pixels and color channels in an image file,
+    without loading it"""
+    if os.path.splitext(image_filename)[1] in ('.tif', '.tiff'):
+        info = get_tif_info(image_filename, return_ifd_info=True)
+        description = dict([
+            x.split('=') for x in info['ifd_info']['description'].split('\n')
+            if len(x.split('=')) > 1])
+        return (info['num_slices'] * info['length'] * info['width'],
+                int(description.get('channels', 1)))
+    if image_data_shape is not None:
+        return int(numpy.prod(image_data_shape)), 1
+    itemsize = numpy.dtype(image_data_dtype or numpy.uint16).itemsize
+    return os.path.getsize(image_filename) // itemsize, 1
+
+def estimate_memory_footprint(num_pixels, num_channels=1,
+                              split_channels=False, block_shape=None):
+    """
+    A rough (generous) guess at the most memory, in bytes, one call to
+    richardson_lucy_deconvolution() needs, for an image with
+    'num_pixels' pixels. With 'split_channels', the call only
+    deconvolves one of the 'num_channels' channels, but it still loads
+    all of them.
+    """
+    if block_shape is not None:
+        """Memory-mapped; a block, its halo and their temporaries"""
+        return 80 * int(numpy.prod([2 * b for b in block_shape]))
+    if split_channels:
+        deconvolved_pixels = num_pixels // num_channels
+    else:
+        deconvolved_pixels = num_pixels
+    """The file's own (16-bit) data, and a float64 copy of just the
+    channels we deconvolve"""
+    loaded = 2 * num_pixels + 8 * deconvolved_pixels
+    saved = 16 * deconvolved_pixels #The estimate, and a copy being saved
+    """Estimates, predictions, ratios and FFTs of one channel at a
+    time; measured at ~130 bytes per pixel in all, with acceleration"""
+    working = 112 * (num_pixels // num_channels)
+    return loaded + saved + working
+
+class DeconvolutionScheduler:
+    """
+    Runs richardson_lucy_deconvolution() for many image files at once,
+    on a pool of worker processes. Multi-color files are split into
+    one job per channel, so their channels run in parallel too.
+
+    A job only starts if the memory we estimate it needs fits in
+    'memory_limit' (bytes; by default three quarters of the RAM), along
+    with the jobs already running. Jobs start in the order they were
+    submitted, so a big job can't be overtaken forever.
+
+    FFTs and other numpy math can use several threads each (MKL,
+    OpenBLAS). Each worker limits the libraries it can find (see
+    limit_math_threads()) to 'fft_threads' (by default, its share of
+    the CPUs), so the workers don't fight over the cores.
+
+    Typical use is submit() a few times, then join(); or call poll()
+    regularly between submissions, like decon_daemon.py does.
+    """
+    def __init__(self, num_processes=None, memory_limit=None,
+                 fft_threads=None, verbose=True):
+        if num_processes is None:
+            num_processes = multiprocessing.cpu_count()
+        if memory_limit is None:
+            memory_limit = physical_memory()
+            if memory_limit is not None:
+                memory_limit = int(0.75 * memory_limit)
+        if fft_threads is None:
+            fft_threads = max(1, multiprocessing.cpu_count() // num_processes)
+        self.num_processes = num_processes
+        self.memory_limit = memory_limit
+        self.fft_threads = fft_threads
+        self.verbose = verbose
+        self.pending = []
+        self.running = []
+        self.finished = []
+        self.failed = []
+        """One job per worker process, so a finished job's memory
+        really goes back to the system"""
+        self.pool = multiprocessing.Pool(
+            processes=num_processes, maxtasksperchild=1,
+            initializer=_job_worker_init, initargs=(fft_threads,))
+        return None
+
+    def submit(self, image_filename, split_channels=True,
+               **deconvolution_arguments):
+        """Queue up richardson_lucy_deconvolution() for
+        'image_filename'. The arguments have to be complete enough that
+        nobody needs to be asked anything."""
+        if deconvolution_arguments.get('num_processes', 1) != 1:
+            raise UserWarning(
+                "Scheduled jobs run in worker processes, which can't start" +
+                " their own. Give the scheduler more processes instead.")
+        num_pixels, num_channels = get_image_size(
+            image_filename,
+            deconvolution_arguments.get('image_data_shape'),
+            deconvolution_arguments.get('image_data_dtype'))
+        which_channel = deconvolution_arguments.pop('which_channel', 'all')
+        if which_channel != 'all' and which_channel not in range(
+            num_channels):
+            raise UserWarning(
+                "'which_channel' is %r, but %s has %i channel(s)"%(
+                    which_channel, image_filename, num_channels))
+        if which_channel == 'all' and split_channels and num_channels > 1:
+            which_channels = range(num_channels)
+        else:
+            which_channels = [which_channel]
+            split_channels = which_channel != 'all'
+        output_name = deconvolution_arguments.pop('output_name', None)
+        if output_name is None:
+            head, tail = os.path.splitext(image_filename)
+            if tail not in ('.tif', '.tiff'):
+                tail = '.raw'
+            output_name = head + tail
+        memory = estimate_memory_footprint(
+            num_pixels, num_channels, split_channels,
+            deconvolution_arguments.get('block_shape'))
+        for c in which_channels:
+            arguments = dict(deconvolution_arguments)
+            arguments['image_data'] = image_filename
+            arguments['which_channel'] = c
+            if split_channels:
+                head, tail = os.path.splitext(output_name)
+                arguments['output_name'] = head + '_channel%i'%(c) + tail
+            else:
+                arguments['output_name'] = output_name
+            name = os.path.split(arguments['output_name'])[1]
+            self.pending.append((name, memory, arguments))
+        self.poll()
+        return None
+
+    def poll(self):
+        """Start any jobs that fit, and collect any that finished.
+        Returns how many jobs are waiting or running."""
+        for job in list(self.running):
+            name, memory, result = job
+            if not result.ready():
+                continue
+            self.running.remove(job)
+            try:
+                elapsed, libraries = result.get()
+                self.finished.append(name)
+                if self.verbose:
+                    print "Finished %s (%0.1f s)"%(name, elapsed),
+                    print "with %i math threads in: %s"%(
+                        self.fft_threads, ', '.join(libraries) or
+                        "(no library we know how to limit)")
+            except Exception as e:
+                self.failed.append((name, e))
+                print "Deconvolution of %s failed:"%(name), repr(e)
+        while len(self.pending) > 0 and len(self.running) < self.num_processes:
+            name, memory, arguments = self.pending[0]
+            memory_in_use = sum(m for n, m, r in self.running)
+            if (len(self.running) > 0 and self.memory_limit is not None and
+                memory_in_use + memory > self.memory_limit):
+                break #Wait for memory to free up
+            self.pending.pop(0)
+            if self.verbose:
+                print "Starting %s (~%0.2f GB)"%(name, memory * 1e-9)
+            self.running.append((name, memory, self.pool.apply_async(
+                _job_worker, (arguments,))))
+        return len(self.pending) + len(self.running)
+
+    def join(self):
+        """Wait for every submitted job to finish"""
+        while self.poll() > 0:
+            time.sleep(0.1)
+        return None
+
+    def close(self):
+        self.join()
+        self.pool.close()
+        self.pool.join()
+        return None
+
+def limit_math_threads(num_threads):
+    """
+    Limit the threads numpy's math libraries use, in this process.
+    Setting OMP_NUM_THREADS and friends only works before numpy is
+    imported, which is too late for pool workers, so we ask each
+    library directly. Returns the names of the ones we limited.
+    """
+    limited = []
+    try:
+        import threadpoolctl
+        _worker_state['thread_limits'] = threadpoolctl.threadpool_limits(
+            num_threads) #Keep it, in case it undoes itself when collected
+        limited.append('threadpoolctl')
+    except ImportError:
+        pass
+    try:
+        import mkl #numpy builds that FFT with MKL
+        mkl.set_num_threads(num_threads)
+        limited.append('mkl')
+    except ImportError:
+        pass
+    """numpy's wheels bundle OpenBLAS; it's already loaded, so loading
+    it again gets the same library"""
+    for library_name in glob.glob(os.path.join(
+        os.path.dirname(numpy.__file__), '.libs', '*openblas*')):
+        try:
+            library = ctypes.CDLL(library_name)
+            library.openblas_set_num_threads(ctypes.c_int(num_threads))
+            limited.append(os.path.basename(library_name))
+        except (OSError, AttributeError):
+            pass
+    return limited
+
+def _job_worker_init(fft_threads):
+    """Runs once in each of DeconvolutionScheduler's worker processes"""
+    _worker_state['math_thread_libraries'] = limit_math_threads(fft_threads)
+    return None
+
+def _job_worker(arguments):
+    start = clock()
+    richardson_lucy_deconvolution(**arguments)
+    return clock() - start, _worker_state['math_thread_libraries']
+
+class CheckpointWriter:
+    """Saves copies of the estimate, and flushes the (memory-mapped)
+    history to disk along with it. With 'background', this happens on
+    a separate thread; if the disk can't keep up, save() waits for the
+    previous save to start, so there's at most one extra copy waiting.
+    """
+    def __init__(self, estimate_name, history,
+                 slices=None, channels=None, background=True):
+        self.estimate_name = estimate_name
+        self.tif = os.path.splitext(estimate_name)[1] in ('.tif', '.tiff')
+        self.history = history
+        self.slices = slices
+        self.channels = channels
+        self.background = background
+        self.up_to_date = False
+        if background:
+            self._queue = Queue.Queue(maxsize=1)
+            self._error = None
+            self._thread = threading.Thread(
+                target=self._save_checkpoints, name='Checkpoint writer')
+            self._thread.daemon = True
+            self._thread.start()
+        return None
+
+    def save(self, full_estimate):
+        if self.tif:
+            estimate = full_estimate.astype(numpy.float32)
+        else:
+            estimate = full_estimate.copy()
+        if self.background:
+            self._queue.put(estimate)
+        else:
+            self._save(estimate)
+        self.up_to_date = True
+        return None
+
+    def _save(self, estimate):
+        if self.tif:
+            array_to_tif(estimate, outfile=self.estimate_name,
+                         slices=self.slices, channels=self.channels)
+        else: #Use raw binary
+            estimate.tofile(self.estimate_name)
+        self.history.flush()
+        return None
+
+    def _save_checkpoints(self):
+        while True:
+            estimate = self._queue.get()
+            if estimate is None:
+                break
+            if self._error is not None:
+                continue #Don't bother, close() will raise the error
+            try:
+                self._save(estimate)
+            except Exception as e:
+                self._error = e
+        return None
+
+    def close(self):
+        """Wait for any saves still in progress"""
+        if self.background:
+            self._queue.put(None)
+            self._thread.join()
+            if self._error is not None:
+                raise self._error
+        self.history.flush()
+        return None
+
+def get_transfer_function(psf_data, image_shape, cache_directory=None):
+    """The real-to-complex FFT of the conditioned PSF (its optical
+    transfer function), padded to a shape numpy's FFTs are fast at.
+    Returns the transfer function and the padded shape.
+
+    The padding is at least as big as the PSF, so convolving with it
+    never wraps around: the object is zero outside the image, whatever
+    size the image is.
+
+    It only depends on the PSF and the image shape, so if
+    'cache_directory' isn't None, we save it there and reuse it."""
+    fft_shape = tuple(best_fft_shape(
+        numpy.add(image_shape, psf_data.shape) - 1))
+    if cache_directory is not None:
+        parameters = ('psf_otf', psf_data, fft_shape)
+        cache_name = os.path.join(cache_directory, 'psf_otf_%s.npy'%(
+            artifact_cache.parameter_key(parameters)))
+        if artifact_cache.is_cached([cache_name], [], parameters):
+            print "Loading", os.path.split(cache_name)[1]
+            return numpy.load(cache_name), fft_shape
+    otf = numpy.fft.rfftn(
+        condition_psf_data(psf_data.copy(), new_shape=fft_shape))
+    if cache_directory is not None:
+        numpy.save(cache_name, otf)
+        artifact_cache.store([cache_name], [], parameters)
+    return otf, fft_shape
+
+def fft_convolve(data, otf, fft_shape, adjoint=False):
+    """Convolve real 'data' with the PSF whose transfer function is
+    'otf', zero-padding it to 'fft_shape' and cropping the result back
+    to the shape of 'data'. 'adjoint' correlates instead: the exact
+    transpose of the convolution, using the conjugate transfer
+    function."""
+    data_fft = numpy.fft.rfftn(data, fft_shape)
+    if adjoint: #conj(conj(a) * b) is a * conj(b), without a copy of 'otf'
+        numpy.conjugate(data_fft, out=data_fft)
+    data_fft *= otf
+    if adjoint:
+        numpy.conjugate(data_fft, out=data_fft)
+    return numpy.fft.irfftn(data_fft, fft_shape)[
+        tuple(slice(0, s) for s in data.shape)]
 
 def condition_psf_data(psf_data, new_shape=None):
     """Prepare the PSF for FFT-based convolution.
@@ -226,13 +900,13 @@ def condition_psf_data(psf_data, new_shape=None):
 ##                     cmap=pylab.cm.gray, interpolation='nearest')
 ##        fig.show()
 ##    padded_psf_data.tofile('out.raw')
-    return fftshift(padded_psf_data)
+    return ifftshift(padded_psf_data)
 
 def image_data_as_array(
     image_data, image_data_shape, image_data_dtype,
     output_name, verbose, config,
     title='Select an image to deconvolve',
-    initialfile='image.tif', master=None
+    initialfile='image.tif', master=None, memmap=False
     ):
 
     if image_data is None:
@@ -268,7 +942,8 @@ def image_data_as_array(
                     dtype=image_data_dtype,
                     verbose=verbose,
                     config=config,
-                    master=master)
+                    master=master,
+                    memmap=memmap)
                 break
             except UserWarning as e:
                 print e
@@ -276,29 +951,38 @@ def image_data_as_array(
             return 'cancelled', None, None
     else:
         if output_name is None:
-            output_name = os.path.join(os.path.getcwd(), 'deconvolution.raw')
+            output_name = os.path.join(os.getcwd(), 'deconvolution.raw')
+        num_channels = 1
     print image_data.shape
-    assert type(image_data) is numpy.ndarray
+    assert isinstance(image_data, numpy.ndarray)
     return image_data, output_name, num_channels
 
 def image_filename_to_array(
     image_filename, shape=None, dtype=None,
-    verbose=True, config=None, master=None):
+    verbose=True, config=None, master=None, memmap=False):
     """Load tif (.tif, .tiff extension) and raw binary files (.dat,
-    .raw extension). If raw binary, 'dtype' and 'shape' must be specified."""
+    .raw extension). If raw binary, 'dtype' and 'shape' must be specified.
+    If 'memmap', return a read-only memmap instead of loading the data."""
     if verbose:
         print "Loading %s..."%(os.path.split(image_filename)[1])
     extension = os.path.splitext(image_filename)[1]
     if extension in ('.tif', '.tiff'):
-        a, info = tif_to_array(image_filename, return_info=True)
+        if memmap:
+            tif_info = get_tif_info(image_filename, return_ifd_info=True)
+            a = numpy.memmap(
+                image_filename, dtype=tif_info['dtype'], mode='r',
+                offset=tif_info['offset'],
+                shape=(tif_info['num_slices'],
+                       tif_info['length'], tif_info['width']))
+            info = tif_info['ifd_info']
+        else:
+            a, info = tif_to_array(image_filename, return_info=True)
         info = dict([x.split('=') for x in info['description'].split('\n')
                 if len(x.split('=')) > 1])
-        if verbose and int(info.get('channels', 1)) > 1:
+        channels = int(info.get('channels', 1))
+        if verbose and channels > 1:
             print "Image data seems to be an ImageJ hyperstack",
             print " with multiple colors."
-            channels = int(info['channels'])
-        else:
-            channels = 1
         return a, channels
     elif extension in ('.raw', '.dat'):
         if (shape is None) or (dtype is None):
@@ -320,7 +1004,10 @@ def image_filename_to_array(
                 }[dtype_name]
         else:
             xy_shape = shape[1:]
-        data = numpy.fromfile(image_filename, dtype=dtype)
+        if memmap:
+            data = numpy.memmap(image_filename, dtype=dtype, mode='r')
+        else:
+            data = numpy.fromfile(image_filename, dtype=dtype)
         try:
             data = data.reshape(
                 (data.size // (xy_shape[0] * xy_shape[1]),) + xy_shape)
@@ -1,5 +1,5 @@
 import os, time
-from decon import richardson_lucy_deconvolution
+from decon import DeconvolutionScheduler
 
 def pull_from_processing_queue(queue_name, temp_name):
     os.rename(queue_name, temp_name)
@@ -16,35 +16,38 @@ def pull_from_processing_queue(queue_name, temp_name):
     os.rename(temp_name, queue_name)
     return process_this
 
-print "Use Ctrl-C to quit."
-print "Ready to process..."
-cwd = os.getcwd()
-queue_name = os.path.join(os.getcwd(), 'processing_queue.txt')
-temp_name = os.path.splitext(queue_name)[0] + '.temp'
-while True:
-    if os.path.exists(queue_name):
-        process_this = pull_from_processing_queue(queue_name, temp_name)
-        if process_this:
-            info = {}
-            for p in process_this.split(';'):
-                k, v = p.strip().split('=')
-                info[k] = v
-            assert os.path.exists(info['filename'])
-            assert os.path.splitext(info['filename'])[1] in (
-                '.tif', '.tiff')
-            print "Filename:", info['filename']
-            sigma = [int(i) for i in info['sigma'].split(', ')]
-            assert len(sigma) == 3
-            print "Gaussian sigma for decon:", sigma
-            iterations = int(info['iterations'])
-            richardson_lucy_deconvolution(
-                image_data=info['filename'],
-                num_iterations=iterations,
-                psf_data='gaussian',
-                psf_sigma=sigma)
-        else:
-            print "Empty queue"
-            print
-    time.sleep(0.1)
-        
-
+if __name__ == '__main__': #Worker processes import this module, too
+    scheduler = DeconvolutionScheduler()
+    print "Use Ctrl-C to quit."
+    print "Ready to process..."
+    print "Up to %i files/channels at once,"%(scheduler.num_processes),
+    print "asking for %i math threads each"%(scheduler.fft_threads)
+    cwd = os.getcwd()
+    queue_name = os.path.join(os.getcwd(), 'processing_queue.txt')
+    temp_name = os.path.splitext(queue_name)[0] + '.temp'
+    while True:
+        if os.path.exists(queue_name):
+            process_this = pull_from_processing_queue(queue_name, temp_name)
+            if process_this:
+                info = {}
+                for p in process_this.split(';'):
+                    k, v = p.strip().split('=')
+                    info[k] = v
+                assert os.path.exists(info['filename'])
+                assert os.path.splitext(info['filename'])[1] in (
+                    '.tif', '.tiff')
+                print "Filename:", info['filename']
+                sigma = [int(i) for i in info['sigma'].split(', ')]
+                assert len(sigma) == 3
+                print "Gaussian sigma for decon:", sigma
+                iterations = int(info['iterations'])
+                scheduler.submit(
+                    info['filename'],
+                    num_iterations=iterations,
+                    psf_data='gaussian',
+                    psf_sigma=sigma)
+            else:
+                print "Empty queue"
+                print
+        scheduler.poll()
+        time.sleep(0.1)
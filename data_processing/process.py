@@ -7,97 +7,118 @@ scan_type = 'dmd'
 scan_dimensions = (16, 14)
 preframes = 0
 num_harmonics = 3 #Default to 3, might have to lower to 2
+num_processes = 6
+chunk_size = 10 #Frames per task handed to each worker process
+tile_rows = None #Set (to, say, 256) to split huge fields of view into tiles
+reconstruction_dtype = 'float64' #'float32' halves memory and saved images
+stack_dtype = 'float64' #'float32' halves the joined stacks, 'uint16' quarters
+cache_size_limit = None #Bytes of derived data to keep per directory; None keeps all
 
 ##Don't edit below here
 ###############################################################################
 import pprint
-import array_illumination
+import array_illumination, artifact_cache
+artifact_cache.max_directory_bytes = cache_size_limit
 
-(data_dir, data_filenames_list, lake_filename, background_filename
- ) = array_illumination.get_data_locations()
+if __name__ == '__main__': #Required for the worker processes on Windows
+    (data_dir, data_filenames_list, lake_filename, background_filename
+     ) = array_illumination.get_data_locations()
 
-print "Calibration source:", lake_filename
-print "Background source:", background_filename
+    print "Calibration source:", lake_filename
+    print "Background source:", background_filename
 
-use_all_lake_parameters = array_illumination.use_lake_parameters()
+    use_all_lake_parameters = array_illumination.use_lake_parameters()
 
-"""Find a set of shift vectors which characterize the illumination"""
-print "\nDetecting illumination lattice parameters..."
-(lattice_vectors, shift_vector, offset_vector,
- intensities_vs_galvo_position, background_frame
- ) = array_illumination.get_lattice_vectors(
-     filename_list=data_filenames_list,
-     lake=lake_filename, bg=background_filename,
-     use_lake_lattice=True,
-     use_all_lake_parameters=use_all_lake_parameters,
-     xPix=xPix, yPix=yPix, zPix=zPix, bg_zPix=background_zPix,
-     preframes=preframes,
-     extent=extent, #Important to get this right.
-     num_spikes=300,
-     tolerance=3.5,
-     num_harmonics=num_harmonics,
-     outlier_phase=1.,
-     calibration_window_size=10,
-     scan_type=scan_type,
-     scan_dimensions=scan_dimensions,
-     verbose=True, #Useful for debugging
-     display=True, #Useful for debugging
-     animate=animate, #Useful to see if 'extent' is right
-     show_interpolation=False, #Fairly low-level debugging
-     show_calibration_steps=False, #Useful for debugging
-     show_lattice=True) #Very useful for checking validity
-print "Lattice vectors:"
-for v in lattice_vectors:
-    print v
-print "Shift vector:"
-pprint.pprint(shift_vector)
-print "Initial position:"
-print offset_vector
+    """Find a set of shift vectors which characterize the illumination"""
+    print "\nDetecting illumination lattice parameters..."
+    (lattice_vectors, shift_vector, offset_vector,
+     intensities_vs_galvo_position, background_frame
+     ) = array_illumination.get_lattice_vectors(
+         filename_list=data_filenames_list,
+         lake=lake_filename, bg=background_filename,
+         use_lake_lattice=True,
+         use_all_lake_parameters=use_all_lake_parameters,
+         xPix=xPix, yPix=yPix, zPix=zPix, bg_zPix=background_zPix,
+         preframes=preframes,
+         extent=extent, #Important to get this right.
+         num_spikes=300,
+         tolerance=3.5,
+         num_harmonics=num_harmonics,
+         outlier_phase=1.,
+         calibration_window_size=10,
+         scan_type=scan_type,
+         scan_dimensions=scan_dimensions,
+         verbose=True, #Useful for debugging
+         display=True, #Useful for debugging
+         animate=animate, #Useful to see if 'extent' is right
+         show_interpolation=False, #Fairly low-level debugging
+         show_calibration_steps=False, #Useful for debugging
+         show_lattice=True) #Very useful for checking validity
+    print "Lattice vectors:"
+    for v in lattice_vectors:
+        print v
+    print "Shift vector:"
+    pprint.pprint(shift_vector)
+    print "Initial position:"
+    print offset_vector
 
-"""Define a new Cartesian grid for Enderlein's trick:"""
-new_grid_xrange = 0, xPix-1, 2*xPix
-new_grid_yrange = 0, yPix-1, 2*yPix
+    """Define a new Cartesian grid for Enderlein's trick:"""
+    new_grid_xrange = 0, xPix-1, 2*xPix
+    new_grid_yrange = 0, yPix-1, 2*yPix
 
-num_processes = 6
-for f in data_filenames_list:
-    print
-    print f
-    def profile_me():
-        array_illumination.enderlein_image_parallel(
-            data_filename=f,
-            lake_filename=lake_filename,
-            background_filename=background_filename,
-            xPix=xPix, yPix=yPix, zPix=zPix, steps=steps, preframes=preframes,
-            lattice_vectors=lattice_vectors,
-            offset_vector=offset_vector,
-            shift_vector=shift_vector,
-            new_grid_xrange=new_grid_xrange, new_grid_yrange=new_grid_yrange,
-            num_processes = num_processes,
-            window_footprint=10,
-            aperture_size=3,
-            make_widefield_image=True,
-            make_confocal_image=False, #Broken, for now
-            verbose=True,
-            show_steps=False, #For debugging
-            show_slices=False, #For debugging
-            intermediate_data=False, #Memory hog, leave 'False'
-            normalize=False, #Of uncertain merit, leave 'False' probably
-            display=False
-            )
-    if num_processes == 1:
-        import cProfile
-        cProfile.run('profile_me()', 'profile_results')
-        try:
-            import pstats
-            p = pstats.Stats('profile_results')
-            p.strip_dirs().sort_stats(-1).print_stats()
-            p.sort_stats('cumulative').print_stats(20)
-        except ImportError:
-            pass
-    else:
-        profile_me()
+    """Join each reconstruction into the output stacks while the next
+    file is being reconstructed"""
+    joiner = array_illumination.Enderlein_Stack_Joiner(
+        data_filenames_list,
+        new_grid_xrange, new_grid_yrange,
+        join_widefield_images=False,
+        dtype=stack_dtype)
+    for i, f in enumerate(data_filenames_list):
+        print
+        print f
+        def profile_me():
+            array_illumination.enderlein_image_parallel(
+                data_filename=f,
+                lake_filename=lake_filename,
+                background_filename=background_filename,
+                xPix=xPix, yPix=yPix, zPix=zPix, steps=steps,
+                preframes=preframes,
+                lattice_vectors=lattice_vectors,
+                offset_vector=offset_vector,
+                shift_vector=shift_vector,
+                new_grid_xrange=new_grid_xrange,
+                new_grid_yrange=new_grid_yrange,
+                num_processes=num_processes,
+                chunk_size=chunk_size,
+                tile_rows=tile_rows,
+                window_footprint=10,
+                aperture_size=3,
+                make_widefield_image=True,
+                make_confocal_image=False, #Broken, for now
+                verbose=True,
+                show_steps=False, #For debugging
+                show_slices=False, #For debugging
+                intermediate_data=False, #Memory hog, leave 'False'
+                normalize=False, #Of uncertain merit, leave 'False' probably
+                display=False,
+                dtype=reconstruction_dtype
+                )
+        if num_processes == 1:
+            import cProfile
+            cProfile.run('profile_me()', 'profile_results')
+            try:
+                import pstats
+                p = pstats.Stats('profile_results')
+                p.strip_dirs().sort_stats(-1).print_stats()
+                p.sort_stats('cumulative').print_stats(20)
+            except ImportError:
+                pass
+        else:
+            profile_me()
+        array_illumination.close_image_stack_readers(f)
+        joiner.add_file(i)
+    array_illumination.close_image_stack_readers() #Lake and background
 
-array_illumination.join_enderlein_images(
-    data_filenames_list,
-    new_grid_xrange, new_grid_yrange,
-    join_widefield_images=False)
+    print "Joining enderlein images into stack..."
+    joiner.close()
+    print "Done joining."
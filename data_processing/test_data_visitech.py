@@ -1,6 +1,6 @@
 import sys, cPickle, numpy, pylab
 from scipy.ndimage import gaussian_filter
-poisson = numpy.vectorize(numpy.random.poisson)
+poisson = numpy.random.poisson #Works on whole arrays at once
 
 pylab.close('all')
 
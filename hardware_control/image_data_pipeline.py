@@ -36,10 +36,17 @@ class Image_Data_Pipeline:
         self,
         num_buffers=100,
         buffer_shape=(60, 256, 512),
+        reconstructor=None,
         ):
         """
         Allocate a bunch of 16-bit buffers for image data, and a few
         8-bit buffers for display data.
+
+        'reconstructor' is None, or an object with add_frame(z, image),
+        save(data_filename) and reset() methods, like
+        array_illumination.Enderlein_Reconstructor. If provided, every
+        data buffer is also fed to it after saving, so processed images
+        are ready as soon as acquisition finishes.
         """
         self.buffer_shape = buffer_shape
         self.buffer_size = int(np.prod(buffer_shape))
@@ -71,6 +78,16 @@ class Image_Data_Pipeline:
         self.file_saving = Data_Pipeline_File_Saving(
             data_buffers=self.data_buffers, buffer_shape=self.buffer_shape,
             input_queue=self.accumulation.output_queue)
+        if reconstructor is None:
+            self.reconstruction = None
+            self.idle_buffer_queue = self.file_saving.output_queue
+        else:
+            self.reconstruction = Data_Pipeline_Reconstruction(
+                data_buffers=self.data_buffers,
+                buffer_shape=self.buffer_shape,
+                reconstructor=reconstructor,
+                input_queue=self.file_saving.output_queue)
+            self.idle_buffer_queue = self.reconstruction.output_queue
         
         self.projection = Data_Pipeline_Projection(
             buffer_shape=self.buffer_shape,
@@ -90,16 +107,33 @@ class Image_Data_Pipeline:
         return None
     
     def load_data_buffers(
-        self, N, file_saving_info=None, collect_buffers=True, timeout=0):
+        self, N, file_saving_info=None, reconstruction_info=None,
+        collect_buffers=True, timeout=0):
         """
         'file_saving_info' is None, or a list of dicts. Each dict is a
         set of arguments to simple_tif.array_to_tif().
+
+        'reconstruction_info' is None, or a list of dicts, one per
+        buffer. Each dict has a 'first_frame' key, the scan position of
+        the buffer's first frame. A dict with a 'data_filename' key (the
+        file the scan's raw data is saved to) also saves the
+        reconstruction next to it when that buffer is done, and resets
+        the reconstructor for the next scan.
         """
         if file_saving_info is not None:
             if len(file_saving_info) != N:
                 raise UserWarning(
                     "If file saving info is provided, it must match the number" +
                     " of buffers loaded.")
+        if reconstruction_info is not None:
+            if self.reconstruction is None:
+                raise UserWarning(
+                    "Reconstruction info was provided, but this" +
+                    " Image_Data_Pipeline has no reconstructor.")
+            if len(reconstruction_info) != N:
+                raise UserWarning(
+                    "If reconstruction info is provided, it must match the" +
+                    " number of buffers loaded.")
         """
         Feed the pipe!
         """
@@ -125,13 +159,16 @@ class Image_Data_Pipeline:
             permission_slip = {'which_buffer': idle_buffer}
             if file_saving_info is not None:
                 permission_slip['file_info'] = file_saving_info.pop(0)
+            if reconstruction_info is not None:
+                permission_slip['reconstruction_info'] = (
+                    reconstruction_info.pop(0))
             self.camera.input_queue.put(permission_slip)
         return None
 
     def collect_data_buffers(self):
         while True:
             try:
-                strip_me = self.file_saving.output_queue.get_nowait()
+                strip_me = self.idle_buffer_queue.get_nowait()
             except Queue.Empty:
                 break
             self.idle_data_buffers.append(strip_me['which_buffer'])
@@ -158,8 +195,11 @@ class Image_Data_Pipeline:
         for p in (self.camera,
                   self.accumulation,
                   self.file_saving,
+                  self.reconstruction,
                   self.projection,
                   self.display):
+            if p is None:
+                continue
             p.commands.send(('set_buffer_shape', {'shape': buffer_shape}))
             while True:
                 if p.commands.poll():
@@ -181,22 +221,30 @@ class Image_Data_Pipeline:
         self.display.commands.send(('withdraw', {}))
 
     def check_children(self):
-        return {'Camera': self.camera.child.is_alive(),
-                'Accumulation': self.accumulation.child.is_alive(),
-                'File Saving': self.file_saving.child.is_alive(),
-                'Projection': self.projection.child.is_alive(),
-                'Display': self.display.child.is_alive()}
+        children = {'Camera': self.camera.child.is_alive(),
+                    'Accumulation': self.accumulation.child.is_alive(),
+                    'File Saving': self.file_saving.child.is_alive(),
+                    'Projection': self.projection.child.is_alive(),
+                    'Display': self.display.child.is_alive()}
+        if self.reconstruction is not None:
+            children['Reconstruction'] = (
+                self.reconstruction.child.is_alive())
+        return children
 
     def close(self):
         self.camera.input_queue.put(None)
         self.accumulation.input_queue.put(None)
         self.file_saving.input_queue.put(None)
+        if self.reconstruction is not None:
+            self.reconstruction.input_queue.put(None)
         self.projection.display_buffer_input_queue.put(None)
         self.projection.accumulation_buffer_input_queue.put(None)
         self.display.display_buffer_input_queue.put(None)
         self.camera.child.join()
         self.accumulation.child.join()
         self.file_saving.child.join()
+        if self.reconstruction is not None:
+            self.reconstruction.child.join()
         self.projection.child.join()
         self.display.child.join()
         return None
@@ -910,6 +958,86 @@ def file_saving_child_process(
             output_queue.put(permission_slip)
     return None
 
+class Data_Pipeline_Reconstruction:
+    def __init__(
+        self,
+        data_buffers,
+        buffer_shape,
+        reconstructor,
+        input_queue=None,
+        output_queue=None,
+        ):
+        if input_queue is None:
+            self.input_queue = mp.Queue()
+        else:
+            self.input_queue = input_queue
+
+        if output_queue is None:
+            self.output_queue = mp.Queue()
+        else:
+            self.output_queue = output_queue
+
+        self.commands, self.child_commands = mp.Pipe()
+
+        self.child = mp.Process(
+            target=reconstruction_child_process,
+            args=(data_buffers, buffer_shape, reconstructor,
+                  self.input_queue, self.output_queue, self.child_commands),
+            name='Reconstruction')
+        self.child.start()
+        return None
+
+def reconstruction_child_process(
+    data_buffers,
+    buffer_shape,
+    reconstructor,
+    input_queue,
+    output_queue,
+    commands,
+    ):
+    buffer_size = np.prod(buffer_shape)
+    while True:
+        if commands.poll():
+            cmd, args = commands.recv()
+            if cmd == 'set_buffer_shape':
+                buffer_shape = args['shape']
+                buffer_size = np.prod(buffer_shape)
+                commands.send(buffer_shape)
+            continue
+        try:
+            permission_slip = input_queue.get_nowait()
+        except Queue.Empty:
+            time.sleep(0.001)
+            continue
+        if permission_slip is None:
+            break
+        else:
+            process_me = permission_slip['which_buffer']
+            info("start buffer %i"%(process_me))
+            reconstruction_info = permission_slip.get('reconstruction_info')
+            if reconstruction_info is not None:
+                """
+                We only process the buffer if we know where it belongs
+                in the scan. Copy the frames out, so the buffer goes
+                back to the camera now, instead of after reconstruction.
+                """
+                with data_buffers[process_me].get_lock():
+                    frames = np.frombuffer(
+                        data_buffers[process_me].get_obj(), dtype=np.uint16
+                        )[:buffer_size].reshape(buffer_shape).copy()
+            info("end buffer %i"%(process_me))
+            output_queue.put(permission_slip)
+            if reconstruction_info is not None:
+                info("reconstructing buffer %i"%(process_me))
+                z = reconstruction_info['first_frame']
+                for i in range(frames.shape[0]):
+                    reconstructor.add_frame(z + i, frames[i, :, :])
+                if 'data_filename' in reconstruction_info:
+                    """Last buffer of the scan. Save, and start over."""
+                    reconstructor.save(reconstruction_info['data_filename'])
+                    reconstructor.reset()
+    return None
+
 if __name__ == '__main__':
     import logging
     logger = mp.log_to_stderr()
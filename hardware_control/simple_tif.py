@@ -58,6 +58,50 @@ def array_to_tif(a, outfile='out.tif', slices=None, channels=None,
         hyperstack = True
     else:
         hyperstack = False
+    if hyperstack:
+        image_description = ''.join((
+            'ImageJ=1.45s\nimages=%i\nchannels=%i\n'%(z, channels),
+            'slices=%i\nhyperstack=true\nmode=grayscale\n'%(slices),
+            'loop=false\nmin=%0.3f\nmax=%0.3f\n\x00'%(a.min(), a.max())))
+    else:
+        image_description = ''.join((
+            'ImageJ=1.45s\nimages=%i\nslices=%i\n'%(z, z),
+            'loop=false\nmin=%0.3f\nmax=%0.3f\n\x00'%(a.min(), a.max())))        
+    write_tif(outfile, a.shape, a.dtype, image_description, data=a)
+    return None
+
+def tif_memmap(outfile, shape, dtype, slices=None, channels=None):
+    """
+    Like array_to_tif(), but for a stack too big to hold in memory:
+    write the headers for a 'shape' stack of 'dtype' data, and return a
+    writeable memmap of the (zero-filled) data, to fill in a slice at a
+    time. There's no min or max in the image description, since we
+    don't know them yet, so ImageJ picks its own display range.
+    """
+    assert len(shape) == 3
+    z, y, x = shape
+    if slices is not None and channels is not None:
+        assert slices * channels == z
+        image_description = ''.join((
+            'ImageJ=1.45s\nimages=%i\nchannels=%i\n'%(z, channels),
+            'slices=%i\nhyperstack=true\nmode=grayscale\n'%(slices),
+            'loop=false\n\x00'))
+    else:
+        image_description = ''.join((
+            'ImageJ=1.45s\nimages=%i\nslices=%i\n'%(z, z),
+            'loop=false\n\x00'))
+    data_offset = write_tif(outfile, shape, dtype, image_description)
+    return numpy.memmap(outfile, dtype=dtype, mode='r+',
+                        offset=data_offset, shape=tuple(shape))
+
+def write_tif(outfile, shape, dtype, image_description, data=None):
+    """
+    Write a TIF of a 'shape' stack of 'dtype' data, with all the data
+    in one block. If 'data' is None, we leave a hole in the file for
+    the data. Returns where the data starts.
+    """
+    z, y, x = shape
+    dtype = numpy.dtype(dtype)
     """
     We have a precomputed header. We edit portions of the header which
     are specific to the array 'a':
@@ -78,36 +122,34 @@ def array_to_tif(a, outfile='out.tif', slices=None, channels=None,
         numpy.dtype('float64'): (3, 64),
         }
     try:
-        data_format[0], bits_per_sample[0] = allowed_dtypes[a.dtype]
+        data_format[0], bits_per_sample[0] = allowed_dtypes[dtype]
     except KeyError:
         warning_string = "Array datatype (%s) not allowed. Allowed types:"%(
-            a.dtype)
+            dtype)
         for i in sorted(allowed_dtypes.keys()):
             warning_string += '\n ' + repr(i)
         raise UserWarning(warning_string)
-    if hyperstack:
-        image_description = ''.join((
-            'ImageJ=1.45s\nimages=%i\nchannels=%i\n'%(z, channels),
-            'slices=%i\nhyperstack=true\nmode=grayscale\n'%(slices),
-            'loop=false\nmin=%0.3f\nmax=%0.3f\n\x00'%(a.min(), a.max())))
-    else:
-        image_description = ''.join((
-            'ImageJ=1.45s\nimages=%i\nslices=%i\n'%(z, z),
-            'loop=false\nmin=%0.3f\nmax=%0.3f\n\x00'%(a.min(), a.max())))        
+    data_nbytes = z*y*x*dtype.itemsize
     num_chars_in_image_description[0] = len(image_description)
     strip_offset[0] = 8 + header.nbytes + len(image_description)
+    data_offset = int(strip_offset[0])
     rows_per_strip[0] = y
     strip_byte_counts[0] = x*y*bits_per_sample[0] // 8
     if z == 1:
         next_ifd_offset[0] = 0
     else:
-        next_ifd_offset[0] = strip_offset[0] + a.nbytes
+        next_ifd_offset[0] = strip_offset[0] + data_nbytes
 
     f = open(outfile, 'wb')
     f.write('II*\x00\x08\x00\x00\x00')
     header.tofile(f)
     f.write(image_description)
-    a.tofile(f)
+    if data is None:
+        f.seek(data_nbytes, 1)
+        if z == 1:
+            f.truncate() #Nothing after the data to set the file size
+    else:
+        data.tofile(f)
     for which_header in range(1, z):
         if which_header == z-1:
             next_ifd_offset[0] = 0
@@ -116,7 +158,7 @@ def array_to_tif(a, outfile='out.tif', slices=None, channels=None,
         strip_offset[0] += strip_byte_counts[0]
         header.tofile(f)
     f.close()
-    return None
+    return data_offset
 
 """
 Now a simple parser, to check if our tif writer is doing what I hoped: